@@ -1,6 +1,5 @@
-import sys, json, logging, re
+import sys, json, logging, re, asyncio
 #import RPi.GPIO as GPIO
-from time import sleep, perf_counter, perf_counter_ns
 import paho.mqtt.client as mqtt
 from os import path
 from pathlib import Path
@@ -126,7 +125,7 @@ def on_message(client, userdata, msg):
     """on message callback will receive messages from the server/broker. Must be subscribed to the topic in on_connect"""
     global deviceD, MQTT_REGEX
     global mqtt_servoID, mqtt_servoAngle
-    global mqtt_controlsD, mqtt_stepreset
+    global mqtt_controlsD, mqtt_stepreset, motor_stream
     global mqtt_dummy1, mqtt_dummy2
     mqtt_logger.debug("Received: {0} with payload: {1}".format(msg.topic, str(msg.payload)))
     msgmatch = re.match(MQTT_REGEX, msg.topic)   # Check for match to subscribed topics
@@ -140,6 +139,15 @@ def on_message(client, userdata, msg):
             mqtt_controlsD = mqtt_payload
         if mqtt_topic[2] == 'stepreset':
             mqtt_stepreset = mqtt_payload
+        if mqtt_topic[2] == 'segments':
+            try:
+                motor_stream.push(mqtt_payload)   # [[ticks, delay_us, speed0, speed1], ...] played back by the stepper runner
+            except ValueError as exc:
+                mqtt_logger.error("Dropped segments on {0}: {1}".format(msg.topic, exc))
+        if mqtt_topic[2] == 'keyframe':   # Node-RED (re)started. Next payload of the delta devices on this lvl2 is a full keyframe
+            for item in deviceD.values():
+                if isinstance(item, dict) and item.get('delta') is not None and item['lvl2'] + 'ZCMD' == mqtt_topic[1]:
+                    item['delta'].request_keyframe()
         #if mqtt_topic[2] == 'group2A':
         #    mqtt_dummy1 = mqtt_payload
         #if mqtt_topic[2] == 'group2B':
@@ -231,7 +239,7 @@ def mqtt_setup(IPaddress):
     # Final NodeRed payload: fields[key]  data is accessed with msg.payload[0].key
     #                        tags(topic levels) are access with msg.payload[1].lvlx (lvl1, lvl2, lvl3)
 
-def setup_device(device, lvl2, publvl3, data_keys):
+def setup_device(device, lvl2, publvl3, data_keys, deadbands=None, heartbeat=60, mininterval=0.0, delta=None):
     global printcolor, deviceD
     if deviceD.get(device) == None:
         deviceD[device] = {}
@@ -250,6 +258,8 @@ def setup_device(device, lvl2, publvl3, data_keys):
                 deviceD[device]['data'][key] = 0
         deviceD[device]['pubtopic'] = MQTT_PUB_LVL1 + lvl2 + '/' + publvl3
         deviceD[device]['send'] = False
+        deviceD[device]['rbe'] = ReportByException(data_keys, deadbands, heartbeat=heartbeat, mininterval=mininterval) # Publish when a data_key moves past its deadband or after heartbeat sec
+        deviceD[device]['delta'] = DeltaEncoder(deadbands=deadbands, **delta) if delta is not None else None # Only keys changed since the last keyframe. Node-RED needs the Mdelta decoder
         printcolor = not printcolor # change color of every other print statement
         if printcolor: 
             main_logger.info(f"{pcolor.LBLUE}{device} Subscribing to: {topic}{pcolor.ENDC}")
@@ -263,6 +273,18 @@ def setup_device(device, lvl2, publvl3, data_keys):
         main_logger.error(f"Device {device} already in use. Device name should be unique")
         sys.exit(f"{pcolor.RED}Device {device} already in use. Device name should be unique{pcolor.ENDC}")
 
+def publish(device, payload, force=False):
+    ''' Publish payload on the device topic if report by exception lets it through. force=True publishes the latest payload anyway '''
+    rbe = deviceD[device]['rbe']
+    payload = rbe.check(payload)
+    if payload is None and force:
+        payload = rbe.latest
+    if payload is not None:
+        if deviceD[device]['delta'] is not None:
+            payload = deviceD[device]['delta'].encode(payload)
+        main_logger.debug("{} {}".format(deviceD[device]['pubtopic'], json.dumps(payload)))
+        mqtt_client.publish(deviceD[device]['pubtopic'], json.dumps(payload))
+
 def button_callback(channel):
         global buttonpressed, buttonvalue
         buttonpressed = True
@@ -274,7 +296,7 @@ def main():
     global _loggers, main_logger, mqtt_logger
     global buttonpressed, buttonvalue     # Joystick variables
     global mqtt_servoID                   # Servo variables
-    global mqtt_controlsD, mqtt_stepreset # Stepper motor controls
+    global mqtt_controlsD, mqtt_stepreset, motor_stream # Stepper motor controls
 
     # Type of loggers - 'basic' or 'custom'
     # 'custom' type -  log level and mode will determine output for custom loggers
@@ -301,6 +323,8 @@ def main():
     
     deviceD = {}  # Primary container for storing all devices, topics, and data
     printcolor = True
+    msginterval = 0.5       # Adjust interval to increase/decrease number of mqtt updates.
+    trace = TraceBuffer(8192)  # Hot path events from stepper/adc drivers. Formatted only when dumped (on exit with DEBUG)
     #==== HARDWARE SETUP =====#
     rotaryEncoderSet = {}
     logger_rotenc = setup_logging(path.dirname(path.abspath(__file__)), 'custom', 'rotenc', log_level=logging.INFO, mode=2)
@@ -308,10 +332,10 @@ def main():
     device = 'rotEnc1'  # Device name should be unique, can not duplicate device ID
     lvl2 = 'rotencoder' # Topic lvl2 name can be a duplicate, meaning multiple devices publishing data on the same topic
     publvl3 = MQTT_CLIENT_ID + "" # Will be a tag in influxdb. Optional to modify it and describe experiment being ran
-    data_keys = ['RotEnc1Ci', 'RotEnc1Bi'] # If topic lvl2 name repeats would likely want the data_keys to be unique
+    data_keys = ['RotEnc1Ci', 'RotEnc1Bi', 'RotEnc1Di', 'RotEnc1Vf', 'RotEnc1Af', 'RotEnc1Pi'] # Position, button, net delta, velocity, acceleration, presses. If topic lvl2 name repeats would likely want the data_keys to be unique
     clkPin, dtPin, button_rotenc = 17, 27, 24
     setup_device(device, lvl2, publvl3, data_keys)
-    rotaryEncoderSet[device] =  RotaryEncoder(clkPin, dtPin, button_rotenc, *data_keys, logger_rotenc) #rotaryencoder.RotaryEncoder(clkPin, dtPin, button_rotenc, *data_keys, rotenc_logger)
+    rotaryEncoderSet[device] =  RotaryEncoder(clkPin, dtPin, button_rotenc, *data_keys[:2], logger_rotenc, motion=dict(interval=0.1, window=0.1)) # One coalesced payload per 0.1s while turning #rotaryencoder.RotaryEncoder(clkPin, dtPin, button_rotenc, *data_keys, rotenc_logger)
     #------------#
     ina219Set = {}   # ina219 library has an internal logger named ina219. name it something different.
     logger_ina219 = setup_logging(path.dirname(path.abspath(__file__)), 'custom', 'ina219l', log_level=logging.INFO, mode=1)
@@ -320,18 +344,23 @@ def main():
     lvl2 = 'ina219A'  # Topic lvl2 name can be a duplicate, meaning multiple devices publishing data on the same topic
     publvl3 = MQTT_CLIENT_ID + "Test1" # Will be a tag in influxdb. Optional to modify it and describe experiment being ran
     data_keys = ['Vbusf', 'IbusAf', 'PowerWf'] # If topic lvl2 name repeats would likely want the data_keys to be unique
-    setup_device(device, lvl2, publvl3, data_keys)
-    ina219Set[device] = PiINA219(*data_keys, "auto", 0.4, 0x40, logger=logger_ina219) #  PiINA219(*data_keys, gainmode="auto", maxA=0.4, address=0x40, logger=ina219_logger) #piina219.PiINA219(*data_keys, gainmode="auto", maxA=0.4, address=0x40, logger=ina219_logger)
+    setup_device(device, lvl2, publvl3, data_keys, deadbands={'Vbusf': 0.05, 'IbusAf': 0.002, 'PowerWf': 0.01}, heartbeat=60) # Deadbands in V, A, W
+    filters = {'IbusAf': Pipeline(Kalman(q=1e-6, r=0.002**2))}  # Kalman on the current. q=process variance, r=measurement variance (A^2)
+    nonblocking = dict(shuntadc=ADC_128SAMP, busadc=ADC_12BIT)  # Conversion ready polling. getdata returns the cached reading plus its age 'Agef' until a new 68ms conversion is done
+    ina219Set[device] = PiINA219(*data_keys, "auto", 0.4, 0x40, logger=logger_ina219, filters=filters, nonblocking=nonblocking) #  PiINA219(*data_keys, gainmode="auto", maxA=0.4, address=0x40, logger=ina219_logger) #piina219.PiINA219(*data_keys, gainmode="auto", maxA=0.4, address=0x40, logger=ina219_logger)
     #------------#
     adcSet = {}  # Can comment out any ADC type not being used
     adc_logger = setup_logging(path.dirname(path.abspath(__file__)), 'custom', 'adc', log_level=logging.INFO, mode=1)
+    calibration = NoiseCalibration(path.join(path.dirname(path.abspath(__file__)), 'noise.json'), adc_logger)  # Calibrated noise thresholds from a previous run replace the ones passed
+    calibrate = False  # True measures the noise of every adc with the inputs idle and saves thresholds for the next start
 
     device = 'ads1115'
     lvl2 = 'ads1115' # Topic lvl2 name can be a duplicate, meaning multiple devices publishing data on the same topic
     publvl3 = MQTT_CLIENT_ID + "" # Will be a tag in influxdb. Optional to modify it and describe experiment being ran
     data_keys = ['a0f', 'a1f', 'etc'] # If topic lvl2 name repeats would likely want the data_keys to be unique
     setup_device(device, lvl2, publvl3, data_keys)
-    adcSet[device] = ads1115(1, 0.003, 1, 1, 0x48, adc_logger) # numOfChannels, noiseThreshold (V), max interval, gain=1 (+/-4.1V readings), address
+    filters = Pipeline(Median(5), LowPass(5, 860))  # Every buffered sample since the last poll is filtered. Drop spikes, then 5Hz low-pass at the 860SPS data rate
+    adcSet[device] = ads1115(1, 0.003, 1, 1, 0x48, adc_logger, trace=trace, continuous=True, datarate=860, filters=filters) # numOfChannels, noiseThreshold (V), max interval, gain=1 (+/-4.1V readings), address. continuous samples on a background thread
     
     device = 'mcp3008'
     lvl2 = 'mcp3008' # Topic lvl2 name can be a duplicate, meaning multiple devices publishing data on the same topic
@@ -340,7 +369,25 @@ def main():
     setup_device(device, lvl2, publvl3, data_keys)
     deviceD[device]['pubtopic2'] = f"{MQTT_SUB_LVL1}/nredZCMD/resetstepgauge"
     deviceD[device]['data2'] = "resetstepgauge"
-    adcSet[device] = mcp3008(2, 5, 400, 1, 8, adc_logger) # numOfChannels, vref, noiseThreshold (raw ADC), maxInterval = 1sec, and ChipSelect GPIO pin (7 or 8)
+    filters = Pipeline(Median(3), EMA(0.3))  # 10 samples per channel per poll (one SPI transfer) filtered as a batch
+    adcSet[device] = mcp3008(2, 5, 400, 1, 8, adc_logger, trace=trace, scan=True, filters=filters, calibration=calibration, name=device) # numOfChannels, vref, noiseThreshold (raw ADC), maxInterval = 1sec, and ChipSelect GPIO pin (7 or 8). scan reads all channels in one SPI transfer
+
+    device = 'mcp3008spectrum'  # Vibration/ripple features instead of voltages. Blocks of samples are analysed on a background thread
+    lvl2 = 'mcp3008'
+    publvl3 = MQTT_CLIENT_ID + "Spectrum"
+    data_keys = ['a0rmsf', 'a0peakf', 'a0hz0f', 'a0hz1f', 'a0band0f', 'a0band1f', 'a0band2f', 'sampleratef']
+    setup_device(device, lvl2, publvl3, data_keys)
+    adcSet[device] = mcp3008(1, 5, 400, 1, 7, adc_logger, capture=dict(blocksize=1024, samplerate=2000, bands=[(0, 40), (40, 60), (60, 1000)], peaks=2)) # Second MCP3008 on CE1 (GPIO7), 'mcp3008' scans the chip on CE0. features of 1024 samples at 2kHz. bands in Hz
+
+    device = 'ads1115adaptive'  # Slowly changing channels. Stable channels are read less often with fewer samples
+    lvl2 = 'ads1115'
+    publvl3 = MQTT_CLIENT_ID + "Adaptive"
+    data_keys = ['a0f', 'a1f', 'a0ratef', 'a0samplesi', 'a1ratef', 'a1samplesi']
+    setup_device(device, lvl2, publvl3, data_keys)
+    adcSet[device] = ads1115(2, 0.003, 1, 1, 0x49, adc_logger, adaptive=dict(maxperiod=2.0, stablepolls=5), calibration=calibration, name=device) # A change is seen within maxperiod (s) on an idle channel
+    if calibrate:
+        for adc in adcSet.values():
+            adc.calibrate(samples=2000, rate=0.01)  # Noise alone publishes on about 1% of the polls
 
     #Joystick button setup
     buttonpressed = False
@@ -368,15 +415,25 @@ def main():
     device = 'stepper'
     lvl2 = 'stepper'
     publvl3 = MQTT_CLIENT_ID + ""
-    data_keys = ['delayf', 'cpufreq0i', 'main_msf', 'looptime0f', 'looptime1f', 'steps0i', 'steps1i', 'rpm0f', 'rpm1f', 'speed0i', 'speed1i']
+    data_keys = ['delayf', 'cpufreq0i', 'cputempf', 'throttledi', 'load1f', 'schedlatemsf', 'looptime0f', 'looptime1f', 'latemeanf', 'jitterf', 'latemaxf', 'steps0i', 'steps1i', 'rpm0f', 'rpm1f', 'speed0i', 'speed1i']
     m1pins = [12, 16, 20, 21]
     m2pins = [19, 13, 6, 5]
     mqtt_stepreset = False   # used to reset steps thru nodered gui
     mqtt_controlsD = {"delay":[0.8,1.0], "speed":[3,3], "mode":[0,0], "inverse":[False,True], "step":[2038, 2038], "startstep":[0,0]}
-    setup_device(device, lvl2, publvl3, data_keys)
+    deadbands = {'cpufreq0i': 100, 'cputempf': 1.0, 'load1f': 0.2, 'schedlatemsf': 5.0, 'looptime0f': 0.2, 'looptime1f': 0.2, 'latemeanf': 0.05, 'jitterf': 0.05, 'latemaxf': 0.5, 'rpm0f': 0.1, 'rpm1f': 0.1}  # Timing/health telemetry alone should not publish
+    setup_device(device, lvl2, publvl3, data_keys, deadbands, heartbeat=10, delta=dict(keyframe=20, keyframeinterval=30)) # Delta payloads with a full keyframe every 20 publishes or 30 sec
     deviceD[device]['pubtopic2'] = f"{MQTT_SUB_LVL1}/nredZCMD/resetstepgauge" # Extra topic used to tell node red to reset the step gauges
     deviceD[device]['data2'] = "resetstepgauge"
-    motor = Stepper(m1pins, m2pins, logger=logger_stepper)  # can enter 1 to 2 list of pins (up to 2 motors)
+    systelemetry = SysTelemetry.shared() # cpu freq, temperature, throttling and load. Sampled on its own interval
+    motor = Stepper(m1pins, m2pins, logger=logger_stepper, timing='deadline', trace=trace)  # timing='deadline' keeps step period steady under load. 'sleep' pauses delay after each step
+    deviceD[device]['pubtopic3'] = f"{MQTT_SUB_LVL1}/nredZCMD/refillsegments" # Extra topic used to ask node red for more step segments
+    eventloop = None   # asyncio loop of mainloop(). Set once it runs
+    def refill_request(free):
+        ''' Low water callback. Runs on the stepper runner thread, so the publish is queued to the main loop with the other mqtt calls '''
+        if eventloop is not None and not eventloop.is_closed():
+            eventloop.call_soon_threadsafe(mqtt_client.publish, deviceD['stepper']['pubtopic3'], json.dumps(free))
+    motor_stream = SegmentBuffer(2, capacity=256, lowwater=64, lowwatercallback=refill_request, logger=logger_stepper)
+    motor_runner = StepperRunner(motor, mqtt_controlsD, telemetryinterval=msginterval, stream=motor_stream, logger=logger_stepper) # Steps on its own thread so device reads do not stall the motors
 
     main_logger.info("ALL DICTIONARIES")
     for device, item in deviceD.items():
@@ -401,73 +458,93 @@ def main():
     mqtt_client.on_disconnect = on_disconnect # Bind on disconnect
     mqtt_client.on_message = on_message       # Bind on message
     mqtt_client.on_publish = on_publish       # Bind on publish
-    main_logger.info("Connecting to: {0}".format(MQTT_SERVER))
-    mqtt_client.connect(MQTT_SERVER, 1883)    # Connect to mqtt broker. This is a blocking function. Script will stop while connecting.
-    mqtt_client.loop_start()                  # Start monitoring loop as asynchronous. Starts a new thread and will process incoming/outgoing messages.
-    # Monitor if we're in process of connecting or if the connection failed
-    while not mqtt_client.connected and not mqtt_client.failed_connection:
-        main_logger.info("Waiting")
-        sleep(1)
-    if mqtt_client.failed_connection:         # If connection failed then stop the loop and main program. Use the rc code to trouble shoot
-        mqtt_client.loop_stop()
-        sys.exit(f"{pcolor.RED}Connection failed. Check rc code to trouble shoot{pcolor.ENDC}")
-    
+    scheduler = DeviceScheduler(workers=4, logger=main_logger)  # Blocking driver reads run on its worker threads
+    poller = BusPoller(deadline=0.08, logger=main_logger)      # ina219/adc reads grouped by bus. Buses are read in parallel
+    for device, ina219 in ina219Set.items():
+        poller.add(device, ina219.getdata, 'i2c1', every=1 if ina219.reader is not None else 5)   # Non-blocking reads are one short transfer, poll every cycle. Blocking at 2Hz
+    for device, adc in adcSet.items():
+        poller.add(device, adc.getdata, 'spi0' if isinstance(adc, mcp3008) else 'i2c1')   # adc drivers only return data on a change or maxInterval
+
+    def adc_publish(device, payload, pressed):
+        ''' ADC readings with the joystick button. A button press publishes the latest readings even if they did not change '''
+        if payload is not None:
+            payload['buttoni'] = buttonvalue   # For joystick with button
+        publish(device, payload, force=pressed)
+
+    def sensors_publish(name, cycle):
+        global buttonpressed
+        results, stale = cycle   # Stale devices missed the cycle deadline. Logged by the poller, their late result comes with a later cycle
+        pressed, buttonpressed = buttonpressed, False
+        for device, payload in results.items():
+            if device not in adcSet:
+                publish(device, payload)
+        for device in adcSet:
+            if device in results or pressed:
+                adc_publish(device, results.get(device), pressed)
+
+    def stepper_read():
+        ''' Latest motor.getdata() from the runner thread. Also handles step resets from node red '''
+        global mqtt_stepreset
+        if mqtt_stepreset:
+            motor_runner.resetsteps()
+            mqtt_stepreset = False
+            mqtt_client.publish(deviceD['stepper']['pubtopic2'], json.dumps(deviceD['stepper']['data2']))
+        snapshot = motor_runner.snapshot()
+        if not snapshot:   # The runner has not taken its first getdata() yet
+            return None
+        deviceD['stepper']['data'] = dict(snapshot)   # The runner's copy stays as it sent it
+        deviceD['stepper']['data']["schedlatemsf"] = 1000 * max(late for reads, overruns, late, busy in scheduler.stats().values())  # Worst scheduler lateness (ms) since the last read. Replaces main_msf (main loop time), which no longer exists
+        systelemetry.merge(deviceD['stepper']['data'], ('cputempf', 'throttledi', 'load1f'))  # Pi health from cached sysfs/procfs reads
+        return deviceD['stepper']['data']
+
+    motor_controls = mqtt_controlsD
+    def controls():
+        ''' Motor controls and servo angles from mqtt. Could change this to another source '''
+        nonlocal motor_controls
+        if mqtt_controlsD is not motor_controls:
+            motor_controls = mqtt_controlsD
+            motor_runner.command(motor_controls)  # Pass instructions to the stepper runner thread
+        servoID = mqtt_servoID
+        if deviceD['servoAngle'][servoID] != mqtt_servoAngle:
+            deviceD['servoAngle'][servoID] = mqtt_servoAngle
+            pca9685[servoID].servo(deviceD['servoAngle'][servoID]) # Set the servo angle
+
+    async def mainloop():
+        nonlocal eventloop
+        eventloop = asyncio.get_running_loop()
+        AsyncMQTT(eventloop, mqtt_client)  # mqtt runs on this loop with the device reads (no loop_start thread)
+        main_logger.info("Connecting to: {0}".format(MQTT_SERVER))
+        mqtt_client.connect(MQTT_SERVER, 1883)    # Connect to mqtt broker. This is a blocking function. Script will stop while connecting.
+        # Monitor if we're in process of connecting or if the connection failed
+        while not mqtt_client.connected and not mqtt_client.failed_connection:
+            main_logger.info("Waiting")
+            await asyncio.sleep(1)
+        if mqtt_client.failed_connection:         # If connection failed then stop the main program. Use the rc code to trouble shoot
+            sys.exit(f"{pcolor.RED}Connection failed. Check rc code to trouble shoot{pcolor.ENDC}")
+        # MQTT setup is successful. Each device is read on its own period, higher priority first when due together
+        for device, rotenc in rotaryEncoderSet.items():
+            scheduler.add(device, rotenc.getdata, 0.02, priority=3, blocking=False, publish=publish)  # Counts accumulate in GPIO edge callbacks, getdata only copies them
+        scheduler.add('controls', controls, 0.01, priority=2, blocking=False)
+        scheduler.add('sensors', poller.poll, 0.1, priority=1, publish=sensors_publish)   # One poll cycle of the i2c and spi buses
+        scheduler.add('stepper', stepper_read, msginterval, blocking=False, publish=publish)
+        motor_runner.start()
+        await scheduler.run()
+
     #==== MAIN LOOP ====================#
-    # MQTT setup is successful. Initialize dictionaries and start the main loop.   
-    t0_sec = perf_counter() # sec Counter for getting stepper data. Future feature - update interval in  node-red dashboard to link to perf_counter
-    msginterval = 0.5       # Adjust interval to increase/decrease number of mqtt updates.
-    t0loop_ns = perf_counter_ns() # nanosec Counter for how long it takes to run motor and get messages
-    outgoingD = {}
     try:
-        while True:
-
-            t0main_ns = perf_counter_ns() - t0loop_ns  # Monitor how long the main/total loop takes
-            t0loop_ns = perf_counter_ns()
-
-            if (perf_counter() - t0_sec) > msginterval: # getdata() from devices on msginterval (also publish data). Note - Does not affect on_message/mqtt data. on_message runs in parallel
-                for device, ina219 in ina219Set.items():
-                    deviceD[device]['data'] = ina219.getdata()
-                    main_logger.debug("{} {}".format(deviceD[device]['pubtopic'], json.dumps(deviceD[device]['data'])))
-                    #mqtt_client.publish(deviceD[device]['pubtopic'], json.dumps(deviceD[device]['data']))  # publish voltage values
-                for device, adc in adcSet.items():
-                    deviceD[device]['data'] = adc.getdata() # Get the readings from each adc
-                    if deviceD[device]['data'] is not None:
-                        main_logger.debug("{} {}".format(deviceD[device]['pubtopic'], json.dumps(deviceD[device]['data'])))
-                        #mqtt_client.publish(deviceD[device]['pubtopic'], json.dumps(deviceD[device]['data']))
-                    # For joystick with button
-                    if buttonpressed or deviceD[device]['data'] is not None:
-                        if deviceD[device]['data'] is not None:
-                            outgoingD = deviceD[device]['data']
-                        outgoingD['buttoni'] = buttonvalue
-                        #mqtt_client.publish(deviceD[device]['pubtopic'], json.dumps(outgoingD))       # publish voltage values
-                        buttonpressed = False
-                        main_logger.debug(outgoingD)
-                    deviceD['stepper']['data'] = motor.getdata()
-                    if deviceD['stepper']['data'] != "na":
-                        deviceD['stepper']['data']["main_msf"] = t0main_ns/1000000  # Monitor the main/total loop time
-                        mqtt_client.publish(deviceD['stepper']['pubtopic'], json.dumps(deviceD['stepper']['data'])) 
-                    if mqtt_stepreset:
-                        motor.resetsteps()
-                        mqtt_stepreset = False
-                        mqtt_client.publish(deviceD['stepper']['pubtopic2'], json.dumps(deviceD['stepper']['data2']))
-                t0_sec = perf_counter()
-                for device, rotenc in rotaryEncoderSet.items(): # ** Remove rotary encoder from msginterval loop for real application
-                    deviceD[device]['data'] = rotenc.getdata()
-                    if deviceD[device]['data'] is not None:
-                        main_logger.debug("{} {}".format(deviceD[device]['pubtopic'], json.dumps(deviceD[device]['data'])))
-                        #mqtt_client.publish(deviceD[device]['pubtopic'], json.dumps(deviceD[device]['data']))
-
-            motor_controls = mqtt_controlsD  # Get updated motor controls from mqtt. Could change this to another source
-            motor.step(motor_controls) # Pass instructions for stepper motor for testing
-
-            servoID = mqtt_servoID                                      # Servo commands coming from mqtt
-            deviceD['servoAngle'][servoID] = mqtt_servoAngle            # But could change data source to something other than mqtt
-            pca9685[servoID].servo(deviceD['servoAngle'][mqtt_servoID]) # Set the servo angle
-
-            #sleep(1)
+        asyncio.run(mainloop())
     except KeyboardInterrupt:
         main_logger.info(f"{pcolor.WARNING}Exit with ctrl-C{pcolor.ENDC}")
     finally:
+        scheduler.stop()
+        poller.close()
+        motor_runner.stop()
+        systelemetry.close()
+        for adc in adcSet.values():
+            adc.close()
+        main_logger.info("I2C transactions and bus time (s) per address: {0}".format(I2CManager.shared().stats()))
+        if main_logger.getEffectiveLevel() == logging.DEBUG:
+            trace.dump(main_logger)
         #GPIO.cleanup()
         main_logger.info(f"{pcolor.CYAN}GPIO cleaned up{pcolor.ENDC}")
 
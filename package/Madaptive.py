@@ -0,0 +1,90 @@
+'''
+Adaptive sampling for polled analog channels. Each channel has its own sample count (readings
+per poll) and poll period. While a channel is stable both back off, and as soon as a change
+passes the noise threshold the channel goes straight back to the full sample count at the
+fastest period.
+
+ stable for stablepolls polls  - samples halve (down to minsamples), period doubles (up to maxperiod)
+ abs(delta) > noiseThreshold   - samples = maxsamples, period = minperiod
+
+maxperiod is the latency budget: a change on an idle channel is seen within maxperiod seconds.
+sample() reads a channel into its sliding window. A poll with fewer samples than the window only
+moves the window mean a little, so when the new samples alone look like a change from the last
+published value a full window of new samples is read at once to confirm it.
+A device getdata() that is called more often than a channel's period skips that channel and
+keeps its last value, so the bus time goes to the channels that are changing.
+
+Payload keys per channel n (added by report())
+ a<n>ratef     - Current polls per second
+ a<n>samplesi  - Current samples per poll
+
+ adc = ads1115(2, 0.003, 1, 1, 0x48, adaptive=dict(maxperiod=2.0, stablepolls=5))
+
+'''
+
+from time import time
+
+class AdaptiveRate:
+    ''' Per channel samples per poll and poll period '''
+
+    def __init__(self, numOfChannels, noiseThreshold, minsamples=1, maxsamples=10, minperiod=0.1, maxperiod=2.0, stablepolls=5):
+        self.numOfChannels = numOfChannels
+        self.noiseThreshold = noiseThreshold if isinstance(noiseThreshold, (list, tuple)) else [noiseThreshold] * numOfChannels   # Per channel
+        self.minsamples = minsamples
+        self.maxsamples = maxsamples
+        self.minperiod = minperiod
+        self.maxperiod = maxperiod   # Latency budget (s)
+        self.stablepolls = stablepolls
+        self.samples = [maxsamples] * numOfChannels
+        self.period = [minperiod] * numOfChannels
+        self.stable = [0] * numOfChannels       # Polls since the last change
+        self.nextpoll = [0.0] * numOfChannels   # time() the channel is due
+
+    def due(self, x, now=None):
+        return (time() if now is None else now) >= self.nextpoll[x]
+
+    def sample(self, x, read, window, reference):
+        ''' Push samples[x] readings of read() into window (Mwindow.RunningStats) and return its mean.
+        If their mean is more than the noise threshold from reference, a full window of new readings is pushed '''
+        values = [read() for i in range(self.samples[x])]
+        for value in values:
+            mean = window.push(value)
+        if len(values) < window.size and abs(sum(values) / len(values) - reference) > self.noiseThreshold[x]:
+            for i in range(window.size):
+                mean = window.push(read())
+        return mean
+
+    def update(self, x, delta, now=None):
+        ''' Record the change seen on channel x and schedule its next poll '''
+        now = time() if now is None else now
+        if abs(delta) > self.noiseThreshold[x]:
+            self.samples[x] = self.maxsamples
+            self.period[x] = self.minperiod
+            self.stable[x] = 0
+        else:
+            self.stable[x] += 1
+            if self.stable[x] >= self.stablepolls:
+                self.samples[x] = max(self.minsamples, self.samples[x] // 2)
+                self.period[x] = min(self.maxperiod, self.period[x] * 2)
+                self.stable[x] = 0
+        self.nextpoll[x] = now + self.period[x]
+
+    def report(self, outgoing):
+        for x in range(self.numOfChannels):
+            outgoing['a' + str(x) + 'ratef'] = 1 / self.period[x]
+            outgoing['a' + str(x) + 'samplesi'] = self.samples[x]
+        return outgoing
+
+if __name__ == "__main__":
+    rate = AdaptiveRate(2, 0.01, maxperiod=1.6, stablepolls=2)
+    last = [0.0, 0.0]
+    now = 0.0
+    for poll in range(60):
+        signal = [0.0, 0.5 if poll >= 30 else 0.0]   # Step on channel 1 at 3s
+        for x in range(2):
+            if rate.due(x, now):
+                rate.update(x, signal[x] - last[x], now)
+                last[x] = signal[x]
+        if poll % 5 == 0:
+            print(round(now, 1), rate.report({}))
+        now += 0.1
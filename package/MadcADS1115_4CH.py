@@ -6,7 +6,8 @@ When creating object, pass: Number of channels, noise threshold, max time interv
 Will return a list with the voltage value for each channel
 
 Number of channels (1-4)
-To find the noise threshold set noise threshold low. Noise is in Volts
+To find the noise threshold set noise threshold low, or run calibrate() with the inputs idle. Noise is in Volts
+The noise threshold can be one value or a list with one per channel.
 Max time interval is used to catch drift/creep that is below the noise threshold.
 Gain options. Set the gain to capture the voltage range being measured.
  User         FS (V)
@@ -27,17 +28,60 @@ Change the address by connecting the ADDR pin to one of the following
 0x4B (1001011) ADR -> SCL
 Then update the address when creating the ads object in the HARDWARE section
 
+The chip is read through the process wide shared I2C bus (see Mi2cbus), so it queues fairly with the
+other I2C devices. Pass i2cbus to use another Mi2cbus.I2CBus.
+
+continuous=True runs the chip in continuous conversion mode at datarate (samples/s) and reads it on a
+background thread (see Mads1115stream). getdata() then averages the buffered samples without any I2C
+traffic. Wire ALERT/RDY to a GPIO and pass it as rdypin to read on conversion ready instead of timed reads.
+ adc = ads1115(2, 0.003, 1, 1, 0x48, continuous=True, datarate=860, rdypin=None)
+
+capture=dict(blocksize=1024, bands=[(0, 50), (50, 200)], peaks=3) switches getdata() to spectral features
+of blocks of continuous samples (see Mspectral). The sample rate is the data rate. Use one channel.
+
+filters=Mfilter.Pipeline(...) replaces the window average with a filter pipeline. In continuous mode every
+sample buffered since the last getdata() goes through the filters as one batch.
+ adc = ads1115(1, 0.003, 1, 1, 0x48, continuous=True, filters=Pipeline(Median(5), LowPass(5, 860)))
+
+adaptive=dict(minsamples=1, maxperiod=2.0, stablepolls=5) lowers the samples per poll and the poll rate of
+stable channels and restores them when a channel changes (see Madaptive). Rates are added to the payload.
+
+Changes are measured from the averages last returned by getdata(), so a slow drift or a small step
+adds up until it passes the noise threshold.
+
+calibrate(samples=2000, rate=0.01) measures the noise with the inputs idle and sets per channel thresholds
+that noise alone exceeds on 1% of the polls (see Mcalibrate). With calibration=NoiseCalibration('noise.json')
+they are saved under <name>_ads1115_<address> (ads1115_<address> without name=) and used instead of noiseThreshold on the next start.
+ adc = ads1115(2, 0.003, 1, 1, 0x48, calibration=NoiseCalibration('noise.json'), name='joystick')
+
 '''
 
-import busio, board, logging
+import logging
+import numpy as np
 from time import time, sleep
 import adafruit_ads1x15.ads1115 as ADS
 from adafruit_ads1x15.analog_in import AnalogIn
+try:
+    from .Mtrace import TraceBuffer
+    from .Mads1115stream import ADS1115Stream
+    from .Mspectral import SpectralCapture
+    from .Mwindow import RunningStats
+    from .Madaptive import AdaptiveRate
+    from .Mcalibrate import noise_thresholds
+    from .Mi2cbus import I2CManager
+except ImportError:
+    from Mtrace import TraceBuffer
+    from Mads1115stream import ADS1115Stream
+    from Mspectral import SpectralCapture
+    from Mwindow import RunningStats
+    from Madaptive import AdaptiveRate
+    from Mcalibrate import noise_thresholds
+    from Mi2cbus import I2CManager
 
 class ads1115:
     ''' ADC using ADS1115 (I2C). Returns a list with voltge values '''
     
-    def __init__(self, numOfChannels=1, noiseThreshold=0.001, maxInterval=1, usergain=1, useraddress=0x48, logger=None):
+    def __init__(self, numOfChannels=1, noiseThreshold=0.001, maxInterval=1, usergain=1, useraddress=0x48, logger=None, trace=None, continuous=False, datarate=860, rdypin=None, capture=None, filters=None, adaptive=None, calibration=None, i2cbus=None, name=None):
         ''' Create I2C bus and initialize lists '''
         
         if logger is not None:                        # Use logger passed as argument
@@ -48,55 +92,159 @@ class ads1115:
         else:                                          # Root logger already exists and no custom logger passed
             self.logger = logging.getLogger(__name__)    # Create from root logger
         self.logger.info("ADS1115 using I2C at address {0}".format(str(useraddress)))
-        i2c = busio.I2C(board.SCL, board.SDA)  # Create the I2C bus
-        ads = ADS.ADS1115(i2c, gain=usergain, address=useraddress)   # Create the ADC object using the I2C bus
+        i2c = i2cbus if i2cbus is not None else I2CManager.shared().bus(1)  # Shared I2C bus
         self.numOfChannels = numOfChannels
-        self.chan = [AnalogIn(ads, ADS.P0), # create analog input channel on pins
-                     AnalogIn(ads, ADS.P1),
-                     AnalogIn(ads, ADS.P2),
-                     AnalogIn(ads, ADS.P3)]
-        self.noiseThreshold = noiseThreshold
-        self.numOfSamples = 10        # Number of samples to average
+        self.stream = None
+        self.capture = None
+        if continuous or capture is not None:   # Chip converts continuously and a background thread buffers the samples
+            blocksize = capture.get('blocksize', 1024) if capture is not None else 0
+            self.stream = ADS1115Stream(i2c, useraddress, usergain, datarate, range(numOfChannels), capacity=max(64, 2 * blocksize), rdypin=rdypin, logger=self.logger)
+            self.stream.start()
+            if not self.stream.wait():   # No conversion within a second. Capture needs the stream, polled reads do not
+                self.stream.stop()
+                self.stream = None
+                if capture is not None:
+                    raise OSError("ADS1115 at {0} returned no conversions in continuous mode".format(hex(useraddress)))
+                self.logger.error("ADS1115 at {0} returned no conversions in continuous mode. Using polled reads".format(hex(useraddress)))
+        if capture is not None:   # getdata() returns spectral features of sample blocks
+            if numOfChannels > 1:
+                self.logger.warning("ADS1115 capture with {0} channels. Mux rotation does not sample evenly, use one channel".format(numOfChannels))
+            options = dict(capture)
+            blocksize, samplerate = options.pop('blocksize', 1024), options.pop('samplerate', None)
+            if samplerate is not None and samplerate != self.stream.samplerate:
+                self.logger.warning("ADS1115 capture samples at the data rate ({0:.1f} Hz). samplerate {1} ignored".format(self.stream.samplerate, samplerate))
+            self.capture = SpectralCapture(self.stream.capture, numOfChannels, blocksize, self.stream.samplerate, logger=self.logger, **options)
+            self.capture.start()
+        else:
+            ads = ADS.ADS1115(i2c, gain=usergain, address=useraddress)   # Create the ADC object using the I2C bus
+            self.chan = [AnalogIn(ads, ADS.P0), # create analog input channel on pins
+                         AnalogIn(ads, ADS.P1),
+                         AnalogIn(ads, ADS.P2),
+                         AnalogIn(ads, ADS.P3)]
+        self.name = ('' if name is None else name + '_') + 'ads1115_' + hex(useraddress)   # Calibration key. name tells apart devices that share a chip
+        self.calibration = calibration   # Optional Mcalibrate.NoiseCalibration. Saved thresholds replace noiseThreshold
+        saved = calibration.load(self.name, numOfChannels) if calibration is not None else None
+        if saved is not None:
+            self.logger.info("ADS1115 using calibrated noise thresholds {0}".format(saved))
+            noiseThreshold = saved
+        self.noiseThreshold = list(noiseThreshold) if isinstance(noiseThreshold, (list, tuple)) else [noiseThreshold] * numOfChannels   # Per channel
+        self.numOfSamples = 10        # Number of samples to average (sliding window, one new sample per getdata)
         self.maxInterval = maxInterval  # interval in seconds to check for update
         self.time0 = time()
         # Initialize lists
         self.sensorAve = [x for x in range(self.numOfChannels)]
-        self.sensorLastRead = [x for x in range(self.numOfChannels)]
+        self.sensorLastRead = [x for x in range(self.numOfChannels)]   # Averages last returned. Changes are measured from them
         self.adcValue = [x for x in range(self.numOfChannels)]
         self.adc = {}  # Dictionary for sending final results
-        self.sensor = [[x for x in range(0, self.numOfSamples)] for x in range(0, self.numOfChannels)]
+        self.window = [RunningStats(self.numOfSamples) for x in range(self.numOfChannels)]
         for x in range(self.numOfChannels): # initialize the first read for comparison later
-            self.sensorLastRead[x] = self.chan[x].value
+            self.sensorLastRead[x] = self.stream.average(x, 1) if self.stream is not None else self.chan[x].voltage
+            self.window[x].fill(self.sensorLastRead[x])
+        self.sensorAve = list(self.sensorLastRead)
+        self.filters = filters   # Optional Mfilter.Pipeline for all channels
+        self.taken = [0] * self.numOfChannels   # Stream sample counts already filtered
+        self.adaptive = None   # Optional Madaptive.AdaptiveRate. Polled reads with the sliding window only
+        if adaptive is not None:
+            if self.stream is not None or filters is not None:
+                self.logger.warning("Adaptive sampling only applies to polled reads without filters. Ignored")
+            else:
+                self.adaptive = AdaptiveRate(self.numOfChannels, self.noiseThreshold, **dict({'maxsamples': self.numOfSamples}, **adaptive))
         self.sensorChanged = False
         self.timelimit = False
+        self.trace = trace   # Optional Mtrace.TraceBuffer for per channel reads
+        if self.trace is not None:
+            self.EV_READ = self.trace.register("ads1115 changed: {1} chan: {0} value: {4:1.3f} previously: {5:1.3f}")
 
     def getdata(self):
         ''' If adc is above noise threshold or time limit exceeded will return voltage of each channel '''
         
+        if self.capture is not None:   # Capture mode. Features of the latest block (None until a new block is analysed)
+            return self.capture.getdata()
         if time() - self.time0 > self.maxInterval:
             self.timelimit = True
+        if self.filters is not None:   # Filter new samples as one batch
+            if self.stream is not None:
+                rows, self.taken = self.stream.take(self.taken)
+                self.filters.process(rows)
+            else:
+                self.filters.update([self.chan[x].voltage for x in range(self.numOfChannels)])
+        now = time()
         for x in range(self.numOfChannels):
-            for i in range(self.numOfSamples):  # get samples points from analog pin and average
-                self.sensor[x][i] = self.chan[x].voltage
-            self.sensorAve[x] = sum(self.sensor[x])/len(self.sensor[x])
-            if abs(self.sensorAve[x] - self.sensorLastRead[x]) > self.noiseThreshold:
+            if self.adaptive is not None and not self.adaptive.due(x, now):
+                continue   # Stable channel, not due yet. Keeps its last value
+            if self.filters is not None:
+                self.sensorAve[x] = float(self.filters.last[x]) if self.filters.last is not None else self.sensorLastRead[x]
+            elif self.stream is not None:   # Already sampled on the stream thread
+                self.sensorAve[x] = self.stream.average(x, self.numOfSamples)
+            else:                         # One new sample (adaptive: samples for this channel) into the sliding window
+                if self.adaptive is not None:   # Confirms a possible change with a full window of samples
+                    self.sensorAve[x] = self.adaptive.sample(x, lambda: self.chan[x].voltage, self.window[x], self.sensorLastRead[x])
+                else:
+                    self.sensorAve[x] = self.window[x].push(self.chan[x].voltage)
+            if abs(self.sensorAve[x] - self.sensorLastRead[x]) > self.noiseThreshold[x]:
                 self.sensorChanged = True
-            self.logger.debug('changed: {0} chan: {1} value: {2:1.3f} previously: {3:1.3f}'.format(self.sensorChanged, x, self.sensorAve[x], self.sensorLastRead[x]))
-            self.adc['a' + str(x) + 'f'] = self.sensorAve[x]            
-            self.sensorLastRead[x] = self.sensorAve[x]
+            if self.adaptive is not None:
+                self.adaptive.update(x, self.sensorAve[x] - self.sensorLastRead[x], now)
+            if self.trace is not None: self.trace.record(self.EV_READ, x, self.sensorChanged, 0, 0, self.sensorAve[x], self.sensorLastRead[x])
+            self.adc['a' + str(x) + 'f'] = self.sensorAve[x]
+        if self.adaptive is not None:
+            self.adaptive.report(self.adc)
         if self.sensorChanged or self.timelimit:
+            self.sensorLastRead = list(self.sensorAve)   # Reference for the next change
             self.time0 = time()
             self.sensorChanged = False
             self.timelimit = False
             return self.adc
+
+    def _block(self, samples):
+        ''' samples readings of every channel as a (samples, channels) array in volts '''
+        block = np.zeros((samples, self.numOfChannels))
+        if self.stream is not None:   # Collect from the stream buffer before it wraps
+            since, n = [self.stream.counts[channel] for channel in self.stream.channels], 0
+            while n < samples:
+                sleep(self.stream.capacity * self.stream.period / 4)
+                rows, since = self.stream.take(since)
+                rows = rows[:samples - n]
+                block[n:n + len(rows)] = rows
+                n += len(rows)
+        else:
+            for n in range(samples):
+                block[n] = [self.chan[x].voltage for x in range(self.numOfChannels)]
+        return block
+
+    def calibrate(self, samples=2000, rate=0.01, apply=True):
+        ''' Measure the noise with the inputs idle. Returns per channel thresholds that noise exceeds on rate of the polls (see Mcalibrate).
+        apply=True uses them and saves them to calibration '''
+        if self.capture is not None:
+            self.logger.warning("Capture mode has no noise threshold to calibrate")
+            return None
+        step = self.numOfSamples if self.stream is not None else 1   # New samples per poll
+        thresholds = noise_thresholds(self._block(samples), rate, self.numOfSamples, step, self.filters)
+        self.logger.info("ADS1115 {0} noise thresholds (V) at {1} false triggers per poll: {2}".format(self.name, rate, [round(t, 6) for t in thresholds]))
+        if apply:
+            self.noiseThreshold = thresholds
+            if self.adaptive is not None:
+                self.adaptive.noiseThreshold = thresholds
+            if self.calibration is not None:
+                self.calibration.save(self.name, thresholds, rate=rate, samples=samples)
+        return thresholds
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.stop()
+        if self.stream is not None:
+            self.stream.stop()
       
 if __name__ == "__main__":
     
     logging.basicConfig(level=logging.DEBUG)
     logger_ads1115 = logging.getLogger('ads1115')
     logger_ads1115.setLevel(logging.INFO)
-    adc = ads1115(1, 0.001, 1, 1, 0x48, logger=logger_ads1115) # numOfChannels, noiseThreshold, max time interval, Gain, Address
+    trace = TraceBuffer(1024)
+    adc = ads1115(1, 0.001, 1, 1, 0x48, logger=logger_ads1115, trace=trace) # numOfChannels, noiseThreshold, max time interval, Gain, Address
+    traceindex = 0
     while True:
         voltage = adc.getdata() # returns a list with the voltage for each pin that was passed in ads1115
         if voltage is not None: logging.debug(voltage)
+        traceindex = trace.dump(logger_ads1115, traceindex)
         sleep(.05)
@@ -8,11 +8,32 @@ MCP3008 adc has 8 channels.  If any channel has a delta (current-previous) that
  Vref (3.3 or 5V) ** Important on RPi. If using 5V must use a voltage divider on MISO
  R2=R1(1/(Vin/Vout-1)) Vin=5V, Vout=3.3V, R1=2.4kohm
  R2=4.7kohm
- Noise threshold is in raw ADC - To find the noise threshold set initial threshold low and monitor
+ Noise threshold is in raw ADC - To find the noise threshold set initial threshold low and monitor, or run calibrate()
+ with the inputs idle. The noise threshold can be one value or a list with one per channel.
  Max time interval is used to catch drift/creep that is below the noise threshold.
  CS (chip select) - Uses SPI0 with GPIO 8 (CE0) or GPIO 7 (CE1)
 
  Requires 4 lines. SCLK, MOSI, MISO, CS
+ scan=True reads every channel in one SPI transaction per chip through spidev (see
+ Mmcp3008scan) instead of one adafruit AnalogIn read per sample. With scan=True, numOfChannels can be
+ up to 16: channels 0-7 on CE0 (cs=8) and 8-15 on a second MCP3008 on CE1.
+  adc = mcp3008(16, 3.3, 400, 1, 8, scan=True)
+
+ capture=dict(blocksize=1024, samplerate=4000, bands=[(0, 50), (50, 200)], peaks=3) switches getdata() to
+ spectral features (volts) of blocks captured at samplerate per channel (see Mspectral). Uses the scan engine.
+
+ filters=Mfilter.Pipeline(...) replaces the window average with a filter pipeline (raw ADC units). With scan=True
+ each getdata() reads 10 samples of every channel in one transfer and filters them as one batch.
+  adc = mcp3008(2, 3.3, 400, 1, 8, scan=True, filters=Pipeline(Median(3), EMA(0.3)))
+
+ adaptive=dict(minsamples=1, maxperiod=2.0, stablepolls=5) lowers the samples per poll and the poll rate of
+ stable channels and restores them when a channel changes (see Madaptive). Per channel reads only (scan=False).
+
+ calibrate(samples=2000, rate=0.01) measures the noise with the inputs idle and sets per channel thresholds
+ that noise alone exceeds on 1% of the polls (see Mcalibrate). With calibration=NoiseCalibration('noise.json')
+ they are saved under <name>_mcp3008_cs<cs> (mcp3008_cs<cs> without name=) and used instead of noiseThreshold on the next start.
+  adc = mcp3008(2, 3.3, 400, 1, 8, calibration=NoiseCalibration('noise.json'), name='joystick')
+
  You can enable SPI1 with a dtoverlay configured in "/boot/config.txt"
  dtoverlay=spi1-3cs
  SPI1 SCLK = GPIO 21
@@ -22,15 +43,30 @@ MCP3008 adc has 8 channels.  If any channel has a delta (current-previous) that
 
 '''
 import busio, digitalio, board, logging
+import numpy as np
 import adafruit_mcp3xxx.mcp3008 as MCP
 from adafruit_mcp3xxx.analog_in import AnalogIn
 from time import time, sleep
 import sys
+try:
+    from .Mtrace import TraceBuffer
+    from .Mmcp3008scan import MCP3008Scan, SpidevBus
+    from .Mspectral import SpectralCapture
+    from .Mwindow import RunningStats
+    from .Madaptive import AdaptiveRate
+    from .Mcalibrate import noise_thresholds
+except ImportError:
+    from Mtrace import TraceBuffer
+    from Mmcp3008scan import MCP3008Scan, SpidevBus
+    from Mspectral import SpectralCapture
+    from Mwindow import RunningStats
+    from Madaptive import AdaptiveRate
+    from Mcalibrate import noise_thresholds
 
 class mcp3008:
     ''' ADC using MCP3008 (SPI). Returns a list with voltge values '''
 
-    def __init__(self, numOfChannels, vref, noiseThreshold=350, maxInterval=1, cs=8, logger=None):
+    def __init__(self, numOfChannels, vref, noiseThreshold=350, maxInterval=1, cs=8, logger=None, trace=None, scan=False, speed=1350000, capture=None, filters=None, adaptive=None, calibration=None, name=None):
         ''' Create spi connection and initialize lists '''
         
         if logger is not None:                        # Use logger passed as argument
@@ -42,38 +78,75 @@ class mcp3008:
             self.logger = logging.getLogger(__name__)    # Create from root logger
         self.vref = vref
         self.logger.info("MCP3008 using SPI SCLK:GPIO{0} MISO:GPIO{1} MOSI:GPIO{2} CS:GPIO{3}".format(board.SCK, board.MISO, board.MOSI, cs))
-        spi = busio.SPI(clock=board.SCK, MISO=board.MISO, MOSI=board.MOSI) # create the spi bus
-        if cs == 8:
-            cs = digitalio.DigitalInOut(board.D8) # create the cs (chip select). Use GPIO8 (CE0) or GPIO7 (CE1)
-        elif cs == 7:
-            cs = digitalio.DigitalInOut(board.D7) # create the cs (chip select). Use GPIO8 (CE0) or GPIO7 (CE1)
-        else:
+        if cs not in (7, 8):
             self.logger.error("Chip Select pin must be 7 or 8")
             sys.exit()
-        mcp = MCP.MCP3008(spi, cs) # create the mcp object. Can pass Vref as last argument
         self.numOfChannels = numOfChannels
-        self.chan = [AnalogIn(mcp, MCP.P0), # create analog input channel on pins
-                     AnalogIn(mcp, MCP.P1),
-                     AnalogIn(mcp, MCP.P2),
-                     AnalogIn(mcp, MCP.P3),
-                     AnalogIn(mcp, MCP.P4),
-                     AnalogIn(mcp, MCP.P5),
-                     AnalogIn(mcp, MCP.P6),
-                     AnalogIn(mcp, MCP.P7)]
-        self.noiseThreshold = noiseThreshold
-        self.numOfSamples = 10             # Number of samples to average
+        self.name = ('' if name is None else name + '_') + 'mcp3008_cs' + str(cs)   # Calibration key. name tells apart devices that share a chip
+        self.calibration = calibration   # Optional Mcalibrate.NoiseCalibration. Saved thresholds replace noiseThreshold
+        saved = calibration.load(self.name, numOfChannels) if calibration is not None else None
+        if saved is not None:
+            self.logger.info("MCP3008 using calibrated noise thresholds {0}".format(saved))
+            noiseThreshold = saved
+        self.noiseThreshold = list(noiseThreshold) if isinstance(noiseThreshold, (list, tuple)) else [noiseThreshold] * numOfChannels   # Per channel
+        self.numOfSamples = 10             # Number of samples to average (sliding window, one new sample per getdata)
+        self.scanner = None
+        self.capture = None
+        if scan or capture is not None:   # All channels and samples in one spidev transaction per chip
+            spis = [SpidevBus(0, 0 if cs == 8 else 1, speed)]
+            if numOfChannels > 8:
+                if cs != 8:
+                    self.logger.error("Channels 8-15 are the MCP3008 on CE1. Use cs=8 for the first chip")
+                    sys.exit()
+                spis.append(SpidevBus(0, 1, speed))
+            self.scanner = MCP3008Scan(spis, numOfChannels, self.numOfSamples if filters is not None else 1)   # One sample of every channel per getdata, or a batch for the filters
+            if capture is not None:   # getdata() returns spectral features of sample blocks
+                options = dict(capture)
+                blocksize, samplerate = options.pop('blocksize', 1024), options.pop('samplerate', 1000)
+                samplerate = self.scanner.setup_capture(blocksize, samplerate)
+                self.capture = SpectralCapture(self.scanner.capture, numOfChannels, blocksize, samplerate, scale=vref / 65535, logger=self.logger, **options)
+                self.capture.start()
+        else:
+            spi = busio.SPI(clock=board.SCK, MISO=board.MISO, MOSI=board.MOSI) # create the spi bus
+            cs = digitalio.DigitalInOut(board.D8 if cs == 8 else board.D7) # create the cs (chip select). Use GPIO8 (CE0) or GPIO7 (CE1)
+            mcp = MCP.MCP3008(spi, cs) # create the mcp object. Can pass Vref as last argument
+            self.chan = [AnalogIn(mcp, MCP.P0), # create analog input channel on pins
+                         AnalogIn(mcp, MCP.P1),
+                         AnalogIn(mcp, MCP.P2),
+                         AnalogIn(mcp, MCP.P3),
+                         AnalogIn(mcp, MCP.P4),
+                         AnalogIn(mcp, MCP.P5),
+                         AnalogIn(mcp, MCP.P6),
+                         AnalogIn(mcp, MCP.P7)]
         self.maxInterval = maxInterval  # interval in seconds to check for update
         self.time0 = time()   # time 0
         # Initialize lists
         self.sensorAve = [x for x in range(self.numOfChannels)]
-        self.sensorLastRead = [x for x in range(self.numOfChannels)]
+        self.sensorLastRead = [x for x in range(self.numOfChannels)]   # Averages last returned. Changes are measured from them
         self.adcValue = [x for x in range(self.numOfChannels)]
-        self.sensor = [[x for x in range(0, self.numOfSamples)] for x in range(0, self.numOfChannels)]
-        for x in range(self.numOfChannels): # initialize the first read for comparison later
-            self.sensorLastRead[x] = self.chan[x].value
+        self.window = [RunningStats(self.numOfSamples) for x in range(self.numOfChannels)]
+        if self.scanner is not None: # initialize the first read for comparison later
+            self.sensorLastRead = self.scanner.scan()[0].tolist()
+        else:
+            for x in range(self.numOfChannels):
+                self.sensorLastRead[x] = self.chan[x].value
+        for x in range(self.numOfChannels):
+            self.window[x].fill(self.sensorLastRead[x])
+        self.sensorAve = list(self.sensorLastRead)
+        self.filters = filters   # Optional Mfilter.Pipeline for all channels
+        self.adaptive = None   # Optional Madaptive.AdaptiveRate. Polled reads with the sliding window only
+        if adaptive is not None:
+            if self.scanner is not None or filters is not None:
+                self.logger.warning("Adaptive sampling only applies to polled reads without filters. Ignored")
+            else:
+                self.adaptive = AdaptiveRate(self.numOfChannels, self.noiseThreshold, **dict({'maxsamples': self.numOfSamples}, **adaptive))
         self.sensorChanged = False
         self.timelimit = False
         self.adc = {}   # Container for sending final data
+        self.trace = trace   # Optional Mtrace.TraceBuffer for per channel reads
+        if self.trace is not None:
+            self.EV_CHANGED = self.trace.register("mcp3008 changed: {1} chan: {0} value: {4:1.3f} previously: {5:1.3f}")
+            self.EV_READ = self.trace.register("mcp3008 chan: {0} value: {4:1.3f}")
     
     def valmap(self, value, istart, istop, ostart, ostop):
         ''' Used to convert from raw ADC to voltage '''
@@ -83,32 +156,91 @@ class mcp3008:
     def getdata(self):
         ''' If adc is above noise threshold or time limit exceeded will return voltage of each channel '''
         
+        if self.capture is not None:   # Capture mode. Features of the latest block (None until a new block is analysed)
+            return self.capture.getdata()
         if time() - self.time0 > self.maxInterval:
             self.timelimit = True
+        if self.scanner is not None:
+            samples = self.scanner.scan()   # Every channel in one transfer per chip
+        if self.filters is not None:   # Filter the new samples as one batch
+            self.filters.process(samples if self.scanner is not None else [[self.chan[x].value for x in range(self.numOfChannels)]])
+        now = time()
         for x in range(self.numOfChannels):
-            for i in range(self.numOfSamples):  # get samples points from analog pin and average
-                self.sensor[x][i] = self.chan[x].value
-            self.sensorAve[x] = sum(self.sensor[x])/len(self.sensor[x])
-            if abs(self.sensorAve[x] - self.sensorLastRead[x]) > self.noiseThreshold:
+            if self.adaptive is not None and not self.adaptive.due(x, now):
+                continue   # Stable channel, not due yet. Keeps its last value
+            if self.filters is not None:
+                self.sensorAve[x] = float(self.filters.last[x]) if self.filters.last is not None else self.sensorLastRead[x]
+            elif self.scanner is not None:   # One new sample into each sliding window
+                self.sensorAve[x] = self.window[x].push(samples[0, x])
+            else:
+                if self.adaptive is not None:   # Confirms a possible change with a full window of samples
+                    self.sensorAve[x] = self.adaptive.sample(x, lambda: self.chan[x].value, self.window[x], self.sensorLastRead[x])
+                else:
+                    self.sensorAve[x] = self.window[x].push(self.chan[x].value)
+            if abs(self.sensorAve[x] - self.sensorLastRead[x]) > self.noiseThreshold[x]:
                 self.sensorChanged = True
-                self.logger.debug('changed: {0} chan: {1} value: {2:1.3f} previously: {3:1.3f}'.format(self.sensorChanged, x, self.sensorAve[x], self.sensorLastRead[x]))
+                if self.trace is not None: self.trace.record(self.EV_CHANGED, x, self.sensorChanged, 0, 0, self.sensorAve[x], self.sensorLastRead[x])
+            if self.adaptive is not None:
+                self.adaptive.update(x, self.sensorAve[x] - self.sensorLastRead[x], now)
             self.adcValue[x] = self.valmap(self.sensorAve[x], 0, 65535, 0, self.vref) # 4mV change is approx 500
-            self.sensorLastRead[x] = self.sensorAve[x]
             self.adc['a' + str(x) + 'f'] = self.adcValue[x]
-            self.logger.debug('chan: {0} value: {1:1.3f}'.format(x, self.adcValue[x]))
+            if self.trace is not None: self.trace.record(self.EV_READ, x, 0, 0, 0, self.adcValue[x])
+        if self.adaptive is not None:
+            self.adaptive.report(self.adc)
         if self.sensorChanged or self.timelimit:
+            self.sensorLastRead = list(self.sensorAve)   # Reference for the next change
             self.time0 = time()
             self.sensorChanged = False
             self.timelimit = False
             return self.adc
+
+    def _block(self, samples):
+        ''' samples raw readings of every channel as a (samples, channels) array '''
+        block = np.zeros((samples, self.numOfChannels))
+        if self.scanner is not None:
+            n = 0
+            while n < samples:
+                rows = self.scanner.scan()[:samples - n]
+                block[n:n + len(rows)] = rows
+                n += len(rows)
+        else:
+            for n in range(samples):
+                block[n] = [self.chan[x].value for x in range(self.numOfChannels)]
+        return block
+
+    def calibrate(self, samples=2000, rate=0.01, apply=True):
+        ''' Measure the noise with the inputs idle. Returns per channel thresholds (raw ADC) that noise exceeds on rate of the polls (see Mcalibrate).
+        apply=True uses them and saves them to calibration '''
+        if self.capture is not None:
+            self.logger.warning("Capture mode has no noise threshold to calibrate")
+            return None
+        step = self.scanner.samples if self.scanner is not None else 1   # New samples per poll
+        thresholds = noise_thresholds(self._block(samples), rate, self.numOfSamples, step, self.filters)
+        self.logger.info("MCP3008 {0} noise thresholds (raw) at {1} false triggers per poll: {2}".format(self.name, rate, [round(t, 1) for t in thresholds]))
+        if apply:
+            self.noiseThreshold = thresholds
+            if self.adaptive is not None:
+                self.adaptive.noiseThreshold = thresholds
+            if self.calibration is not None:
+                self.calibration.save(self.name, thresholds, rate=rate, samples=samples)
+        return thresholds
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.stop()
+        if self.scanner is not None:
+            self.scanner.close()
       
 if __name__ == "__main__":
   
     logging.basicConfig(level=logging.INFO)
     logger_mcp3008 = logging.getLogger('mcp3008')
     logger_mcp3008.setLevel(logging.DEBUG)
-    adc_mcp3008 = mcp3008(2, 5, 400, 1, 8, logger=logger_mcp3008) # numOfChannels, vref, noiseThreshold, max time interval, chip select
+    trace = TraceBuffer(1024)
+    adc_mcp3008 = mcp3008(2, 5, 400, 1, 8, logger=logger_mcp3008, trace=trace) # numOfChannels, vref, noiseThreshold, max time interval, chip select
+    traceindex = 0
     while True:
         voltage = adc_mcp3008.getdata()
         if voltage is not None: logging.debug(voltage)
+        traceindex = trace.dump(logger_mcp3008, traceindex)
         sleep(.05)
\ No newline at end of file
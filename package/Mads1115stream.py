@@ -0,0 +1,218 @@
+'''
+Continuous conversion acquisition for the ADS1115. The chip is put in continuous mode at the
+configured data rate and a background thread reads every conversion into a ring buffer per
+channel, so getdata() averages buffered samples and never waits on the I2C bus.
+
+Only one input is converted at a time. With more than one channel the thread rotates the mux,
+waits one full conversion period after each mux change (writing the config restarts the
+conversion) and keeps burst samples per channel before moving on. With a single channel the
+mux is never changed and every conversion is kept.
+
+A new conversion is detected either with
+ rdypin  - ALERT/RDY wired to a GPIO (BCM). The comparator is set up as a conversion ready pulse
+           (hi_thresh MSB 1, lo_thresh MSB 0) and the thread waits on the falling edge
+ timed   - rdypin=None. Reads are paced at the data rate from perf_counter with a 10% margin
+           for the internal oscillator tolerance
+
+The i2c argument is a busio.I2C (or Mfakebus.FakeI2C off the Pi).
+
+ stream = ADS1115Stream(busio.I2C(board.SCL, board.SDA), address=0x48, gain=1, datarate=860, channels=(0, 1))
+ stream.start()
+ volts = stream.average(0, 10)   # mean of the last 10 samples of channel 0
+ stream.stop()
+
+capture(block) waits for the next len(block) samples and copies them, for Mspectral. Use one
+channel (the mux rotation is not evenly spaced) and a capacity of at least the block size.
+
+'''
+
+import logging, threading
+from array import array
+from time import perf_counter, sleep
+
+class ADS1115Stream:
+    ''' Background continuous conversion reader with a ring buffer of volts per channel '''
+    REG_CONVERSION, REG_CONFIG, REG_LOTHRESH, REG_HITHRESH = 0x00, 0x01, 0x02, 0x03
+    GAIN = {2/3: (0, 6.144), 1: (1, 4.096), 2: (2, 2.048), 4: (3, 1.024), 8: (4, 0.512), 16: (5, 0.256)}   # gain -> (PGA bits, +/- volts)
+    DATARATE = {8: 0, 16: 1, 32: 2, 64: 3, 128: 4, 250: 5, 475: 6, 860: 7}                                 # samples/s -> DR bits
+
+    def __init__(self, i2c, address=0x48, gain=1, datarate=860, channels=(0,), capacity=64, burst=8, rdypin=None, logger=None):
+        if logger is not None:                        # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        if gain not in self.GAIN:
+            raise ValueError("Gain must be one of {0}".format(list(self.GAIN)))
+        if datarate not in self.DATARATE:
+            raise ValueError("Data rate must be one of {0}".format(list(self.DATARATE)))
+        self.i2c = i2c
+        self.address = address
+        self.pga, self.fullscale = self.GAIN[gain]
+        self.datarate = datarate
+        self.period = 1 / datarate
+        self.channels = tuple(channels)
+        self.burst = burst if len(self.channels) > 1 else 1   # samples kept per mux visit
+        self.capacity = capacity
+        self.buffers = [array('d', bytes(8 * capacity)) for x in range(4)]   # Indexed by channel 0-3
+        self.counts = [0] * 4                                               # Samples written per channel
+        self.rdypin = rdypin
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._command = bytearray(3)
+        self._result = bytearray(2)
+        self.logger.info("ADS1115 continuous mode at {0} SPS channels: {1} ready: {2}".format(datarate, self.channels, "GPIO " + str(rdypin) if rdypin is not None else "timed"))
+
+    def config(self, channel):
+        ''' Config register for continuous conversion of one single ended input '''
+        return ((0b100 + channel) << 12) | (self.pga << 9) | (0 << 8) | (self.DATARATE[self.datarate] << 5) | (0b00 if self.rdypin is not None else 0b11)   # MODE 0 = continuous. COMP_QUE 00 = RDY after each conversion, 11 = comparator off
+
+    def _lock(self):
+        ''' Mi2cbus.I2CBus.try_lock() queues for the bus. A plain busio.I2C returns False while another thread has it, so sleep between tries '''
+        while not self.i2c.try_lock():
+            sleep(self.period / 8)
+
+    def _write(self, register, value):
+        self._command[0] = register
+        self._command[1] = (value >> 8) & 0xFF
+        self._command[2] = value & 0xFF
+        self._lock()
+        try:
+            self.i2c.writeto(self.address, self._command)
+        finally:
+            self.i2c.unlock()
+
+    def _read(self):
+        ''' Latest conversion in volts '''
+        self._lock()
+        try:
+            self.i2c.writeto_then_readfrom(self.address, bytes([self.REG_CONVERSION]), self._result)
+        finally:
+            self.i2c.unlock()
+        raw = (self._result[0] << 8) | self._result[1]
+        if raw & 0x8000:
+            raw -= 1 << 16
+        return raw * self.fullscale / 32768
+
+    def _setup_rdy(self):
+        self._write(self.REG_HITHRESH, 0x8000)   # MSB 1 in hi_thresh and 0 in lo_thresh turns ALERT/RDY into a conversion ready output
+        self._write(self.REG_LOTHRESH, 0x0000)
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(self.rdypin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(self.rdypin, GPIO.FALLING, callback=lambda pin: self._ready.set())
+
+    def _waitconversion(self, due):
+        ''' Block until the next conversion is ready. Returns the time the one after it is due (timed mode) '''
+        if self.rdypin is not None:
+            if not self._ready.wait(4 * self.period + 0.01):
+                self.logger.warning("ADS1115 no RDY pulse on GPIO {0}".format(self.rdypin))
+            self._ready.clear()
+            return due
+        wait = due - perf_counter()
+        if wait > 0:
+            sleep(wait)
+        return max(due, perf_counter()) + self.period * 1.1
+
+    def start(self):
+        if self.rdypin is not None:
+            self._setup_rdy()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ads1115', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self.rdypin is not None:
+            self.GPIO.remove_event_detect(self.rdypin)
+        self._write(self.REG_CONFIG, self.config(self.channels[0]) | (1 << 8))   # Back to single shot (power down)
+
+    def _run(self):
+        multiplexed = len(self.channels) > 1
+        try:
+            self._write(self.REG_CONFIG, self.config(self.channels[0]))
+            due = perf_counter() + self.period * 1.1
+            while not self._stop.is_set():
+                for channel in self.channels:
+                    if multiplexed:
+                        self._ready.clear()
+                        self._write(self.REG_CONFIG, self.config(channel))   # Writing config restarts the conversion with the new mux
+                        due = perf_counter() + self.period * 1.1
+                    for i in range(self.burst):
+                        due = self._waitconversion(due)
+                        self.append(channel, self._read())
+                        if self._stop.is_set():
+                            return
+        except Exception:
+            self.logger.exception("ADS1115 continuous read stopped on error")
+
+    def append(self, channel, volts):
+        ''' Single writer. Value is stored before the count moves so readers never see an unwritten slot '''
+        self.buffers[channel][self.counts[channel] % self.capacity] = volts
+        self.counts[channel] += 1
+
+    def samples(self, channel, n=None):
+        ''' Up to n most recent samples of channel, oldest first '''
+        count = self.counts[channel]
+        n = min(count, self.capacity if n is None else min(n, self.capacity))
+        buffer = self.buffers[channel]
+        return [buffer[k % self.capacity] for k in range(count - n, count)]
+
+    def average(self, channel, n=None):
+        ''' Mean of the n most recent samples. None before the first sample '''
+        values = self.samples(channel, n)
+        return sum(values) / len(values) if values else None
+
+    @property
+    def samplerate(self):
+        ''' Samples/s of each channel with one channel. Timed reads run 10% slower than the data rate '''
+        return self.datarate if self.rdypin is not None else self.datarate / 1.1
+
+    def capture(self, block):
+        ''' Fill block (samples, channels) with the next samples of every channel '''
+        n = block.shape[0]
+        start = [self.counts[channel] for channel in self.channels]
+        while any(self.counts[channel] - first < n for channel, first in zip(self.channels, start)):
+            if self._stop.is_set():
+                return
+            sleep(self.period * 8)
+        for column, channel in enumerate(self.channels):
+            block[:, column] = self.samples(channel, n)
+
+    def take(self, since):
+        ''' Rows of samples (one value per channel) recorded after since (counts from the last call). Returns (rows, counts for next call).
+        Rows stop at the channel with the fewest new samples, the others keep the rest for the next call '''
+        first = [max(start, self.counts[channel] - self.capacity) for channel, start in zip(self.channels, since)]   # Older samples were overwritten
+        n = min(self.counts[channel] - start for channel, start in zip(self.channels, first))
+        columns = [[self.buffers[channel][k % self.capacity] for k in range(start, start + n)] for channel, start in zip(self.channels, first)]
+        return list(zip(*columns)), [start + n for start in first]
+
+    def wait(self, timeout=1):
+        ''' Block until every channel has at least one sample '''
+        end = perf_counter() + timeout
+        while any(self.counts[channel] == 0 for channel in self.channels):
+            if perf_counter() > end:
+                return False
+            sleep(self.period)
+        return True
+
+if __name__ == "__main__":
+    try:
+        from .Mfakebus import FakeI2C, FakeADS1115
+    except ImportError:
+        from Mfakebus import FakeI2C, FakeADS1115
+    logging.basicConfig(level=logging.INFO)
+    bus = FakeI2C({0x48: FakeADS1115([1.2, 0.4, 3.3, 0.0], noise=0.002)})
+    stream = ADS1115Stream(bus, channels=(0, 1, 2))
+    stream.start()
+    sleep(0.5)
+    stream.stop()
+    for channel in stream.channels:
+        logging.info("chan {0} samples: {1} average: {2:1.3f}".format(channel, stream.counts[channel], stream.average(channel, 10)))
+    logging.info("I2C transfers: {0}".format(bus.transactions))
@@ -0,0 +1,122 @@
+'''
+Parallel polling of devices on independent buses. Devices are grouped by bus and each bus has one
+worker thread that reads its devices one after the other, so reads on the same bus never overlap
+and reads on different buses (ie I2C and SPI) run at the same time. A poll cycle takes about as
+long as the slowest bus instead of the sum of all devices.
+
+poll() waits for the cycle up to deadline seconds. A device that has not returned by then is
+reported stale and the cycle goes on without it. A bus still busy with a previous cycle is not
+given a new one, its devices are stale until it catches up. A read that finishes after its
+deadline is not lost: the latest unreported result of each device is returned by the next poll().
+
+ poller = BusPoller(deadline=0.08)
+ poller.add('ina219A', ina219A.getdata, 'i2c1', every=5)   # every 5th cycle
+ poller.add('ads1115', adc.getdata, 'i2c1')
+ poller.add('mcp3008', mcp.getdata, 'spi0')
+ results, stale = poller.poll()    # {name: payload} of devices read this cycle, [names] that missed the deadline
+
+'''
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import monotonic
+
+class BusPoller:
+    ''' One worker per bus. poll() reads every due device once, up to a deadline '''
+
+    def __init__(self, deadline=0.25, logger=None):
+        if logger is not None:                        # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        self.deadline = deadline
+        self.buses = {}      # bus -> [(name, read, every)]
+        self.workers = {}    # bus -> single thread executor
+        self.running = {}    # bus -> future of the group in progress
+        self.results = {}    # name -> (cycle, payload). Written by the bus worker
+        self.stale = {}      # name -> cycles missed in a row
+        self.reported = {}   # name -> cycle of the last result returned by poll()
+        self.cycle = 0
+        self.cycletime = 0.0
+
+    def add(self, name, read, bus, every=1):
+        if bus not in self.buses:
+            self.buses[bus] = []
+            self.workers[bus] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=str(bus))
+        self.buses[bus].append((name, read, every))
+        self.stale[name] = 0
+        self.reported[name] = 0
+        self.logger.info("Polling {0} on {1}{2}".format(name, bus, "" if every == 1 else " every {0} cycles".format(every)))
+
+    def _readgroup(self, devices, cycle):
+        for name, read in devices:
+            try:
+                payload = read()
+            except Exception:
+                self.logger.exception("{0} read failed".format(name))
+                payload = None
+            self.results[name] = (cycle, payload)
+
+    def poll(self, deadline=None):
+        ''' Returns ({name: payload} for devices that returned data since the last poll, [names of devices that missed this cycle]) '''
+        deadline = self.deadline if deadline is None else deadline
+        t0 = monotonic()
+        self.cycle += 1
+        due = []   # Names expected this cycle
+        futures = []
+        for bus, devices in self.buses.items():
+            group = [(name, read) for name, read, every in devices if self.cycle % every == 0]
+            if not group:
+                continue
+            due.extend(name for name, read in group)
+            if bus in self.running and not self.running[bus].done():
+                continue   # Still on an earlier cycle. Its devices will be stale
+            self.running[bus] = self.workers[bus].submit(self._readgroup, group, self.cycle)
+            futures.append(self.running[bus])
+        wait(futures, timeout=deadline)
+        results, stale = {}, []
+        for name in self.reported:   # This cycle's reads and late reads of earlier cycles
+            cycle, payload = self.results.get(name, (0, None))
+            if cycle > self.reported[name]:
+                self.reported[name] = cycle
+                if payload is not None:
+                    results[name] = payload
+        for name in due:
+            cycle, payload = self.results.get(name, (None, None))
+            if cycle == self.cycle:
+                if self.stale[name]:
+                    self.logger.info("{0} back after {1} stale cycles".format(name, self.stale[name]))
+                self.stale[name] = 0
+            else:
+                if self.stale[name] == 0:
+                    self.logger.warning("{0} missed the {1}s poll deadline. Reported stale".format(name, deadline))
+                self.stale[name] += 1
+                stale.append(name)
+        self.cycletime = monotonic() - t0
+        return results, stale
+
+    def close(self):
+        for worker in self.workers.values():
+            worker.shutdown(wait=False)
+
+if __name__ == "__main__":
+    from time import sleep
+    logging.basicConfig(level=logging.INFO)
+    def device(seconds, value):
+        def read():
+            sleep(seconds)
+            return {'valuef': value}
+        return read
+    poller = BusPoller(deadline=0.1)
+    poller.add('ina219A', device(0.02, 1), 'i2c1')
+    poller.add('ina219B', device(0.02, 2), 'i2c1')
+    poller.add('ads1115', device(0.03, 3), 'i2c1', every=2)
+    poller.add('mcp3008', device(0.04, 4), 'spi0')
+    poller.add('slow', device(0.25, 5), 'uart0')
+    for n in range(4):
+        results, stale = poller.poll()
+        logging.info("cycle {0} {1:.3f}s read {2} stale {3}".format(poller.cycle, poller.cycletime, sorted(results), stale))
+    poller.close()
@@ -0,0 +1,105 @@
+'''
+Noise floor calibration for the ADC noise thresholds. Capture a block of samples of every channel
+with the inputs idle (sensor connected, nothing changing) and the change the driver compares against
+noiseThreshold (the average now minus the average last published) is computed from it the same way
+getdata() does:
+ polled/scan  - mean of the sliding window (numOfSamples), one new sample per poll
+ stream       - mean of the last numOfSamples samples, new samples every poll
+ filters      - output of a copy of the filter pipeline
+The last published average is usually more than a window old, so the change is taken against the
+average one window (window / step polls) earlier. The threshold of each channel is the change that idle noise exceeds at the chosen false trigger
+rate. rate is per device poll: a device publishes when any channel changes, so every channel gets
+rate / channels. With enough deltas (10 or more expected triggers) the threshold is the empirical
+quantile of the deltas, otherwise a normal distribution fitted to them (robust sigma from the MAD).
+
+ thresholds = noise_thresholds(block, rate=0.01, window=10)   # block is (samples, channels)
+
+The drivers do the capture and can persist the thresholds so the next start uses them
+ calibration = NoiseCalibration('noise.json')
+ adc = ads1115(2, 0.003, 1, 1, 0x48, calibration=calibration, name='joystick')   # Saved thresholds replace 0.003 if there are any
+ adc.calibrate(samples=2000, rate=0.01)                          # Measure, apply and save
+
+File format: {"joystick_ads1115_0x48": {"noiseThreshold": [...], "rate": 0.01, "samples": 2000, "time": "..."}}
+
+'''
+
+import json, logging
+from copy import deepcopy
+from datetime import datetime
+from os import path, replace
+from statistics import NormalDist
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+def poll_deltas(block, window=10, step=1, filters=None):
+    ''' Change from the average one window of polls earlier for each channel. step is the new samples per poll '''
+    block = np.asarray(block, dtype=float)
+    if filters is not None:
+        pipeline = deepcopy(filters)   # Leave the live filter state alone
+        pipeline.reset()
+        values = pipeline.process(block)
+        step = max(1, step * len(values) // len(block))   # Decimation
+    else:
+        values = sliding_window_view(block, window, axis=0).mean(axis=-1)
+    values = values[step - 1::step]
+    lag = max(1, -(-window // step))   # Polls for a window of new samples
+    return values[lag:] - values[:-lag]
+
+def noise_thresholds(block, rate=0.01, window=10, step=1, filters=None):
+    ''' Per channel thresholds that idle noise exceeds on rate of the device polls '''
+    deltas = np.abs(poll_deltas(block, window, step, filters))
+    p = rate / deltas.shape[1]   # Per channel
+    if len(deltas) * p >= 10:
+        thresholds = np.quantile(deltas, 1 - p, axis=0)
+    else:
+        sigma = 1.4826 * np.median(deltas, axis=0)   # MAD of deltas centred on 0
+        thresholds = NormalDist().inv_cdf(1 - p / 2) * sigma
+    return thresholds.tolist()
+
+class NoiseCalibration:
+    ''' Per device thresholds saved in a JSON file '''
+
+    def __init__(self, filename='noise.json', logger=None):
+        if logger is not None:                        # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        self.filename = filename
+
+    def _read(self):
+        if not path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except ValueError:
+            self.logger.error("Noise calibration file {0} is not valid JSON. Ignored".format(self.filename))
+            return {}
+
+    def load(self, device, numOfChannels=None):
+        ''' Saved thresholds of device, or None if there are none for that number of channels '''
+        entry = self._read().get(device)
+        if entry is None:
+            return None
+        if numOfChannels is not None and len(entry['noiseThreshold']) != numOfChannels:
+            self.logger.warning("{0} calibrated with {1} channels, not {2}. Ignored".format(device, len(entry['noiseThreshold']), numOfChannels))
+            return None
+        return entry['noiseThreshold']
+
+    def save(self, device, thresholds, **info):
+        data = self._read()
+        data[device] = dict(noiseThreshold=list(thresholds), time=datetime.now().isoformat(timespec='seconds'), **info)
+        with open(self.filename + '.tmp', 'w') as f:   # Replace in one step so a crash can not leave half a file
+            json.dump(data, f, indent=1)
+        replace(self.filename + '.tmp', self.filename)
+        self.logger.info("Saved {0} noise thresholds to {1}".format(device, self.filename))
+
+if __name__ == "__main__":
+    block = np.random.normal([1.0, 2.0], [0.002, 0.005], (20000, 2))   # Idle channels, volts
+    for rate in (0.1, 0.01, 0.001):
+        thresholds = noise_thresholds(block, rate, 10)
+        deltas = np.abs(poll_deltas(np.random.normal([1.0, 2.0], [0.002, 0.005], (20000, 2)), 10))
+        print(rate, [round(t, 5) for t in thresholds], "triggers per poll", round(float(np.mean((deltas > thresholds).any(axis=1))), 4))
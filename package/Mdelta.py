@@ -0,0 +1,117 @@
+'''
+Delta payloads. Instead of every key on every publish, only the keys that differ from the last full
+payload (keyframe) are sent. Deltas are relative to the keyframe, not to the previous delta, so a
+lost delta is repaired by the next one and a subscriber only needs the latest keyframe.
+ seqi  - Sequence number of the payload. A jump shows payloads were lost
+ keyi  - seqi of the keyframe the payload is relative to. keyi == seqi on a keyframe
+
+A keyframe is sent every keyframe payloads, after keyframeinterval seconds, when more than ratio of
+the keys changed (a delta would be nearly as big), when a keyframe key is missing from the payload
+(a delta can not remove a key, the decoder would keep its old value), or when requested (ie a
+subscriber restarted).
+deadbands ({key: deadband}) lets values within the deadband of the keyframe count as unchanged.
+
+ delta = DeltaEncoder(keyframe=20, keyframeinterval=60)
+ mqtt_client.publish(topic, json.dumps(delta.encode(payload)))
+
+Node-RED function node to rebuild the full payload (latest keyframe kept per topic):
+
+ const frames = context.get('keyframes') || {};
+ const lastseq = context.get('lastseq') || {};
+ const p = msg.payload;
+ if (p.keyi === p.seqi) frames[msg.topic] = p;
+ if (p.seqi > lastseq[msg.topic] + 1) node.warn(msg.topic + ' lost ' + (p.seqi - lastseq[msg.topic] - 1) + ' payloads');
+ lastseq[msg.topic] = p.seqi;
+ context.set('keyframes', frames);
+ context.set('lastseq', lastseq);
+ const frame = frames[msg.topic];
+ if (!frame || frame.keyi !== p.keyi) {               // Keyframe missed. Drop until the next one
+     node.status({fill: 'yellow', shape: 'ring', text: 'waiting for keyframe'});
+     return null;
+ }
+ node.status({});
+ msg.payload = Object.assign({}, frame, p);
+ return msg;
+
+'''
+
+from time import monotonic
+
+class DeltaEncoder:
+    ''' Keys changed since the last keyframe, with a sequence number '''
+
+    def __init__(self, keyframe=20, keyframeinterval=60, ratio=0.5, deadbands=None):
+        self.keyframe = keyframe
+        self.keyframeinterval = keyframeinterval
+        self.ratio = ratio
+        self.deadbands = deadbands or {}
+        self.reference = None   # Last keyframe payload
+        self.seq = -1
+        self.keyseq = -1
+        self.count = 0          # Deltas since the last keyframe
+        self.tkeyframe = 0.0
+        self.requested = False
+
+    def request_keyframe(self):
+        self.requested = True
+
+    def changed(self, payload):
+        keys = []
+        for key, value in payload.items():
+            last = self.reference.get(key)
+            if isinstance(value, (int, float)) and isinstance(last, (int, float)) and not isinstance(value, bool):
+                if abs(value - last) > self.deadbands.get(key, 0):
+                    keys.append(key)
+            elif value != last or key not in self.reference:
+                keys.append(key)
+        return keys
+
+    def encode(self, payload, now=None):
+        ''' Payload to publish: a keyframe (every key) or the keys that differ from the keyframe '''
+        now = monotonic() if now is None else now
+        self.seq += 1
+        if self.reference is not None and not self.requested and self.count + 1 < self.keyframe and now - self.tkeyframe < self.keyframeinterval and not self.reference.keys() - payload.keys():   # A removed key needs a keyframe
+            keys = self.changed(payload)
+            if len(keys) <= self.ratio * len(payload):
+                self.count += 1
+                delta = {key: payload[key] for key in keys}
+                delta['seqi'] = self.seq
+                delta['keyi'] = self.keyseq
+                return delta
+        self.reference = dict(payload)
+        self.keyseq = self.seq
+        self.count = 0
+        self.tkeyframe = now
+        self.requested = False
+        frame = dict(payload)
+        frame['seqi'] = self.seq
+        frame['keyi'] = self.keyseq
+        return frame
+
+def decode(state, payload):
+    ''' Python version of the Node-RED decoder. state is a dict kept between calls. Returns the full payload or None '''
+    if payload['keyi'] == payload['seqi']:
+        state['keyframe'] = payload
+    if payload['seqi'] > state.get('lastseq', payload['seqi']) + 1:
+        state['lost'] = state.get('lost', 0) + payload['seqi'] - state['lastseq'] - 1
+    state['lastseq'] = payload['seqi']
+    frame = state.get('keyframe')
+    if frame is None or frame['keyi'] != payload['keyi']:
+        return None   # Keyframe missed
+    return dict(frame, **payload)
+
+if __name__ == "__main__":
+    import json, random
+    delta = DeltaEncoder(keyframe=10)
+    state = {}
+    payload = {'steps0i': 0, 'steps1i': 0, 'rpm0f': 3.0, 'rpm1f': 3.0, 'speed0i': 3, 'speed1i': 3, 'delayf': 0.8}
+    full, sent = 0, 0
+    for n in range(50):
+        payload['steps0i'] += 20   # One motor moving
+        message = delta.encode(payload)
+        full += len(json.dumps(payload))
+        sent += len(json.dumps(message))
+        if random.random() < 0.1 and message['keyi'] != message['seqi']:
+            continue   # Lost delta
+        assert decode(state, message) in (None, dict(payload, seqi=message['seqi'], keyi=message['keyi']))
+    print("bytes full", full, "delta", sent, "lost", state.get('lost', 0))
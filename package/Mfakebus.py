@@ -0,0 +1,302 @@
+'''
+Fake buses for running the drivers without a Pi. FakeI2C has the methods the drivers call on
+busio.I2C and FakeSPI the transfer() of Mmcp3008scan.SpidevBus, so they can be passed anywhere
+the real bus object is expected.
+
+ FakeI2C(devices)     - devices is a dict {address: device model}. Transfers are forwarded to the
+                        model at that address. transactions counts every bus transfer
+ FakeADS1115(signal)  - ADS1115 register model. signal(channel, t) returns the input voltage, or pass
+                        a list of voltages (one per channel). Conversions follow the configured data rate
+ FakeSPI(device)      - Same transfer(tx, framelen, delay_us) as Mmcp3008scan.SpidevBus. Each framelen bytes
+                        is one chip select cycle handed to the device model. No device is a loopback (rx = tx).
+                        Keeps a simulated clock from the bit time and frame delays, so captures have exact timing
+ FakeMCP3008(signal)  - MCP3008 model. signal as FakeADS1115 with up to 8 channels
+ FakeINA219(signal)   - INA219 register model. signal(t) returns (bus volts, amps), or pass a tuple.
+                        Conversions take the time of the configured ADC resolution/averaging and set CNVR
+ FakeGPIO()           - RPi.GPIO stand in (pass it as gpio=). set(pin, level) changes an input and runs its
+                        event callback in the calling thread. turn(clk, dt, detents) injects quadrature edges
+
+ bus = FakeI2C({0x48: FakeADS1115([1.2, 0.4, 3.3, 0.0], noise=0.002)})
+ stream = ADS1115Stream(bus, address=0x48, channels=(0, 1))
+
+'''
+
+import random, struct
+from time import perf_counter, sleep
+
+class FakeI2C:
+    ''' busio.I2C stand in. Every transfer is forwarded to the device model at the address '''
+
+    def __init__(self, devices=None):
+        self.devices = dict(devices) if devices is not None else {}
+        self.locked = False
+        self.transactions = 0
+
+    def try_lock(self):
+        if self.locked:
+            return False
+        self.locked = True
+        return True
+
+    def unlock(self):
+        self.locked = False
+
+    def scan(self):
+        return sorted(self.devices)
+
+    def _device(self, address):
+        if address not in self.devices:
+            raise OSError(121, "No device at I2C address {0}".format(hex(address)))   # errno 121 = Remote I/O error, same as the kernel driver
+        return self.devices[address]
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        self.transactions += 1
+        self._device(address).write(bytes(buffer[start:end]))
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None):
+        self.transactions += 1
+        end = len(buffer) if end is None else end
+        buffer[start:end] = self._device(address).read(end - start)
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0, in_end=None):
+        self.transactions += 1
+        device = self._device(address)
+        device.write(bytes(buffer_out[out_start:out_end]))
+        in_end = len(buffer_in) if in_end is None else in_end
+        buffer_in[in_start:in_end] = device.read(in_end - in_start)
+
+    def deinit(self):
+        pass
+
+class FakeADS1115:
+    ''' ADS1115 registers: 0 conversion, 1 config, 2 lo_thresh, 3 hi_thresh '''
+    FULLSCALE = (6.144, 4.096, 2.048, 1.024, 0.512, 0.256, 0.256, 0.256)   # PGA bits -> +/- volts
+    DATARATE = (8, 16, 32, 64, 128, 250, 475, 860)                         # DR bits -> samples/s
+
+    def __init__(self, signal=None, noise=0.0):
+        if signal is None:
+            signal = [0.0, 0.0, 0.0, 0.0]
+        self.signal = signal if callable(signal) else (lambda channel, t, volts=list(signal): volts[channel])
+        self.noise = noise
+        self.registers = [0x0000, 0x8583, 0x8000, 0x7FFF]   # Power on defaults
+        self.pointer = 0
+        self.started = perf_counter()   # Time the current mux/config took effect
+        self.conversions = 0             # Conversions read back
+
+    def write(self, data):
+        self.pointer = data[0] & 0x03
+        if len(data) >= 3:
+            value = (data[1] << 8) | data[2]
+            self.registers[self.pointer] = value & 0x7FFF if self.pointer == 1 else value   # OS bit reads back 0 (busy) when set
+            if self.pointer == 1:
+                self.started = perf_counter()
+
+    def read(self, length):
+        if self.pointer == 0:
+            self.conversions += 1
+            return struct.pack('>h', self.convert())[:length]
+        value = self.registers[self.pointer]
+        if self.pointer == 1 and perf_counter() - self.started >= 1 / self.datarate():
+            value |= 0x8000   # OS bit 1 = not converting
+        return struct.pack('>H', value)[:length]
+
+    def datarate(self):
+        return self.DATARATE[(self.registers[1] >> 5) & 0x07]
+
+    def convert(self):
+        ''' Signed 16 bit result for the current mux and gain. Single ended inputs only (mux 4-7) '''
+        config = self.registers[1]
+        mux = (config >> 12) & 0x07
+        channel = mux - 4 if mux >= 4 else 0
+        fullscale = self.FULLSCALE[(config >> 9) & 0x07]
+        volts = self.signal(channel, perf_counter())
+        if self.noise:
+            volts += random.gauss(0, self.noise)
+        return max(-32768, min(32767, int(volts * 32768 / fullscale)))
+
+class FakeSPI:
+    ''' spidev stand in. transactions counts transfer() calls, frames counts chip select cycles '''
+
+    def __init__(self, device=None, speed=1350000):
+        self.device = device
+        self.speed = speed
+        self.clock = 0.0   # Simulated seconds on the bus
+        self.transactions = 0
+        self.frames = 0
+
+    def transfer(self, tx, framelen, delay_us=0):
+        self.transactions += 1
+        if self.device is None:
+            return bytes(tx)
+        rx = bytearray(len(tx))
+        frametime = framelen * 8 / self.speed + delay_us / 1000000
+        for start in range(0, len(tx), framelen):
+            self.frames += 1
+            rx[start:start + framelen] = self.device.frame(bytes(tx[start:start + framelen]), self.clock)
+            self.clock += frametime
+        return bytes(rx)
+
+    def close(self):
+        pass
+
+class FakeMCP3008:
+    ''' 10 bit conversion of the channel in the command byte. Start bit in byte 0, SGL/DIFF + D2-D0 in byte 1 '''
+
+    def __init__(self, signal=None, vref=3.3, noise=0.0):
+        if signal is None:
+            signal = [0.0] * 8
+        self.signal = signal if callable(signal) else (lambda channel, t, volts=list(signal): volts[channel])
+        self.vref = vref
+        self.noise = noise
+
+    def frame(self, data, t=None):
+        ''' One chip select cycle. t is the sample time (perf_counter when not given) '''
+        if not data[0] & 0x01:   # No start bit, chip stays idle and MISO reads 0
+            return bytes(len(data))
+        channel = (data[1] >> 4) & 0x07
+        volts = self.signal(channel, perf_counter() if t is None else t)
+        if self.noise:
+            volts += random.gauss(0, self.noise)
+        value = max(0, min(1023, round(volts * 1024 / self.vref)))
+        return bytes([0, (value >> 8) & 0x03, value & 0xFF]) + bytes(len(data) - 3)
+
+class FakeINA219:
+    ''' INA219 registers: 0 config, 1 shunt voltage, 2 bus voltage, 3 power, 4 current, 5 calibration '''
+    CONVERSION_US = {0: 84, 1: 148, 2: 276, 3: 532, 8: 532, 9: 1060, 10: 2130, 11: 4260, 12: 8510, 13: 17020, 14: 34050, 15: 68100}   # ADC bits -> us
+
+    def __init__(self, signal=(5.0, 0.1), shunt_ohms=0.1, noise=0.0):
+        self.signal = signal if callable(signal) else (lambda t, values=tuple(signal): values)
+        self.shunt_ohms = shunt_ohms
+        self.noise = noise   # amps
+        self.registers = [0x399F, 0, 0, 0, 0, 0]   # Power on defaults. 0x399F = 32V, 320mV, 12 bit, continuous shunt and bus
+        self.pointer = 0
+        self.cnvr = False
+        self.ovf = False
+        self.pending = True
+        self.started = perf_counter()   # Start of the conversion in progress
+        self.conversions = 0
+
+    def conversiontime(self):
+        config = self.registers[0]
+        return max(self.CONVERSION_US.get((config >> 7) & 0x0F, 532), self.CONVERSION_US.get((config >> 3) & 0x0F, 532)) / 1000000
+
+    def write(self, data):
+        self.pointer = data[0] % 6
+        if len(data) >= 3:
+            value = (data[1] << 8) | data[2]
+            if self.pointer == 0:
+                if value & 0x8000:   # Reset
+                    value = 0x399F
+                self.cnvr = False
+                self.pending = True   # Triggered modes convert once per config write
+                self.started = perf_counter()
+            self.registers[self.pointer] = value
+
+    def _update(self):
+        ''' Finish the conversion in progress when its time is up '''
+        mode = self.registers[0] & 0x07
+        if mode in (0, 4) or mode <= 3 and not self.pending or perf_counter() - self.started < self.conversiontime():
+            return
+        volts, amps = self.signal(perf_counter())
+        if self.noise:
+            amps += random.gauss(0, self.noise)
+        fullscale = 0.04 * (1 << ((self.registers[0] >> 11) & 0x03))   # PGA shunt range
+        shunt = max(-fullscale, min(fullscale, amps * self.shunt_ohms))
+        self.ovf = abs(amps * self.shunt_ohms) > fullscale
+        self.registers[1] = int(round(shunt / 0.00001)) & 0xFFFF                           # 10uV LSB
+        busraw = max(0, min(8191, int(round(volts / 0.004))))                             # 4mV LSB
+        self.registers[2] = busraw << 3
+        current = int(round(shunt / 0.00001)) * self.registers[5] // 4096
+        self.registers[4] = current & 0xFFFF
+        self.registers[3] = max(0, min(0xFFFF, abs(current) * busraw // 5000))
+        self.cnvr = True
+        self.conversions += 1
+        if mode <= 3:   # Triggered. Wait for the next config write
+            self.pending = False
+        else:
+            self.started = perf_counter()
+
+    def read(self, length):
+        self._update()
+        value = self.registers[self.pointer]
+        if self.pointer == 2:
+            value |= (self.cnvr << 1) | self.ovf
+        elif self.pointer == 3:
+            self.cnvr = False   # Reading power clears the conversion ready flag
+        return struct.pack('>H', value)[:length]
+
+class FakeGPIO:
+    ''' RPi.GPIO module stand in. Levels are set by the test, edges run the add_event_detect callbacks '''
+    BOARD, BCM = 10, 11
+    OUT, IN = 0, 1
+    LOW, HIGH = 0, 1
+    PUD_OFF, PUD_DOWN, PUD_UP = 20, 21, 22
+    RISING, FALLING, BOTH = 31, 32, 33
+    VERSION = 'fake'
+    CW = {0: 1, 1: 3, 3: 2, 2: 0}   # Next (clk << 1 | dt) state for one quarter step clockwise (dt leads)
+
+    def __init__(self):
+        self.levels = {}
+        self.events = {}   # pin -> (edge, [callbacks])
+        self.edges = 0
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=LOW):
+        self.levels[pin] = int(pull_up_down == self.PUD_UP) if direction == self.IN else initial
+
+    def input(self, pin):
+        return self.levels[pin]
+
+    def output(self, pin, value):
+        self.set(pin, value)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.events[pin] = (edge, [callback] if callback is not None else [])
+
+    def add_event_callback(self, pin, callback):
+        self.events[pin][1].append(callback)
+
+    def remove_event_detect(self, pin):
+        self.events.pop(pin, None)
+
+    def cleanup(self, pins=None):
+        self.events.clear()
+
+    def set(self, pin, level):
+        ''' Drive an input. A level change runs the pin callbacks that match the edge '''
+        level = int(bool(level))
+        if self.levels.get(pin) == level:
+            return
+        self.levels[pin] = level
+        self.edges += 1
+        edge, callbacks = self.events.get(pin, (None, []))
+        if edge == self.BOTH or edge == (self.RISING if level else self.FALLING):
+            for callback in callbacks:
+                callback(pin)
+
+    def turn(self, clk, dt, detents, bounce=0, delay=0.0):
+        ''' Quadrature edges for detents (4 quarter steps each, negative is counter clockwise). bounce extra
+        toggles of each changing pin before it settles. delay seconds between edges '''
+        ccw = {new: old for old, new in self.CW.items()}
+        for n in range(4 * abs(detents)):
+            state = (self.levels[clk] << 1) | self.levels[dt]
+            new = self.CW[state] if detents > 0 else ccw[state]
+            pin = clk if (state ^ new) & 2 else dt
+            for b in range(bounce):
+                self.set(pin, not self.levels[pin])
+                self.set(pin, not self.levels[pin])
+            self.set(pin, not self.levels[pin])
+            if delay:
+                sleep(delay)
+
+if __name__ == "__main__":
+    bus = FakeI2C({0x48: FakeADS1115([1.2, 0.4, 3.3, 0.0])})
+    result = bytearray(2)
+    bus.writeto(0x48, bytes([0x01, 0xC3, 0x83]))   # Single shot, channel 0, gain 1
+    bus.writeto_then_readfrom(0x48, bytes([0x00]), result)
+    print(struct.unpack('>h', result)[0] * 4.096 / 32768, bus.scan(), bus.transactions)
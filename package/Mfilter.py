@@ -0,0 +1,161 @@
+'''
+Composable filters for sensor channels. A Pipeline runs its filters in order over a batch of
+samples (rows) for every channel (columns) at once with NumPy. Each filter keeps its own state
+per channel, so consecutive batches filter as one continuous signal.
+
+ EMA(alpha)                 - Exponential moving average. y = alpha*x + (1-alpha)*y
+ Median(n)                  - Median of the last n samples (spikes/glitches)
+ Decimate(factor)           - Keep every factor-th sample. Put a low-pass in front of it
+ LowPass(cutoff, samplerate) - 2nd order Butterworth low-pass (Hz)
+ Kalman(q, r)               - Scalar Kalman filter for a slowly changing value (ie INA219 current).
+                              q = process variance per sample, r = measurement variance
+
+ filters = Pipeline(Median(5), LowPass(20, 860), Decimate(4))
+ out = filters.process(block)     # block is (samples, channels). Returns the filtered rows
+ latest = filters.update(values)  # One sample per channel. Returns the latest output row
+
+IIR filters (EMA, LowPass) use scipy.signal.lfilter when scipy is installed and a loop over the
+samples (vectorized across channels) when it is not. Filters start from the first sample (steady
+state) instead of ramping up from 0.
+
+'''
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+
+def _iir(b, a, x, zi):
+    ''' Direct form II transposed over axis 0. Returns (y, final state) '''
+    if lfilter is not None:
+        return lfilter(b, a, x, axis=0, zi=zi)
+    y = np.empty_like(x)
+    z = zi.copy()
+    order = len(z)
+    for n in range(len(x)):
+        y[n] = b[0] * x[n] + z[0]
+        for k in range(order):
+            z[k] = b[k + 1] * x[n] - a[k + 1] * y[n] + (z[k + 1] if k + 1 < order else 0)
+    return y, z
+
+def _steadystate(b, a, x0):
+    ''' State of a unity DC gain IIR that has seen x0 forever, so the output starts at x0 '''
+    return np.array([(np.sum(b[k:]) - np.sum(a[k:])) * x0 for k in range(1, len(a))])
+
+class EMA:
+    def __init__(self, alpha=0.2):
+        self.b = np.array([alpha, 0.0])
+        self.a = np.array([1.0, alpha - 1])
+        self.reset()
+
+    def reset(self):
+        self.z = None
+
+    def process(self, x):
+        if self.z is None:
+            self.z = _steadystate(self.b, self.a, x[0])
+        y, self.z = _iir(self.b, self.a, x, self.z)
+        return y
+
+class LowPass(EMA):
+    def __init__(self, cutoff, samplerate):
+        w = 2 * np.pi * cutoff / samplerate   # Bilinear transform biquad, Q = 1/sqrt(2)
+        alpha = np.sin(w) / np.sqrt(2)
+        cos = np.cos(w)
+        a0 = 1 + alpha
+        self.b = np.array([(1 - cos) / 2, 1 - cos, (1 - cos) / 2]) / a0
+        self.a = np.array([a0, -2 * cos, 1 - alpha]) / a0
+        self.reset()
+
+class Median:
+    def __init__(self, n=5):
+        self.n = n
+        self.reset()
+
+    def reset(self):
+        self.history = None   # Last n-1 rows of the previous batch
+
+    def process(self, x):
+        if self.history is None:
+            self.history = np.repeat(x[:1], self.n - 1, axis=0)
+        window = np.concatenate((self.history, x))
+        self.history = window[len(window) - (self.n - 1):]
+        return np.median(sliding_window_view(window, self.n, axis=0), axis=-1)
+
+class Decimate:
+    def __init__(self, factor=4):
+        self.factor = factor
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+
+    def process(self, x):
+        keep = (self.count + np.arange(len(x))) % self.factor == self.factor - 1
+        self.count += len(x)
+        return x[keep]
+
+class Kalman:
+    def __init__(self, q=1e-5, r=1e-3):
+        self.q = q
+        self.r = r
+        self.reset()
+
+    def reset(self):
+        self.estimate = None
+        self.p = None
+
+    def process(self, x):
+        if self.estimate is None:
+            self.estimate = x[0].copy()
+            self.p = np.full(x.shape[1], self.r)
+        y = np.empty_like(x)
+        for n in range(len(x)):
+            self.p = self.p + self.q
+            gain = self.p / (self.p + self.r)
+            self.estimate = self.estimate + gain * (x[n] - self.estimate)
+            self.p = (1 - gain) * self.p
+            y[n] = self.estimate
+        return y
+
+class Pipeline:
+    ''' Filters applied in order. last is the latest output row (None before the first output) '''
+
+    def __init__(self, *filters):
+        self.filters = filters
+        self.last = None
+
+    def process(self, x):
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 1:
+            x = x[:, None]
+        for f in self.filters:
+            if len(x) == 0:
+                break
+            x = f.process(x)
+        if len(x):
+            self.last = x[-1].copy()
+        return x
+
+    def update(self, values):
+        self.process(np.asarray(values, dtype=float)[None, :])
+        return self.last
+
+    def reset(self):
+        for f in self.filters:
+            f.reset()
+        self.last = None
+
+if __name__ == "__main__":
+    rate = 860
+    t = np.arange(2048) / rate
+    clean = np.column_stack([1 + 0.2 * np.sin(2 * np.pi * 2 * t), 0.5 + 0 * t])
+    noisy = clean + np.random.normal(0, 0.05, clean.shape)
+    noisy[::97] += 1.0   # Spikes
+    filters = Pipeline(Median(5), LowPass(10, rate))
+    out = np.concatenate([filters.process(noisy[n:n + 100]) for n in range(0, len(noisy), 100)])   # Batches filter as one signal
+    print("rms error noisy {0:.4f} filtered {1:.4f}".format(np.sqrt(np.mean((noisy - clean) ** 2)), np.sqrt(np.mean((out[200:] - clean[200:]) ** 2))))
+    current = Pipeline(Kalman(1e-6, 0.05 ** 2))
+    print("kalman", [round(float(current.update([0.3 + np.random.normal(0, 0.05)])[0]), 4) for x in range(10)])
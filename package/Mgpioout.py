@@ -0,0 +1,128 @@
+'''
+Batched GPIO output stage for the steppers. All motor pins are mapped to one bitmask
+(bit n = BCM pin n) and the set mask for every motor and coil phase is precomputed, so one
+tick for the whole machine is a few ORs and a single backend write.
+
+Backends (pass one to Stepper/StepperArray as output=)
+ RPiGPIOBackend()   - RPi.GPIO. One GPIO.output() call with every pin per tick
+ RegisterBackend()  - Writes the BCM283x GPSET0/GPCLR0 registers through /dev/gpiomem. Pins 0-31
+ RecorderBackend()  - Keeps every write in memory. For testing without a Pi
+
+ motor = Stepper(m1pins, m2pins, logger=logger_stepper, output=RecorderBackend())
+
+'''
+
+import mmap, os
+from time import perf_counter_ns
+
+class PinBank:
+    ''' Pin bitmasks for all motors. phasemask[motor][phase] is the set mask for that coil pattern '''
+
+    def __init__(self, motorpins, phases, backend):
+        self.backend = backend
+        self.pins = [pin for pins in motorpins for pin in pins]
+        self.allmask = 0
+        for pin in self.pins:
+            self.allmask |= 1 << pin
+        self.phasemask = []
+        for pins in motorpins:
+            masks = []
+            for pattern in phases:
+                mask = 0
+                for pin, level in zip(pins, pattern):
+                    if level:
+                        mask |= 1 << pin
+                masks.append(mask)
+            self.phasemask.append(masks)
+        self.backend.setup(self.pins)
+
+    def write(self, setmask):
+        ''' Set the pins in setmask HIGH and every other motor pin LOW in one backend write '''
+        self.backend.write(setmask, self.allmask & ~setmask)
+
+    def write_phases(self, phases, moving):
+        ''' Build the set mask from the phase of each motor. Motors not moving are all LOW '''
+        setmask = 0
+        for motor, phase in enumerate(phases):
+            if moving[motor]:
+                setmask |= self.phasemask[motor][phase]
+        self.write(setmask)
+
+    def cleanup(self):
+        self.write(0)
+        self.backend.cleanup()
+
+class RPiGPIOBackend:
+    ''' RPi.GPIO accepts a list of channels and values, so one call updates every pin '''
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+
+    def setup(self, pins):
+        self.GPIO.setmode(self.GPIO.BCM)
+        self.channels = list(pins)
+        for pin in self.channels:
+            self.GPIO.setup(pin, self.GPIO.OUT)
+
+    def write(self, setmask, clearmask):
+        self.GPIO.output(self.channels, [(setmask >> pin) & 1 for pin in self.channels])
+
+    def cleanup(self):
+        self.GPIO.cleanup(self.channels)
+
+class RegisterBackend:
+    ''' Direct register writes. One GPCLR0 and one GPSET0 store per tick. Only GPIO 0-31 (all header pins) '''
+    GPFSEL0, GPSET0, GPCLR0 = 0, 7, 10   # 32bit register index (offset/4)
+
+    def __init__(self, device='/dev/gpiomem'):
+        fd = os.open(device, os.O_RDWR | os.O_SYNC)
+        self.mem = mmap.mmap(fd, 4096, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        os.close(fd)
+        self.regs = memoryview(self.mem).cast('I')
+
+    def setup(self, pins):
+        for pin in pins:
+            if pin > 31:
+                raise ValueError("RegisterBackend only supports GPIO 0-31. Pin {0}".format(pin))
+            index, shift = self.GPFSEL0 + pin // 10, (pin % 10) * 3
+            self.regs[index] = (self.regs[index] & ~(0b111 << shift)) | (0b001 << shift)   # 001 = output
+
+    def write(self, setmask, clearmask):
+        self.regs[self.GPCLR0] = clearmask
+        self.regs[self.GPSET0] = setmask
+
+    def cleanup(self):
+        self.regs.release()
+        self.mem.close()
+
+class RecorderBackend:
+    ''' In memory backend. writes keeps (perf_counter_ns, setmask, clearmask) for each tick '''
+
+    def __init__(self, maxwrites=100000):
+        self.maxwrites = maxwrites
+        self.writes = []
+        self.level = 0   # Current pin levels as a bitmask
+
+    def setup(self, pins):
+        self.pins = list(pins)
+
+    def write(self, setmask, clearmask):
+        self.level = (self.level & ~clearmask) | setmask
+        if len(self.writes) < self.maxwrites:
+            self.writes.append((perf_counter_ns(), setmask, clearmask))
+
+    def states(self, pins):
+        ''' Levels (0/1) of pins after the last write '''
+        return [(self.level >> pin) & 1 for pin in pins]
+
+    def cleanup(self):
+        pass
+
+if __name__ == "__main__":
+    recorder = RecorderBackend()
+    bank = PinBank([[12, 16, 20, 21], [19, 13, 6, 5]], ((1,0,0,1), (1,0,0,0), (1,1,0,0), (0,1,0,0)), recorder)
+    bank.write_phases([0, 2], [True, True])
+    print(recorder.states([12, 16, 20, 21]), recorder.states([19, 13, 6, 5]))
+    bank.write_phases([1, 2], [True, False])
+    print(recorder.states([12, 16, 20, 21]), recorder.states([19, 13, 6, 5]))
@@ -0,0 +1,231 @@
+'''
+Process wide I2C bus manager. Every driver on a bus gets the same I2CBus handle instead of opening
+its own, and transactions are serialized with a ticket lock so threads get the bus in the order
+they asked for it (a busy reader can not starve the others).
+
+I2CBus has the busio.I2C methods (try_lock/unlock/writeto/readfrom_into/writeto_then_readfrom/scan)
+so it can be passed to adafruit drivers and Mads1115stream. try_lock() waits for its turn and
+returns True, so busio style "while not try_lock()" loops queue instead of spinning.
+ read_registers(address, registers) - several register reads of one device in one turn on the bus.
+                                      autoincrement=True merges consecutive registers into one transfer
+ stats()                            - per address: transactions, bus time held (s) and time waited for the bus (s)
+
+RegisterDevice wraps an address with the Adafruit_GPIO I2C device methods (readU16BE, writeList ...)
+used by the ina219 library, so its transfers go through the shared bus too.
+
+ bus = I2CManager.shared().bus(1)                      # busio.I2C(board.SCL, board.SDA) the first time
+ bus = I2CManager.shared().bus(1, FakeI2C({...}))      # Fake backend (Mfakebus) for testing without a Pi
+ config, conversion = bus.read_registers(0x48, (1, 0))
+
+'''
+
+import logging, threading
+from time import perf_counter
+
+class I2CBus:
+    ''' One shared bus. Fair (FIFO) re-entrant lock and per address accounting '''
+
+    def __init__(self, backend, name='i2c1'):
+        self.backend = backend
+        self.name = name
+        self._turn = threading.Condition()
+        self._tickets = 0     # Next ticket handed out
+        self._serving = 0     # Ticket that owns the bus
+        self._owner = None    # Thread holding the bus
+        self._depth = 0
+        self._held = 0.0      # perf_counter() the bus was taken
+        self._waited = 0.0
+        self._address = None  # Last address used in the current hold
+        self.accounting = {}  # address -> [transactions, busy s, wait s]
+
+    def acquire(self):
+        me = threading.get_ident()
+        if self._owner == me:
+            self._depth += 1
+            return
+        t0 = perf_counter()
+        with self._turn:
+            ticket = self._tickets
+            self._tickets += 1
+            while ticket != self._serving:
+                self._turn.wait()
+            self._owner = me
+        self._depth = 1
+        self._held = perf_counter()
+        self._waited = self._held - t0
+        self._address = None
+
+    def release(self):
+        self._depth -= 1
+        if self._depth:
+            return
+        if self._address is not None:
+            account = self.accounting.setdefault(self._address, [0, 0.0, 0.0])
+            account[1] += perf_counter() - self._held
+            account[2] += self._waited
+        with self._turn:
+            self._owner = None
+            self._serving += 1
+            self._turn.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def try_lock(self):
+        ''' Waits for this thread's turn. Always True '''
+        self.acquire()
+        return True
+
+    def unlock(self):
+        self.release()
+
+    def _count(self, address):
+        self._address = address
+        account = self.accounting.setdefault(address, [0, 0.0, 0.0])
+        account[0] += 1
+
+    def scan(self):
+        with self:
+            return self.backend.scan()
+
+    def writeto(self, address, buffer, **kwargs):
+        with self:
+            self._count(address)
+            self.backend.writeto(address, buffer, **kwargs)
+
+    def readfrom_into(self, address, buffer, **kwargs):
+        with self:
+            self._count(address)
+            self.backend.readfrom_into(address, buffer, **kwargs)
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, **kwargs):
+        with self:
+            self._count(address)
+            self.backend.writeto_then_readfrom(address, buffer_out, buffer_in, **kwargs)
+
+    def read_registers(self, address, registers, size=2, autoincrement=False):
+        ''' Read each register (size bytes) of address in one turn on the bus. Returns a list of bytearrays '''
+        results = []
+        with self:
+            if autoincrement:   # Runs of consecutive registers in one transfer
+                first = 0
+                while first < len(registers):
+                    last = first
+                    while last + 1 < len(registers) and registers[last + 1] == registers[last] + 1:
+                        last += 1
+                    buffer = bytearray(size * (last - first + 1))
+                    self.writeto_then_readfrom(address, bytes([registers[first]]), buffer)
+                    results.extend(buffer[k:k + size] for k in range(0, len(buffer), size))
+                    first = last + 1
+            else:
+                for register in registers:
+                    buffer = bytearray(size)
+                    self.writeto_then_readfrom(address, bytes([register]), buffer)
+                    results.append(buffer)
+        return results
+
+    def write_register(self, address, register, data):
+        self.writeto(address, bytes([register]) + bytes(data))
+
+    def stats(self):
+        ''' {address: {'transactions', 'busy', 'wait'}} busy and wait in seconds '''
+        return {address: dict(transactions=account[0], busy=account[1], wait=account[2]) for address, account in self.accounting.items()}
+
+    def deinit(self):
+        self.backend.deinit()
+
+class RegisterDevice:
+    ''' Adafruit_GPIO.I2C.Device methods for one address on a shared I2CBus '''
+
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+
+    def writeList(self, register, data):
+        self.bus.write_register(self.address, register, data)
+
+    def write8(self, register, value):
+        self.bus.write_register(self.address, register, [value & 0xFF])
+
+    def readList(self, register, length):
+        buffer = bytearray(length)
+        self.bus.writeto_then_readfrom(self.address, bytes([register]), buffer)
+        return buffer
+
+    def readU8(self, register):
+        return self.readList(register, 1)[0]
+
+    def readU16BE(self, register):
+        data = self.readList(register, 2)
+        return (data[0] << 8) | data[1]
+
+    def readS16BE(self, register):
+        value = self.readU16BE(register)
+        return value - (1 << 16) if value & 0x8000 else value
+
+class I2CManager:
+    ''' One I2CBus per bus number for the whole process '''
+    _shared = None
+
+    def __init__(self, logger=None):
+        if logger is not None:                        # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        self.buses = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def bus(self, number=1, backend=None):
+        ''' Handle for bus number. backend is only used the first time (default busio.I2C on the Pi header pins for bus 1) '''
+        with self._lock:
+            if number not in self.buses:
+                if backend is None:
+                    if number != 1:
+                        raise ValueError("Pass a backend for I2C bus {0}".format(number))
+                    import busio, board
+                    backend = busio.I2C(board.SCL, board.SDA)
+                self.buses[number] = I2CBus(backend, 'i2c' + str(number))
+                self.logger.info("Shared I2C bus {0} using {1}".format(number, type(backend).__name__))
+            return self.buses[number]
+
+    def stats(self):
+        return {bus.name: bus.stats() for bus in self.buses.values()}
+
+if __name__ == "__main__":
+    try:
+        from .Mfakebus import FakeI2C, FakeADS1115
+    except ImportError:
+        from Mfakebus import FakeI2C, FakeADS1115
+    from time import sleep
+    logging.basicConfig(level=logging.INFO)
+    bus = I2CManager.shared().bus(1, FakeI2C({0x48: FakeADS1115([1.0, 2.0]), 0x49: FakeADS1115([3.0])}))
+    order = []
+    start = threading.Barrier(2)
+    def reader(address, n):
+        start.wait()
+        for x in range(n):
+            with bus:
+                order.append(address)
+                bus.read_registers(address, (1, 0))
+                sleep(0.0005)   # Bus time of a real transfer
+    threads = [threading.Thread(target=reader, args=(address, 200)) for address in (0x48, 0x49)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    switches = sum(a != b for a, b in zip(order, order[1:]))
+    logging.info("turns {0} switches between devices {1}".format(len(order), switches))
+    logging.info(I2CManager.shared().stats())
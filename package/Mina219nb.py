@@ -0,0 +1,115 @@
+'''
+Non-blocking INA219 reader. getdata() never waits for a conversion: it reads the bus voltage
+register (one 2 byte read), and only when its CNVR (conversion ready) bit is set reads the shunt,
+current and power registers in one turn on the shared bus (see Mi2cbus). Reading power clears
+CNVR. Otherwise it returns the cached reading with its age, so a poll costs one short transfer
+even at 128 sample averaging (68ms per conversion).
+
+ mode='triggered'  - Each fresh result triggers the next conversion (config write). The chip idles in between
+ mode='continuous' - The chip converts all the time. getdata() picks up the latest result
+
+ADC resolution/averaging of the bus and shunt ADCs trades latency for precision
+ ADC_9BIT 84us, ADC_10BIT 148us, ADC_11BIT 276us, ADC_12BIT 532us
+ ADC_2SAMP 1.06ms, ADC_4SAMP 2.13ms, ADC_8SAMP 4.26ms, ADC_16SAMP 8.51ms, ADC_32SAMP 17.02ms,
+ ADC_64SAMP 34.05ms, ADC_128SAMP 68.10ms (all 12 bit)
+
+Payload keys are the PiINA219 keys plus agekey (seconds since the reading was converted)
+
+ reader = INA219Reader(I2CManager.shared().bus(1), 0x40, maxA=0.4, busadc=ADC_12BIT, shuntadc=ADC_128SAMP)
+ ina = PiINA219('Vbusf', 'IbusAf', 'PowerWf', "auto", 0.4, 0x40, nonblocking=dict(shuntadc=ADC_128SAMP))
+
+'''
+
+import logging
+from time import monotonic
+
+ADC_9BIT, ADC_10BIT, ADC_11BIT, ADC_12BIT = 0, 1, 2, 3
+ADC_2SAMP, ADC_4SAMP, ADC_8SAMP, ADC_16SAMP, ADC_32SAMP, ADC_64SAMP, ADC_128SAMP = 9, 10, 11, 12, 13, 14, 15
+CONVERSION_US = {0: 84, 1: 148, 2: 276, 3: 532, 9: 1060, 10: 2130, 11: 4260, 12: 8510, 13: 17020, 14: 34050, 15: 68100}
+
+class INA219Reader:
+    ''' Register level INA219 reads that return right away '''
+    REG_CONFIG, REG_SHUNT, REG_BUS, REG_POWER, REG_CURRENT, REG_CALIBRATION = range(6)
+    MODE_TRIGGERED = 0b011   # Shunt and bus, triggered
+    MODE_CONTINUOUS = 0b111  # Shunt and bus, continuous
+
+    def __init__(self, bus, address=0x40, shunt_ohms=0.1, maxA=0.4, busadc=ADC_12BIT, shuntadc=ADC_12BIT, mode='triggered', gain=None,
+                 voltkey='Vbusf', currentkey='IbusAf', powerkey='PowerWf', agekey='Agef', logger=None):
+        ''' gain 0-3 is the shunt range 40mV << gain. None picks the smallest range for maxA '''
+        if logger is not None:                        # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        self.bus = bus
+        self.address = address
+        self.triggered = mode == 'triggered'
+        self.voltkey, self.currentkey, self.powerkey, self.agekey = voltkey, currentkey, powerkey, agekey
+        if gain is None:
+            gain = next((pg for pg in range(4) if maxA * shunt_ohms <= 0.04 * (1 << pg)), 3)   # Smallest shunt range for maxA
+        self.current_lsb = max(maxA / 32768, 0.04096 / (0xFFFE * shunt_ohms))   # Calibration register max is 0xFFFE. Small maxA gets the finest LSB it allows
+        self.power_lsb = 20 * self.current_lsb
+        self.calibration = int(0.04096 / (self.current_lsb * shunt_ohms))
+        self.config = (0 << 13) | (gain << 11) | (busadc << 7) | (shuntadc << 3) | (self.MODE_TRIGGERED if self.triggered else self.MODE_CONTINUOUS)   # 16V range
+        self.conversiontime = max(CONVERSION_US[busadc], CONVERSION_US[shuntadc]) / 1000000
+        self.setup()
+        self.outgoing = {}
+        self.tconverted = None   # monotonic() of the cached reading
+        self.fresh = 0           # Conversions read
+        self.logger.info("INA219 non-blocking {0} at {1} shunt range {2}mV conversion {3:.2f}ms".format(mode, hex(address), 40 << gain, self.conversiontime * 1000))
+
+    def _write(self, register, value):
+        self.bus.write_register(self.address, register, [(value >> 8) & 0xFF, value & 0xFF])
+
+    def setup(self):
+        ''' Write calibration and configuration (after power up or a reset) '''
+        self._write(self.REG_CALIBRATION, self.calibration)
+        self.trigger()
+
+    def trigger(self):
+        ''' Start a conversion (triggered) or restart continuous conversions '''
+        self._write(self.REG_CONFIG, self.config)
+        self.ttrigger = monotonic()
+
+    def getdata(self):
+        ''' Latest reading. Reads the result registers only when a new conversion is ready '''
+        now = monotonic()
+        busreg = self.bus.read_registers(self.address, (self.REG_BUS,))[0]
+        busraw = (busreg[0] << 8) | busreg[1]
+        if busraw & 0x02:   # CNVR
+            shunt, current, power = self.bus.read_registers(self.address, (self.REG_SHUNT, self.REG_CURRENT, self.REG_POWER))   # Power last, it clears CNVR
+            if self.triggered:
+                self.trigger()
+            self.tconverted = now - self.conversiontime / 2
+            self.fresh += 1
+            self.outgoing[self.voltkey] = (busraw >> 3) * 0.004
+            if busraw & 0x01:   # OVF. Current and power are not valid
+                self.logger.info("Current overflow")
+            else:
+                current = int.from_bytes(current, 'big', signed=True)
+                self.outgoing[self.currentkey] = float("{:.3f}".format(current * self.current_lsb))
+                self.outgoing[self.powerkey] = float("{:.2f}".format(int.from_bytes(power, 'big') * self.power_lsb))
+        elif self.triggered and now - self.ttrigger > 2 * self.conversiontime + 0.01:
+            self.trigger()   # Trigger lost (ie chip reset). Start again
+        if self.tconverted is not None:
+            self.outgoing[self.agekey] = now - self.tconverted
+        return self.outgoing
+
+if __name__ == "__main__":
+    import math
+    from time import sleep
+    try:
+        from .Mfakebus import FakeI2C, FakeINA219
+        from .Mi2cbus import I2CManager
+    except ImportError:
+        from Mfakebus import FakeI2C, FakeINA219
+        from Mi2cbus import I2CManager
+    logging.basicConfig(level=logging.INFO)
+    bus = I2CManager.shared().bus(1, FakeI2C({0x40: FakeINA219(lambda t: (5.0, 0.2 + 0.05 * math.sin(t)), noise=0.001)}))
+    reader = INA219Reader(bus, 0x40, shuntadc=ADC_128SAMP)
+    for n in range(20):
+        logging.info(reader.getdata())
+        sleep(0.02)   # 50Hz polls, 68ms conversions
+    logging.info("conversions read {0} of {1} polls. bus {2}".format(reader.fresh, 20, bus.stats()))
@@ -0,0 +1,89 @@
+'''
+Coordinated multi-axis moves for the steppers. Per axis deltas (steps) are turned into one
+event schedule where every tick has a speed code for every motor, so all axes start and finish
+together (lines, and arcs built from short lines).
+
+Axis i steps on tick k when floor((k+1)*|di|/N) > floor(k*|di|/N), with N the largest delta.
+This is integer (Bresenham) interpolation computed for the whole move at once. The dominant axis
+steps every tick and the others are spread evenly.
+With fullstep=True each tick is 2 steps. An odd delta leaves a half step, which is carried to the
+next line of the path and the one left at the end is a final half step tick, so the total is exact.
+
+The schedule is precomputed, so next_command() costs the same every tick no matter how long the
+move is. It has the same next_command() interface as Mstream.SegmentBuffer, so it can be set as
+StepperRunner stream (runner.stream = move), or called directly
+ move = CoordinatedMove([(400, 200)], delay=1.0)      # one line, 400 steps on motor 0, 200 on motor 1
+ command = move.next_command()
+ while command is not None:
+     motor.step(command)
+     command = move.next_command()
+
+'''
+
+import numpy as np
+
+def line_events(deltas, fullstep=False):
+    ''' Event schedule (ticks x axes) of speed codes for one straight move. With fullstep an odd delta ends with a half step tick '''
+    deltas = np.asarray(deltas, dtype=np.int64).reshape(-1)
+    size = 2 if fullstep else 1                         # steps per tick
+    counts = np.abs(deltas) // size
+    ticks = int(counts.max()) if len(counts) else 0
+    if ticks == 0:
+        events = np.zeros((0, len(counts)), dtype=np.int8)
+    else:
+        k = np.arange(ticks + 1)[:, None]
+        stepped = np.diff((k * counts) // ticks, axis=0).astype(bool)   # 1 where the axis steps on that tick
+        forward, reverse = (4, 0) if fullstep else (3, 1)
+        codes = np.where(deltas >= 0, forward, reverse).astype(np.int8)
+        events = np.where(stepped, codes, np.int8(2))
+    if fullstep and (deltas % 2).any():
+        events = np.concatenate([events, line_events(halfsteps(deltas))])
+    return events
+
+def halfsteps(deltas):
+    ''' The half step left over on each axis when deltas are made of full (2 step) steps '''
+    return np.sign(deltas) * (np.abs(deltas) % 2)
+
+def arc_deltas(radius, startangle, endangle, segments=32):
+    ''' Per segment (dx, dy) steps along an arc of radius from startangle to endangle (degrees, centre at -radius*(cos, sin) of startangle) '''
+    angles = np.radians(np.linspace(startangle, endangle, segments + 1))
+    x = np.rint(radius * np.cos(angles)).astype(np.int64)   # Round the absolute positions so error does not accumulate
+    y = np.rint(radius * np.sin(angles)).astype(np.int64)
+    return list(zip(np.diff(x).tolist(), np.diff(y).tolist()))
+
+class CoordinatedMove:
+    ''' Precomputed event schedule for a path of straight moves. next_command() returns controls for Stepper.step() '''
+
+    def __init__(self, path, delay=1.0, fullstep=False):
+        blocks, carry = [], 0
+        for deltas in path:
+            deltas = np.asarray(deltas, dtype=np.int64) + carry
+            if fullstep:   # Odd half steps move to the next line so they do not add a half step tick to every line
+                carry = halfsteps(deltas)
+                deltas = deltas - carry
+            blocks.append(line_events(deltas, fullstep))
+        if np.any(carry):
+            blocks.append(line_events(carry))   # Final half step
+        self.events = np.concatenate(blocks) if blocks else np.zeros((0, 0), dtype=np.int8)   # An empty path finishes on the first tick
+        self.numOfMotors = self.events.shape[1]
+        self.speed = self.events.tolist()    # Plain lists so each tick is a single slice copy
+        self.index = 0
+        self.command = {"delay":[delay, 0], "speed":[2] * self.numOfMotors, "mode":[0] * self.numOfMotors,
+                        "inverse":[False] * self.numOfMotors, "step":[0] * self.numOfMotors, "startstep":[0] * self.numOfMotors}
+
+    def remaining(self):
+        return len(self.speed) - self.index
+
+    def next_command(self):
+        ''' Controls for the next tick or None when the move is finished '''
+        if self.index >= len(self.speed):
+            return None
+        self.command["speed"][:] = self.speed[self.index]
+        self.index += 1
+        return self.command
+
+if __name__ == "__main__":
+    move = CoordinatedMove([(10, 4), (-3, 6)])
+    print(move.events.T)
+    print("net steps", (np.select([move.events == 3, move.events == 1], [1, -1], 0)).sum(axis=0))
+    print(arc_deltas(100, 0, 90, 8))
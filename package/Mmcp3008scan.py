@@ -0,0 +1,139 @@
+'''
+Multi-channel MCP3008 scan in one SPI transaction per chip. Every sample of every channel is one
+3 byte frame (start bit, SGL + channel, clock out) and all frames are packed into one buffer that
+goes to the kernel as a single SPI_IOC_MESSAGE ioctl. The kernel toggles chip select between
+frames (cs_change) so each frame is a separate conversion, but there is only one system call and
+no Python per sample. The reply is decoded for all channels and samples with NumPy in one step.
+
+Channels 0-7 are the chip on CE0 (spidev0.0) and channels 8-15 the chip on CE1 (spidev0.1).
+
+Values are the 10 bit result shifted to 16 bits (0-65535) so they match adafruit AnalogIn.value
+and the existing noise thresholds.
+
+ scan = MCP3008Scan([SpidevBus(0, 0), SpidevBus(0, 1)], channels=16, samples=10)
+ raw = scan.scan()          # (samples, channels) uint16 array
+ means = scan.averages()    # mean per channel
+
+The spidev driver limits one message to 511 transfers and bufsiz (4096) bytes, so larger scans
+are split into as few ioctls as fit.
+
+capture() records a block at a fixed sample rate for Mspectral. The rate is set in the kernel with
+delay_usecs after each frame, so sample timing does not depend on Python. There is a short gap
+(one system call) every 511 frames.
+ rate = scan.setup_capture(1024, 4000)   # actual rate after rounding the delay to whole us
+ scan.capture(block)                     # block is a (1024, channels) array
+
+'''
+
+import os, struct, fcntl
+import numpy as np
+from array import array
+
+SPI_IOC_WR_MODE = 0x40016b01          # _IOW('k', 1, __u8)
+SPI_IOC_WR_MAX_SPEED_HZ = 0x40046b04  # _IOW('k', 4, __u32)
+SPI_IOC_TRANSFER = struct.Struct('QQIIHBBBBBB')   # struct spi_ioc_transfer (32 bytes)
+
+def SPI_IOC_MESSAGE(n):
+    ''' _IOW('k', 0, char[n * sizeof(struct spi_ioc_transfer)]) '''
+    return 0x40000000 | ((n * SPI_IOC_TRANSFER.size) << 16) | (ord('k') << 8)
+
+class SpidevBus:
+    ''' /dev/spidev<bus>.<device> with one ioctl per transfer() call. Each framelen bytes is one chip select cycle '''
+    MAXTRANSFERS = 511
+    BUFSIZ = 4096
+
+    def __init__(self, bus=0, device=0, speed=1350000, mode=0):
+        self.fd = os.open('/dev/spidev{0}.{1}'.format(bus, device), os.O_RDWR)
+        fcntl.ioctl(self.fd, SPI_IOC_WR_MODE, struct.pack('B', mode))
+        fcntl.ioctl(self.fd, SPI_IOC_WR_MAX_SPEED_HZ, struct.pack('I', speed))
+        self.speed = speed
+        self.messages = {}   # (length, framelen, delay) -> (tx, rx, ioctl requests). Built once, reused every scan
+
+    def _prepare(self, length, framelen, delay_us):
+        tx = array('B', bytes(length))
+        rx = array('B', bytes(length))
+        txaddress, rxaddress = tx.buffer_info()[0], rx.buffer_info()[0]
+        perioctl = min(self.MAXTRANSFERS, self.BUFSIZ // framelen)
+        requests = []
+        frames = length // framelen
+        for first in range(0, frames, perioctl):
+            count = min(perioctl, frames - first)
+            message = bytearray().join(SPI_IOC_TRANSFER.pack(txaddress + (first + k) * framelen, rxaddress + (first + k) * framelen,
+                                                             framelen, self.speed, delay_us, 8, int(k < count - 1), 0, 0, 0, 0)   # cs_change between frames. Not on the last or CS stays asserted
+                                       for k in range(count))
+            requests.append((SPI_IOC_MESSAGE(count), message))   # Mutable so ioctl passes it in place (immutable args are limited to 1024 bytes)
+        return tx, rx, requests
+
+    def transfer(self, tx, framelen, delay_us=0):
+        ''' delay_us is the wait after each frame before chip select toggles '''
+        key = (len(tx), framelen, delay_us)
+        if key not in self.messages:
+            self.messages[key] = self._prepare(len(tx), framelen, delay_us)
+        txbuffer, rxbuffer, requests = self.messages[key]
+        txbuffer[:] = array('B', tx)
+        for request, message in requests:
+            fcntl.ioctl(self.fd, request, message)
+        return rxbuffer.tobytes()
+
+    def close(self):
+        os.close(self.fd)
+
+class MCP3008Scan:
+    ''' Read channels (1-16) x samples with one transfer per chip. spis[0] is CE0, spis[1] is CE1 '''
+    FRAME = 3
+
+    def __init__(self, spis, channels=8, samples=10):
+        if not 1 <= channels <= 8 * len(spis):
+            raise ValueError("channels must be 1-{0} with {1} chip(s)".format(8 * len(spis), len(spis)))
+        self.spis = spis
+        self.channels = channels
+        self.samples = samples
+        self.chips = []   # (spi, first channel, number of channels, command bytes)
+        for chip, spi in enumerate(spis):
+            count = min(8, channels - 8 * chip)
+            if count <= 0:
+                break
+            frames = [bytes([0x01, (0x08 | ch) << 4, 0x00]) for ch in range(count)]   # start bit, single ended + channel
+            self.chips.append((spi, 8 * chip, count, b''.join(frames) * samples))     # samples interleaved across channels
+        self.raw = np.zeros((samples, channels), dtype=np.uint16)
+        self.capturechips = []   # Same as chips with blocksize samples, set by setup_capture()
+        self.delay_us = 0
+
+    def scan(self):
+        ''' Latest (samples, channels) array of 16 bit scaled readings '''
+        for spi, first, count, command in self.chips:
+            frames = np.frombuffer(spi.transfer(command, self.FRAME), dtype=np.uint8).reshape(self.samples, count, self.FRAME)
+            self.raw[:, first:first + count] = (((frames[:, :, 1] & 0x03).astype(np.uint16) << 8) | frames[:, :, 2]) << 6
+        return self.raw
+
+    def setup_capture(self, blocksize, samplerate):
+        ''' Build the capture commands. Returns the sample rate the frame delay gives (Hz) '''
+        count = max(chip[2] for chip in self.chips)   # Frames per sample on the busiest chip
+        frametime = self.FRAME * 8 / self.spis[0].speed
+        self.delay_us = max(0, round(1000000 / (samplerate * count) - frametime * 1000000))
+        self.capturechips = [(spi, first, n, command[:n * self.FRAME] * blocksize) for spi, first, n, command in self.chips]
+        return 1 / (count * (frametime + self.delay_us / 1000000))
+
+    def capture(self, block):
+        ''' Fill block (blocksize, channels) with 16 bit scaled readings at the setup_capture() rate. Chips are captured one after the other '''
+        for spi, first, count, command in self.capturechips:
+            frames = np.frombuffer(spi.transfer(command, self.FRAME, self.delay_us), dtype=np.uint8).reshape(-1, count, self.FRAME)
+            block[:, first:first + count] = (((frames[:, :, 1] & 0x03).astype(np.uint16) << 8) | frames[:, :, 2]) << 6
+
+    def averages(self):
+        ''' Mean of the samples for each channel '''
+        return self.scan().mean(axis=0)
+
+    def close(self):
+        for spi in self.spis:
+            spi.close()
+
+if __name__ == "__main__":
+    try:
+        from .Mfakebus import FakeSPI, FakeMCP3008
+    except ImportError:
+        from Mfakebus import FakeSPI, FakeMCP3008
+    spis = [FakeSPI(FakeMCP3008([0.1 * ch for ch in range(8)])), FakeSPI(FakeMCP3008([3.3 - 0.1 * ch for ch in range(8)]))]
+    scan = MCP3008Scan(spis, channels=16, samples=10)
+    print((scan.averages() / 65536 * 3.3).round(3))
+    print("transfers", [spi.transactions for spi in spis], "conversions", [spi.frames for spi in spis])
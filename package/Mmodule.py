@@ -5,40 +5,139 @@ Data is simulated/created with random and numpy methods
 
 '''
 
-import logging, random
+import logging, random, threading
 import numpy as np
 from time import sleep, time, perf_counter_ns
 from dataclasses import dataclass
 from typing import List
+try:
+    from .Mplanner import MoveProfiles
+    from .Mgpioout import PinBank
+    from .Msystelemetry import SysTelemetry
+    from .Mtrace import TraceBuffer
+    from .Mads1115stream import ADS1115Stream
+    from .Mfakebus import FakeI2C, FakeADS1115, FakeSPI, FakeMCP3008, FakeINA219, FakeGPIO
+    from .Mmcp3008scan import MCP3008Scan
+    from .Mspectral import SpectralCapture
+    from .Mwindow import RunningStats
+    from .Madaptive import AdaptiveRate
+    from .Mcalibrate import noise_thresholds
+    from .Mi2cbus import I2CManager
+    from .Mina219nb import INA219Reader
+    from .Mrotary_encoder import QuadratureDecoder
+    from .Mmotion import EncoderMotion
+except ImportError:
+    from Mplanner import MoveProfiles
+    from Mgpioout import PinBank
+    from Msystelemetry import SysTelemetry
+    from Mtrace import TraceBuffer
+    from Mads1115stream import ADS1115Stream
+    from Mfakebus import FakeI2C, FakeADS1115, FakeSPI, FakeMCP3008, FakeINA219, FakeGPIO
+    from Mmcp3008scan import MCP3008Scan
+    from Mspectral import SpectralCapture
+    from Mwindow import RunningStats
+    from Madaptive import AdaptiveRate
+    from Mcalibrate import noise_thresholds
+    from Mi2cbus import I2CManager
+    from Mina219nb import INA219Reader
+    from Mrotary_encoder import QuadratureDecoder
+    from Mmotion import EncoderMotion
+
+# Coil patterns (HIGH pulses) for ULN2003 IN1,2,3,4 in half step order. Even phases are the two coil full step patterns.
+COILPHASES = ((1,0,0,1), (1,0,0,0), (1,1,0,0), (0,1,0,0), (0,1,1,0), (0,0,1,0), (0,0,1,1), (0,0,0,1))
+COILSTOP = (0,0,0,0)           # Speed 2 is hard coded as stop
+STEPDELTA = (-2, -1, 0, 1, 2)  # Step counter change for each speed. 0=fullstepCCW, 1=halfstepCCW, 2=stop, 3=halfstep CW, 4=fullstep CW
+
+def _nextphase(phase, speed, inverse):
+    ''' Phase index after one step. Full step snaps to the even (two coil) phases '''
+    move = STEPDELTA[speed] if not inverse else -STEPDELTA[speed]
+    if move == 2:
+        return ((phase & ~1) + 2) % 8
+    elif move == -2:
+        return (((phase + 1) & ~1) - 2) % 8
+    return (phase + move) % 8
+
+# Precomputed next phase lookup. PHASETABLE[inverse][speed][phase] -> phase
+PHASETABLE = tuple(tuple(tuple(_nextphase(phase, speed, inverse) for phase in range(8)) for speed in range(5)) for inverse in (False, True))
 
 @dataclass
 class StepperMotor:
     pins: list       # Pins connected to ULN2003 IN1,2,3,4
     step: int        # Counter to keep track of motor step (0-4076 in halfstep mode)
-    speed: list      # 0=fullstepCCW, 1=halfstepCCW, 2=stop, 3=halfstep CW, 4=fullstep CW
-    coils: dict      # Arrays to specify HIGH pulses sent to coils.
+    phase: int       # Index into COILPHASES for the current coil pattern
+    coils: tuple     # Coil pattern (HIGH pulses) sent to the pins on the last step
 
 @dataclass
 class Machine:
     stepper: List[StepperMotor]
 
+class StepDeadline:
+    ''' Step timing with absolute perf_counter_ns deadlines. Logic time and time spent outside step() do not add
+    to the step period. Sleeps until spinus before the deadline then spins. Lateness of each step is kept in a ring buffer '''
+
+    def __init__(self, spinus=200, window=500, maxlagms=20):
+        self.spinns = spinus * 1000          # Final microseconds are spun instead of slept (sleep wakes up late)
+        self.maxlagns = maxlagms * 1000000   # If further behind than this, resync instead of bursting steps to catch up
+        self.deadline = None
+        self.late = [0] * window             # Ring buffer of lateness (ns) per step
+        self.index = 0
+        self.count = 0
+        self.resyncs = 0
+
+    def wait(self, periodns):
+        ''' Wait for the next step deadline (previous deadline + period) '''
+        now = perf_counter_ns()
+        if self.deadline is None:
+            self.deadline = now + periodns
+        else:
+            self.deadline += periodns
+            if now - self.deadline > self.maxlagns:
+                self.deadline = now
+                self.resyncs += 1
+        remaining = self.deadline - now
+        if remaining > self.spinns:
+            sleep((remaining - self.spinns) / 1000000000)
+        while perf_counter_ns() < self.deadline:
+            pass
+        self.late[self.index] = perf_counter_ns() - self.deadline
+        self.index = (self.index + 1) % len(self.late)
+        self.count += 1
+
+    def reset(self):
+        self.deadline = None
+
+    def stats(self):
+        ''' Return mean, standard deviation (jitter) and max lateness in microseconds '''
+        n = min(self.count, len(self.late))
+        if n == 0:
+            return 0.0, 0.0, 0.0
+        late = self.late[:n] if n < len(self.late) else self.late
+        mean = sum(late) / n
+        jitter = (sum((x - mean) ** 2 for x in late) / n) ** 0.5
+        return mean / 1000, jitter / 1000, max(late) / 1000
+
 class Stepper:   # command comes from node-red GUI
     def __init__(self, *args, **kwargs):
         
-        for key, value in kwargs.items():
-            if key == 'logger':
-                self.logger = kwargs[key]   #  Use logger passed as argument
-            elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
-                logging.basicConfig(level=logging.INFO)      # Create root logger
-                self.logger = logging.getLogger(__name__)    # Create from root logger
-            else:                                          # Root logger already exists and no custom logger passed
-                self.logger = logging.getLogger(__name__)    # Create from root logger
+        logger = kwargs.get('logger')
+        if logger is not None:                         # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        # timing='sleep' pauses delay after the coil logic. timing='deadline' keeps a steady step period (StepDeadline)
+        self.deadline = StepDeadline() if kwargs.get('timing', 'sleep') == 'deadline' else None
         self.FULLREVOLUTION = 4076    # Steps per revolution
         motorpins = args
         motors = []
         for pinlist in motorpins:
-            motors.append(StepperMotor(pinlist, 0, [0,0,0,0,0], {"Harr1":[0,1], "Farr1":[0,1], "arr2":[0,1], "arr3":[0,1], "HarrOUT":[0,1], "FarrOUT":[0,1]}))
+            motors.append(StepperMotor(pinlist, 0, 6, COILSTOP))   # Start at phase 6 [0,0,1,1]
         self.mach = Machine(motors)
+        self.profiles = MoveProfiles(len(motors))   # Acceleration delay tables for mode 1 moves (see Mplanner)
+        # output=RPiGPIOBackend()/RegisterBackend()/RecorderBackend() sends all coils in one write per step (see Mgpioout)
+        self.output = PinBank(motorpins, COILPHASES, kwargs['output']) if kwargs.get('output') is not None else None
         # Setup and initialize motor parameters
         #GPIO.setmode(GPIO.BCM)
         self.startstepping = []     # Flag sent from nodered dashboard to start stepping in increment mode
@@ -52,9 +151,17 @@ class Stepper:   # command comes from node-red GUI
         self.timens = []  # monitor how long each motor loop takes (coil logic only)
         self.timems = [] # monitor how long each motor loop takes (coil logic + delay)
         self.outgoing = {}
+        self.telemetry = kwargs.get('telemetry') or SysTelemetry.shared()   # cpufreq from cached sysfs descriptors
+        self.trace = kwargs.get('trace')   # Optional Mtrace.TraceBuffer. Step events are recorded there instead of formatted debug logs
+        if self.trace is not None:
+            self.EV_MODE1 = self.trace.register("1:MODE1      - Motor:{0} startstep:{1} machStep:{2} targetstep:{3}")
+            self.EV_STRTSTP = self.trace.register("2:STRTSTP ON - Motor:{0} machStep:{2} targetstep:{3}")
+            self.EV_STEPPING = self.trace.register("3:STEPPING   - Motor:{0} machStep:{2} targetstep:{3}")
+            self.EV_DONE = self.trace.register("4:DONE-M1OFF - Motor:{0} machStep:{2} targetstep:{3}")
+            self.EV_STEP = self.trace.register("Motor:{0} Steps:{1} speed:{2} phase:{3}")
+            self.EV_FULLREV = self.trace.register("FULL REVOLUTION -- Motor:{0} Steps:{1}")
         
         for i in range(len(self.mach.stepper)):          # Setup each stepper motor
-            self.mach.stepper[i].speed[2] = [0,0,0,0]    # Speed 2 is hard coded as stop
             self.reportsteps[1].append(0)
             self.startstepping.append(False)  
             self.targetstep.append(291)         
@@ -63,11 +170,6 @@ class Stepper:   # command comes from node-red GUI
             self.rpm.append(0)
             self.timens.append(perf_counter_ns())
             self.timems.append(perf_counter_ns())
-            for rotation in range(2):        # Setup starting array for each rotation (CW,CCW) and H-half/F-full step
-                self.mach.stepper[i].coils["Harr1"][rotation] = [0,0,1,1]
-                self.mach.stepper[i].coils["Farr1"][rotation] = [0,0,1,1]
-                self.mach.stepper[i].coils["arr2"][rotation] = [0,0,0,1]
-                self.mach.stepper[i].coils["arr3"][rotation] = [0,0,1,0]
             for pin in self.mach.stepper[i].pins:        # Setup each pin in each stepper
                 #GPIO.setup(pin,GPIO.OUT)
                 self.logger.info("pin {0} Setup".format(pin))
@@ -76,44 +178,14 @@ class Stepper:   # command comes from node-red GUI
         ''' LOOP THRU EACH STEPPER AND THE TWO ROTATIONS (CW/CCW) AND SEND COIL ARRAY (HIGH PULSES) '''
         self.command = incomingD
         self.delay = self.command["delay"][0]        # First delay is half step loop pause. Second value is add-on for full step.
+        setmask = 0                                  # HIGH pins for all motors, sent in one write after the loop
+        trace = self.trace
         for i in range(len(self.mach.stepper)):   # Loop thru each stepper
             self.timens[i] = perf_counter_ns() # time counter for monitoring how long the loop takes
+            motor = self.mach.stepper[i]
             stepspeed = self.command["speed"][i]         # stepspeed is a temporary variable for this loop
-            if stepspeed > 2:
-                rotation = 0 if self.command["inverse"][i] else 1
-            elif stepspeed < 2:
-                rotation = 1 if self.command["inverse"][i] else 0
-                
-            if stepspeed == 3 or stepspeed == 1:  # Half step calculation
-                if rotation == 1:            # H is for half-step. Do array rotation (slicing) by 1 place to the right for CW
-                    self.mach.stepper[i].coils["HarrOUT"][rotation] = self.mach.stepper[i].coils["Harr1"][rotation][-1:] + self.mach.stepper[i].coils["Harr1"][rotation][:-1]
-                    self.mach.stepper[i].coils["Harr1"][rotation] = self.mach.stepper[i].coils["arr2"][rotation]
-                    self.mach.stepper[i].coils["arr2"][rotation] = self.mach.stepper[i].coils["HarrOUT"][rotation]
-                else:                        # Array rotation (slicing) 1 place to the left for CCW. And use arr3
-                    self.mach.stepper[i].coils["HarrOUT"][rotation] = self.mach.stepper[i].coils["Harr1"][rotation][1:] + self.mach.stepper[i].coils["Harr1"][rotation][:1]
-                    self.mach.stepper[i].coils["Harr1"][rotation] = self.mach.stepper[i].coils["arr3"][rotation]
-                    self.mach.stepper[i].coils["arr3"][rotation] = self.mach.stepper[i].coils["HarrOUT"][rotation]
-            if stepspeed == 4 or stepspeed == 0:  # Full step calculation          
+            if stepspeed == 4 or stepspeed == 0:  # Full step
                 self.delay = self.command["delay"][0] + self.command["delay"][1] # Add extra delay for full step
-                if rotation == 1:            # F is for full-step. Do array rotation (slicing) by 1 place to the right for CW
-                    self.mach.stepper[i].coils["FarrOUT"][rotation] = self.mach.stepper[i].coils["Farr1"][rotation][-1:] + self.mach.stepper[i].coils["Farr1"][rotation][:-1]
-                    self.mach.stepper[i].coils["Farr1"][rotation] = self.mach.stepper[i].coils["FarrOUT"][rotation]
-                else:                        # Array rotation (slicing) 1 place to the left for CCW 
-                    self.mach.stepper[i].coils["FarrOUT"][rotation] = self.mach.stepper[i].coils["Farr1"][rotation][1:] + self.mach.stepper[i].coils["Farr1"][rotation][:1]
-                    self.mach.stepper[i].coils["Farr1"][rotation] = self.mach.stepper[i].coils["FarrOUT"][rotation]
-            
-            # Now that coil array updated set the 4 available speeds/direction. Half step CW & CCW. Full step CW & CCW.
-            if not self.command["inverse"][i]: # Normal rotation pattern. speed 3/4=rot1(CW). speed 0/1=rot0 (CCW). 
-                self.mach.stepper[i].speed[0] = self.mach.stepper[i].coils["FarrOUT"][0]
-                self.mach.stepper[i].speed[1] = self.mach.stepper[i].coils["HarrOUT"][0]
-                self.mach.stepper[i].speed[3] = self.mach.stepper[i].coils["HarrOUT"][1]
-                self.mach.stepper[i].speed[4] = self.mach.stepper[i].coils["FarrOUT"][1]
-            elif self.command["inverse"][i]:  # Inverse rotation pattern. speed 3/4=rot0(CCW). speed 0/1=rot1 (CW). 
-                self.mach.stepper[i].speed[0] = self.mach.stepper[i].coils["FarrOUT"][1]
-                self.mach.stepper[i].speed[1] = self.mach.stepper[i].coils["HarrOUT"][1]
-                self.mach.stepper[i].speed[3] = self.mach.stepper[i].coils["HarrOUT"][0]
-                self.mach.stepper[i].speed[4] = self.mach.stepper[i].coils["FarrOUT"][0]
-            
 
             # If mode is 1 (incremental stepping) and startstep has been flagged from node-red gui then startstepping
             if self.command["mode"][i] == 1 and stepspeed != 2 and self.command["startstep"][i] == 1:
@@ -128,37 +200,57 @@ class Stepper:   # command comes from node-red GUI
                     self.targetstep[i] = self.mach.stepper[i].step - self.command["step"][i]
                     if self.targetstep[i] < (self.FULLREVOLUTION * -1):
                         self.targetstep[i] = (self.FULLREVOLUTION * -1)
-                self.logger.debug("2:STRTSTP ON - Motor:{0} Mode:{1} startstep:{2} startstepping:{3} machStep:{4} targetstep:{5}".format(i, self.command["mode"][i], self.command["startstep"][i], self.startstepping[i], self.mach.stepper[i].step, self.targetstep[i]))
+                self.profiles.start(i, self.command, self.targetstep[i] - motor.step, 2 if stepspeed in (0, 4) else 1)
+                if trace is not None: trace.record(self.EV_STRTSTP, i, 0, motor.step, self.targetstep[i])
             
             # Mode set to 1 (incremental stepping) but haven't started stepping. Stop motor (stepspeed=2) and set the target step (based on node-red gui)
             # Will wait until startstep flag is sent from node-red GUI before starting motor
             if self.command["mode"][i] == 1 and not self.startstepping[i]:
                 stepspeed = 2
                 self.command["speed"][i] = 2
-                self.logger.debug("1:MODE1      - Motor:{0} Mode:{1} startstep:{2} startstepping:{3} machStep:{4} targetstep:{5}".format(i, self.command["mode"][i], self.command["startstep"][i], self.startstepping[i], self.mach.stepper[i].step, self.targetstep[i]))
+                if trace is not None: trace.record(self.EV_MODE1, i, self.command["startstep"][i], motor.step, self.targetstep[i])
             
             # IN INCREMENT MODE1. Keep stepping until the target step is met. Then reset the startstepping/startstep(nodered) flags.
             elif self.command["mode"][i] == 1 and self.startstepping[i]:
-                self.logger.debug("3:STEPPING   - Motor:{0} Mode:{1} startstep:{2} startstepping:{3} machStep:{4} targetstep:{5}".format(i, self.command["mode"][i], self.command["startstep"][i], self.startstepping[i], self.mach.stepper[i].step, self.targetstep[i]))
+                if trace is not None: trace.record(self.EV_STEPPING, i, 0, motor.step, self.targetstep[i])
                 if abs((abs(self.mach.stepper[i].step) - abs(self.targetstep[i]))) < 2: # if delta is less than 2 then target met. Can't use 0 since full step increments by 2
-                    self.logger.debug("4:DONE-M1OFF - Motor:{0} Mode:{1} startstep:{2} startstepping:{3} machStep:{4} targetstep:{5}".format(i, self.command["mode"][i], self.command["startstep"][i], self.startstepping[i], self.mach.stepper[i].step, self.targetstep[i]))
+                    if trace is not None: trace.record(self.EV_DONE, i, 0, motor.step, self.targetstep[i])
                     self.startstepping[i] = False
+                    self.profiles.stop(i)
                     #command["startstep"][i] = 0
-
-            # SEND COIL ARRAY (HIGH PULSES) TO GPIO PINS AND UPDATE STEP COUNTER
-            #GPIO.output(self.mach.stepper[i].pins, self.mach.stepper[i].speed[stepspeed]) # output the coil array (speed/direction) to the GPIO pins.
-            self.logger.debug("Motor:{0} Steps:{1} Mode:{2} startstepping:{3} coils:{4}".format(i, self.mach.stepper[i].step, self.command["mode"][i], self.startstepping[i], self.mach.stepper[i].speed[stepspeed]))
-            self.mach.stepper[i].step = self.stepupdate(stepspeed, self.mach.stepper[i].step)  # update the motor step based on direction and half vs full step
+            elif self.profiles.table[i] is not None:   # Left mode 1 during a profiled move
+                self.profiles.stop(i)
+
+            # ADVANCE PHASE INDEX (lookup table handles half/full step, CW/CCW and inverse). Stop sends no HIGH pulses.
+            if stepspeed != 2:
+                motor.phase = PHASETABLE[bool(self.command["inverse"][i])][stepspeed][motor.phase]
+                motor.coils = COILPHASES[motor.phase]
+                if self.output is not None:
+                    setmask |= self.output.phasemask[i][motor.phase]
+            else:
+                motor.coils = COILSTOP
+
+            # ADD COIL ARRAY (HIGH PULSES) TO THE PIN MASK AND UPDATE STEP COUNTER
+            if trace is not None: trace.record(self.EV_STEP, i, motor.step, stepspeed, motor.phase)
+            motor.step += STEPDELTA[stepspeed]  # update the motor step based on direction and half vs full step
             
             # IF FULL REVOLUTION - reset the step counter
             if (abs(self.mach.stepper[i].step) > self.FULLREVOLUTION):  # If hit full revolution reset the step counter. If want to step past full revolution would need to later add a 'not startstepping'
-                self.logger.debug("FULL REVOLUTION -- Motor:{0} Steps:{1} Mode:{2} startstepping:{3} coils:{4}".format(i, self.mach.stepper[i].step, self.command["mode"][i], self.startstepping[i], self.mach.stepper[i].speed[self.command["speed"][i]]))
+                if trace is not None: trace.record(self.EV_FULLREV, i, motor.step)
                 self.mach.stepper[i].step = 0
             
             # Timers to monitor how long the loops is taking
             self.timens[i] = perf_counter_ns() - self.timens[i]
             self.timems[i] = (self.timens[i]/1000000) + self.delay
-        sleep(float(self.delay/1000))  # delay can be updated from node-red gui. Needs optimal setting for the motors.
+        if self.output is not None:
+            self.output.write(setmask)   # output the coil arrays for every motor to the GPIO pins in one write
+        profiledelay = self.profiles.delay()   # Mode 1 moves with accel follow their delay table instead of the fixed delay
+        if profiledelay is not None:
+            self.delay = profiledelay
+        if self.deadline is not None:
+            self.deadline.wait(int(self.delay * 1000000))  # step period is delay, independent of logic and main loop time
+        else:
+            sleep(float(self.delay/1000))  # delay can be updated from node-red gui. Needs optimal setting for the motors.
 
     def getdata(self):
         ''' RETURN MOTOR DATA INCLUDING STEPS, RPMS, ETC '''
@@ -172,9 +264,10 @@ class Stepper:   # command comes from node-red GUI
             self.outgoing['rpm'+ str(i) + 'f'] = self.rpm[i]
             self.outgoing['looptime'+ str(i) + 'f'] = self.timems[i]
             self.outgoing['speed'+ str(i) + 'i'] = self.command["speed"][i]
+        if self.deadline is not None:   # Step lateness (us) when using deadline timing
+            self.outgoing['latemeanf'], self.outgoing['jitterf'], self.outgoing['latemaxf'] = self.deadline.stats()
         self.outgoing['delayf'] = self.delay
-        f0 = open("/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq")
-        self.outgoing['cpufreq0i'] = int(int(f0.read()) / 1000)
+        self.telemetry.merge(self.outgoing, ('cpufreq0i',))
         return self.outgoing
 
     def resetsteps(self):
@@ -182,18 +275,8 @@ class Stepper:   # command comes from node-red GUI
             self.mach.stepper[i].step = 0
 
     def stepupdate(self, spd, stp):
-        ''' Will update the motor step counter based on full vs half speed and CW vs CCW. Details in Stepper Class'''
-        if spd == 4:
-            stp += 2
-        elif spd ==3:
-            stp += 1
-        elif spd == 1:
-            stp -= 1
-        elif spd == 0:
-            stp -= 2
-        else:
-            stp = stp
-        return stp
+        ''' Will update the motor step counter based on full vs half speed and CW vs CCW. Details in STEPDELTA'''
+        return stp + STEPDELTA[spd]
 
 class ServoKit:
     def __init__(self, address, channels):
@@ -204,7 +287,9 @@ class ServoKit:
         self.angle = angle
         
 class RotaryEncoder:
-    def __init__(self, clkPin, dtPin, button, key1='RotEncCi', key2='RotEncBi', logger=None):
+    ''' interrupt=True decodes edges from a FakeGPIO knob that a background thread turns at random. False returns random counts.
+    motion=dict() for coalesced payloads with velocity and acceleration (Mmotion, needs interrupt) '''
+    def __init__(self, clkPin, dtPin, button, key1='RotEncCi', key2='RotEncBi', logger=None, interrupt=True, motion=None):
         self.clkPin = clkPin
         self.dtPin = dtPin
         self.button = button
@@ -224,8 +309,53 @@ class RotaryEncoder:
         self.logger.info('Rotary Encoder pins- clk:{0} data:{1} button:{2}'.format(self.clkPin, self.dtPin, self.button))
         self.testcounter = np.arange(-10, 10, 0.5).tolist()
         self.testbutton = [0,0,1]
+        self.decoder = None
+        self.motion = None
+        self.presses = 0
+        if interrupt:
+            self.gpio = FakeGPIO()
+            for pin in (clkPin, dtPin, button):
+                self.gpio.setup(pin, self.gpio.IN, pull_up_down=self.gpio.PUD_DOWN)
+            self.gpio.add_event_detect(button, self.gpio.BOTH, callback=self._button_callback)
+            if motion is not None:
+                self.motion = EncoderMotion(prefix=key1[:-2] if key1.endswith('Ci') else key1, **motion)
+            self.decoder = QuadratureDecoder(self.gpio, clkPin, dtPin, motion=self.motion)
+            self.knob = threading.Thread(target=self._turnknob, name='fakeknob', daemon=True)
+            self.knob.start()
+
+    def _turnknob(self):
+        ''' Random turns with contact bounce, 1-20ms between edges. Now and then a button press '''
+        while True:
+            sleep(random.uniform(0.2, 2))
+            self.gpio.turn(self.clkPin, self.dtPin, random.choice([-3, -2, -1, 1, 2, 3]), bounce=random.choice([0, 0, 1, 2]), delay=random.uniform(0.001, 0.02))
+            if random.random() < 0.1:
+                self.gpio.set(self.button, 1)
+                sleep(0.1)
+                self.gpio.set(self.button, 0)
+
+    def _button_callback(self, channel):
+        self.buttonpressed = True
+        if self.gpio.input(self.button):
+            self.presses += 1
 
     def getdata(self):
+        if self.motion is not None:
+            with self.decoder.lock:
+                outgoing = self.motion.report(self.decoder.position, self.gpio.input(self.button), self.presses)
+            self.buttonpressed = False
+            if outgoing is not None:
+                self.logger.debug(outgoing)
+            return outgoing
+        if self.decoder is not None:
+            position, quarters = self.decoder.read()
+            if position != self.counter or self.buttonpressed:
+                self.counter = position
+                self.buttonpressed = False
+                self.outgoing[self.og_counter] = self.counter
+                self.outgoing[self.og_button] = self.gpio.input(self.button)
+                self.logger.debug(self.outgoing)
+                return self.outgoing
+            return None
         self.counter = random.choice(self.testcounter)
         buttonstate = random.choice(self.testbutton)
         if self._is_integer(self.counter):
@@ -255,8 +385,10 @@ class RotaryEncoder:
 
 class PiINA219:
 
-    def __init__(self, voltkey='Vbusf', currentkey='IbusAf', powerkey='PowerWf', gainmode="auto", maxA = 0.4, address=0x40, logger=None): 
+    def __init__(self, voltkey='Vbusf', currentkey='IbusAf', powerkey='PowerWf', gainmode="auto", maxA = 0.4, address=0x40, logger=None, filters=None, nonblocking=None): 
+        ''' nonblocking=dict() reads a fake INA219 on the shared fake I2C bus through Mina219nb.INA219Reader '''
         self.SHUNT_OHMS = 0.1
+        self.filters = filters if filters is not None else {}   # data key -> Mfilter.Pipeline
         self.voltkey = voltkey
         self.currentkey = currentkey
         self.powerkey = powerkey
@@ -274,21 +406,39 @@ class PiINA219:
             #self.ina219.configure(self.ina219.RANGE_16V)
         #elif gainmode == "manual":  # MANUAL GAIN, HIGH RESOLUTION - Max amps is 400mA
             #self.ina219.configure(self.ina219.RANGE_16V, self.ina219.GAIN_1_40MV)
+        self.reader = None
+        if nonblocking is not None:
+            level = random.uniform(0.1, 0.3)
+            bus = I2CManager.shared().bus(1, FakeI2C())   # Shared fake bus. Each chip adds its model at its address
+            bus.backend.devices[address] = FakeINA219(lambda t: (5.0, level + 0.02 * np.sin(t)), self.SHUNT_OHMS, noise=0.001)
+            self.reader = INA219Reader(bus, address, self.SHUNT_OHMS, maxA, gain=0 if gainmode == "manual" else None,
+                                       voltkey=voltkey, currentkey=currentkey, powerkey=powerkey, logger=self.logger, **nonblocking)
+            self.outgoing = self.reader.outgoing
         self.logger.info('ina219 using I2C at address {0} setup with gain mode:{1} max Amps:{2}'.format(address, gainmode, maxA))
         #self.logger.info(self.ina219)
 
     def getdata(self):
-        self.outgoing[self.voltkey] =  float("%.2f"%random.uniform(0, 5))
-        self.outgoing[self.currentkey] = float("%.2f"%random.uniform(0, 1))
-        self.outgoing[self.powerkey] = float("%.2f"%(self.outgoing[self.voltkey] * self.outgoing[self.currentkey]))
+        fresh = True
+        if self.reader is not None:
+            conversions = self.reader.fresh
+            self.reader.getdata()   # Updates self.outgoing
+            fresh = self.reader.fresh != conversions   # Filter new conversions only, not the cached reading
+        else:
+            self.outgoing[self.voltkey] =  float("%.2f"%random.uniform(0, 5))
+            self.outgoing[self.currentkey] = float("%.2f"%random.uniform(0, 1))
+            self.outgoing[self.powerkey] = float("%.2f"%(self.outgoing[self.voltkey] * self.outgoing[self.currentkey]))
+        for key, pipeline in self.filters.items():
+            if fresh and key in self.outgoing and pipeline.update([self.outgoing[key]]) is not None:
+                self.outgoing[key] = float(pipeline.last[0])
         self.logger.debug('{0}, {1}, {2}'.format(self.address, self.outgoing.keys(), self.outgoing.values()))
         return self.outgoing
 
 class ads1115:
     ''' ADC using ADS1115 (I2C). Returns a list with voltage values '''
+    NOISE = 0.002   # Simulated noise sigma (V) of polled reads. Fixed so calibrating does not change it
     
-    def __init__(self, numOfChannels=1, noiseThreshold=0.001, maxInterval=1, usergain=1, useraddress=0x48, logger=None):
-        ''' Create I2C bus and initialize lists '''
+    def __init__(self, numOfChannels=1, noiseThreshold=0.001, maxInterval=1, usergain=1, useraddress=0x48, logger=None, trace=None, continuous=False, datarate=860, capture=None, filters=None, adaptive=None, calibration=None, name=None):
+        ''' Create I2C bus and initialize lists. continuous=True streams from a fake ADS1115 on a fake I2C bus. capture=dict() returns spectral features. filters=Mfilter.Pipeline. adaptive=dict() for Madaptive. calibration=Mcalibrate.NoiseCalibration saves under name (the device name) and the chip '''
         
         if logger is not None:                        # Use logger passed as argument
             self.logger = logger
@@ -299,7 +449,13 @@ class ads1115:
             self.logger = logging.getLogger(__name__)    # Create from root logger
         self.logger.info("ADS1115 using I2C at address {0}".format(str(useraddress)))
         self.numOfChannels = numOfChannels
-        self.noiseThreshold = noiseThreshold
+        self.name = ('' if name is None else name + '_') + 'ads1115_' + hex(useraddress)   # Calibration key
+        self.calibration = calibration
+        saved = calibration.load(self.name, numOfChannels) if calibration is not None else None
+        if saved is not None:
+            self.logger.info("ADS1115 using calibrated noise thresholds {0}".format(saved))
+            noiseThreshold = saved
+        self.noiseThreshold = list(noiseThreshold) if isinstance(noiseThreshold, (list, tuple)) else [noiseThreshold] * numOfChannels   # Per channel
         self.numOfSamples = 10        # Number of samples to average
         self.maxInterval = maxInterval  # interval in seconds to check for update
         self.time0 = time()   # time 0
@@ -308,32 +464,129 @@ class ads1115:
         self.sensorLastRead = [x for x in range(self.numOfChannels)]
         self.adcValue = [x for x in range(self.numOfChannels)]
         self.adc = {}
-        self.sensor = [[x for x in range(0, self.numOfSamples)] for x in range(0, self.numOfChannels)]
+        self.window = [RunningStats(self.numOfSamples) for x in range(self.numOfChannels)]   # Sliding window, one new sample per getdata
         self.sensorChanged = False
         self.timelimit = False
+        self.trace = trace   # Optional Mtrace.TraceBuffer for per channel reads
+        if self.trace is not None:
+            self.EV_READ = self.trace.register("ads1115 changed: {1} chan: {0} value: {4:1.3f} previously: {5:1.3f}")
+        self.stream = None
+        self.capture = None
+        if continuous or capture is not None:
+            levels = [random.uniform(0, 4) for x in range(4)]
+            bus = I2CManager.shared().bus(1, FakeI2C())   # Shared fake bus. Each chip adds its model at its address
+            bus.backend.devices[useraddress] = FakeADS1115(lambda ch, t: levels[ch] + 0.05 * np.sin(2 * np.pi * (30 + 20 * ch) * t), noise=0.002)   # Level with a small vibration per channel
+            blocksize = capture.get('blocksize', 1024) if capture is not None else 0
+            self.stream = ADS1115Stream(bus, useraddress, usergain, datarate, range(numOfChannels), capacity=max(64, 2 * blocksize), logger=self.logger)
+            self.stream.start()
+            if not self.stream.wait():   # No conversion within a second. Capture needs the stream, polled reads do not
+                self.stream.stop()
+                self.stream = None
+                if capture is not None:
+                    raise OSError("ADS1115 at {0} returned no conversions in continuous mode".format(hex(useraddress)))
+                self.logger.error("ADS1115 at {0} returned no conversions in continuous mode. Using polled reads".format(hex(useraddress)))
+        if capture is not None:
+            options = dict(capture)
+            blocksize, samplerate = options.pop('blocksize', 1024), options.pop('samplerate', None)
+            if samplerate is not None and samplerate != self.stream.samplerate:
+                self.logger.warning("ADS1115 capture samples at the data rate ({0:.1f} Hz). samplerate {1} ignored".format(self.stream.samplerate, samplerate))
+            self.capture = SpectralCapture(self.stream.capture, numOfChannels, blocksize, self.stream.samplerate, logger=self.logger, **options)
+            self.capture.start()
+        self.filters = filters
+        self.taken = [0] * self.numOfChannels   # Stream sample counts already filtered
+        self.adaptive = None
+        if adaptive is not None and (self.stream is not None or filters is not None):
+            self.logger.warning("Adaptive sampling only applies to polled reads without filters. Ignored")
+        elif adaptive is not None:   # Polled reads only. Readings are mostly idle with an occasional step
+            self.adaptive = AdaptiveRate(self.numOfChannels, self.noiseThreshold, **dict({'maxsamples': self.numOfSamples}, **adaptive))
+            self.level = [random.uniform(0, 4) for x in range(self.numOfChannels)]
+
+    def _sample(self, x):
+        if random.random() < 0.02:
+            self.level[x] = random.uniform(0, 4)
+        return self.level[x] + random.gauss(0, self.NOISE)
 
     def getdata(self):
         ''' If adc is above noise threshold or time limit exceeded will return voltage of each channel '''
         
+        if self.capture is not None:   # Features of the latest block
+            return self.capture.getdata()
+        sensorChanged, timelimit = self.sensorChanged, self.timelimit
         if time() - self.time0 > self.maxInterval:
             timelimit = True
+        if self.filters is not None:   # Filter new samples as one batch
+            if self.stream is not None:
+                rows, self.taken = self.stream.take(self.taken)
+                self.filters.process(rows)
+            else:
+                self.filters.update([random.uniform(0, 5) for x in range(self.numOfChannels)])
+        now = time()
         for x in range(self.numOfChannels):
-            self.sensorAve[x] = float("%.2f"%random.uniform(0, 5))  # sum(self.sensor[x])/len(self.sensor[x])
-            sensorChanged = True
+            if self.adaptive is not None and not self.adaptive.due(x, now):
+                continue
+            if self.filters is not None:
+                self.sensorAve[x] = float(self.filters.last[x]) if self.filters.last is not None else self.sensorLastRead[x]
+            elif self.stream is not None:
+                self.sensorAve[x] = self.stream.average(x, self.numOfSamples)
+            elif self.adaptive is not None:
+                self.sensorAve[x] = self.adaptive.sample(x, lambda: self._sample(x), self.window[x], self.sensorLastRead[x])
+                self.adaptive.update(x, self.sensorAve[x] - self.sensorLastRead[x], now)
+            else:
+                self.sensorAve[x] = self.window[x].push(float("%.2f"%random.uniform(0, 5)))
+            if self.adaptive is None or abs(self.sensorAve[x] - self.sensorLastRead[x]) > self.noiseThreshold[x]:
+                sensorChanged = True   # Random readings always count as a change. Adaptive ones are compared like the driver does
             self.adc['a' + str(x) + 'f'] = self.sensorAve[x]
-            self.sensorLastRead[x] = self.sensorAve[x]
-            self.logger.debug('changed: {0} chan: {1} value: {2:1.3f} previously: {3:1.3f}'.format(sensorChanged, x, self.sensorAve[x], self.sensorLastRead[x]))
+            if self.trace is not None: self.trace.record(self.EV_READ, x, sensorChanged, 0, 0, self.sensorAve[x], self.sensorLastRead[x])
+        if self.adaptive is not None:
+            self.adaptive.report(self.adc)
         if sensorChanged or timelimit:
+            self.sensorLastRead = list(self.sensorAve)   # Reference for the next change
             self.time0 = time()
             self.sensorChanged = False
             self.timelimit = False
             return self.adc    # Return dict with voltage for each channel: a0f, a1f, a2f etc
 
+    def _block(self, samples):
+        ''' Idle readings (samples, channels). Stream samples in continuous mode, NOISE otherwise '''
+        if self.stream is None:
+            return np.random.normal(2.0, self.NOISE, (samples, self.numOfChannels))
+        block = np.zeros((samples, self.numOfChannels))
+        since, n = [self.stream.counts[channel] for channel in self.stream.channels], 0
+        while n < samples:
+            sleep(self.stream.capacity * self.stream.period / 4)
+            rows, since = self.stream.take(since)
+            rows = rows[:samples - n]
+            block[n:n + len(rows)] = rows
+            n += len(rows)
+        return block
+
+    def calibrate(self, samples=2000, rate=0.01, apply=True):
+        ''' Per channel thresholds that idle noise exceeds on rate of the polls (see Mcalibrate). apply=True uses and saves them '''
+        if self.capture is not None:
+            self.logger.warning("Capture mode has no noise threshold to calibrate")
+            return None
+        thresholds = noise_thresholds(self._block(samples), rate, self.numOfSamples, self.numOfSamples if self.stream is not None else 1, self.filters)
+        self.logger.info("ADS1115 {0} noise thresholds at {1} false triggers per poll: {2}".format(self.name, rate, thresholds))
+        if apply:
+            self.noiseThreshold = thresholds
+            if self.adaptive is not None:
+                self.adaptive.noiseThreshold = thresholds
+            if self.calibration is not None:
+                self.calibration.save(self.name, thresholds, rate=rate, samples=samples)
+        return thresholds
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.stop()
+        if self.stream is not None:
+            self.stream.stop()
+
 class mcp3008:
     ''' ADC using MCP3008 (SPI). Returns a list with voltage values '''
+    NOISE = 60      # Simulated noise sigma (raw 16 bit counts) of polled reads. Fixed so calibrating does not change it
 
-    def __init__(self, numOfChannels, vref, noiseThreshold=350, maxInterval=1, cs=8, logger=None):
-        ''' Create spi connection and initialize lists '''
+    def __init__(self, numOfChannels, vref, noiseThreshold=350, maxInterval=1, cs=8, logger=None, trace=None, scan=False, capture=None, filters=None, adaptive=None, calibration=None, name=None):
+        ''' Create spi connection and initialize lists. scan=True reads fake MCP3008s (up to 16 channels) with Mmcp3008scan. capture=dict() returns spectral features. filters=Mfilter.Pipeline. adaptive=dict() for Madaptive. calibration=Mcalibrate.NoiseCalibration saves under name (the device name) and the chip '''
         
         if logger is not None:                        # Use logger passed as argument
             self.logger = logger
@@ -345,7 +598,13 @@ class mcp3008:
         self.vref = vref
         self.logger.info("MCP3008 using SPI ")
         self.numOfChannels = numOfChannels
-        self.noiseThreshold = noiseThreshold
+        self.name = ('' if name is None else name + '_') + 'mcp3008_cs' + str(cs)   # Calibration key
+        self.calibration = calibration
+        saved = calibration.load(self.name, numOfChannels) if calibration is not None else None
+        if saved is not None:
+            self.logger.info("MCP3008 using calibrated noise thresholds {0}".format(saved))
+            noiseThreshold = saved
+        self.noiseThreshold = list(noiseThreshold) if isinstance(noiseThreshold, (list, tuple)) else [noiseThreshold] * numOfChannels   # Per channel
         self.numOfSamples = 10             # Number of samples to average
         self.maxInterval = maxInterval  # interval in seconds to check for update
         self.time0 = time()   # time 0
@@ -353,10 +612,38 @@ class mcp3008:
         self.sensorAve = [x for x in range(self.numOfChannels)]
         self.sensorLastRead = [x for x in range(self.numOfChannels)]
         self.adcValue = [x for x in range(self.numOfChannels)]
-        self.sensor = [[x for x in range(0, self.numOfSamples)] for x in range(0, self.numOfChannels)]
+        self.window = [RunningStats(self.numOfSamples) for x in range(self.numOfChannels)]   # Sliding window, one new sample per getdata
         self.sensorChanged = False
         self.timelimit = False
         self.adc = {}   # Container for sending final data
+        self.trace = trace   # Optional Mtrace.TraceBuffer for per channel reads
+        if self.trace is not None:
+            self.EV_READ = self.trace.register("mcp3008 chan: {0} value: {4:1.3f}")
+        self.scanner = None
+        self.capture = None
+        if scan or capture is not None:
+            levels = [random.uniform(0.5, vref - 0.5) for x in range(16)]
+            spis = [FakeSPI(FakeMCP3008(lambda ch, t, first=8 * chip: levels[first + ch] + 0.1 * np.sin(2 * np.pi * 50 * (first + ch + 1) * t), vref, noise=0.003))   # Level with ripple at a multiple of 50Hz
+                    for chip in range((numOfChannels + 7) // 8)]
+            self.scanner = MCP3008Scan(spis, numOfChannels, self.numOfSamples if filters is not None else 1)
+        self.filters = filters
+        if capture is not None:
+            options = dict(capture)
+            blocksize, samplerate = options.pop('blocksize', 1024), options.pop('samplerate', 1000)
+            samplerate = self.scanner.setup_capture(blocksize, samplerate)
+            self.capture = SpectralCapture(self.scanner.capture, numOfChannels, blocksize, samplerate, scale=vref / 65535, logger=self.logger, **options)
+            self.capture.start()
+        self.adaptive = None
+        if adaptive is not None and (self.scanner is not None or filters is not None):
+            self.logger.warning("Adaptive sampling only applies to polled reads without filters. Ignored")
+        elif adaptive is not None:   # Per channel reads only. Raw readings are mostly idle with an occasional step
+            self.adaptive = AdaptiveRate(self.numOfChannels, self.noiseThreshold, **dict({'maxsamples': self.numOfSamples}, **adaptive))
+            self.level = [random.uniform(0, 65535) for x in range(self.numOfChannels)]
+
+    def _sample(self, x):
+        if random.random() < 0.02:
+            self.level[x] = random.uniform(0, 65535)
+        return self.level[x] + random.gauss(0, self.NOISE)
     
     def valmap(self, value, istart, istop, ostart, ostop):
         ''' Used to convert from raw ADC to voltage '''
@@ -366,18 +653,72 @@ class mcp3008:
     def getdata(self):
         ''' If adc is above noise threshold or time limit exceeded will return voltage of each channel '''
         
+        if self.capture is not None:   # Features of the latest block
+            return self.capture.getdata()
         if time() - self.time0 > self.maxInterval:
             self.timelimit = True
+        if self.scanner is not None:
+            samples = self.scanner.scan()
+            if self.filters is not None:   # Filter the new samples as one batch
+                self.filters.process(samples)
+        now = time()
         for x in range(self.numOfChannels):
-            self.sensorChanged = True
-            self.adc['a' + str(x) + 'f'] = float("%.2f"%random.uniform(0, 5)) # self.adcValue[x]
-            self.logger.debug('{0}'.format(self.adc))
+            if self.adaptive is not None and not self.adaptive.due(x, now):
+                continue
+            if self.adaptive is not None:
+                self.sensorAve[x] = self.adaptive.sample(x, lambda: self._sample(x), self.window[x], self.sensorLastRead[x])
+                if abs(self.sensorAve[x] - self.sensorLastRead[x]) > self.noiseThreshold[x]:
+                    self.sensorChanged = True
+                self.adaptive.update(x, self.sensorAve[x] - self.sensorLastRead[x], now)
+                self.adc['a' + str(x) + 'f'] = self.valmap(self.sensorAve[x], 0, 65535, 0, self.vref)
+            elif self.scanner is not None:
+                self.sensorChanged = True
+                self.sensorAve[x] = float(self.filters.last[x]) if self.filters is not None else self.window[x].push(samples[0, x])
+                self.adc['a' + str(x) + 'f'] = self.valmap(self.sensorAve[x], 0, 65535, 0, self.vref)
+            else:
+                self.sensorChanged = True
+                self.adc['a' + str(x) + 'f'] = self.window[x].push(float("%.2f"%random.uniform(0, 5))) # self.adcValue[x]
+            if self.trace is not None: self.trace.record(self.EV_READ, x, 0, 0, 0, self.adc['a' + str(x) + 'f'])
+        if self.adaptive is not None:
+            self.adaptive.report(self.adc)
         if self.sensorChanged or self.timelimit:
+            self.sensorLastRead = list(self.sensorAve)   # Reference for the next change
             self.time0 = time()
             self.sensorChanged = False
             self.timelimit = False
             return self.adc   # Return dict with voltage for each channel: a0f, a1f, a2f etc
 
+    def _block(self, samples):
+        ''' Idle raw readings (samples, channels). Fake MCP3008 scans with scan=True, NOISE otherwise '''
+        if self.scanner is None:
+            return np.random.normal(30000, self.NOISE, (samples, self.numOfChannels))
+        block = np.zeros((samples, self.numOfChannels))
+        n = 0
+        while n < samples:
+            rows = self.scanner.scan()[:samples - n]
+            block[n:n + len(rows)] = rows
+            n += len(rows)
+        return block
+
+    def calibrate(self, samples=2000, rate=0.01, apply=True):
+        ''' Per channel thresholds that idle noise exceeds on rate of the polls (see Mcalibrate). apply=True uses and saves them '''
+        if self.capture is not None:
+            self.logger.warning("Capture mode has no noise threshold to calibrate")
+            return None
+        thresholds = noise_thresholds(self._block(samples), rate, self.numOfSamples, self.scanner.samples if self.scanner is not None else 1, self.filters)
+        self.logger.info("MCP3008 {0} noise thresholds at {1} false triggers per poll: {2}".format(self.name, rate, thresholds))
+        if apply:
+            self.noiseThreshold = thresholds
+            if self.adaptive is not None:
+                self.adaptive.noiseThreshold = thresholds
+            if self.calibration is not None:
+                self.calibration.save(self.name, thresholds, rate=rate, samples=samples)
+        return thresholds
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.stop()
+
 
 
 if __name__ == "__main__":
@@ -394,7 +735,8 @@ if __name__ == "__main__":
     data_keys = ['delayf', 'cpufreq0i', 'looptime0f', 'looptime1f', 'steps0i', 'steps1i', 'rpm0f', 'rpm1f', 'speed0i', 'speed1i']
     m1pins = [12, 16, 20, 21]
     m2pins = [19, 13, 6, 5]
-    motor = Stepper(m1pins, m2pins, logger=logger_stepper)  # can enter 1 to 2 list of pins (up to 2 motors)
+    trace = TraceBuffer(4096)   # Step and adc events. Formatted only when dumped
+    motor = Stepper(m1pins, m2pins, logger=logger_stepper, timing='deadline', trace=trace)  # can enter 1 to 2 list of pins (up to 2 motors)
 
     logger_rotenc = logging.getLogger('rotenc')
     logger_rotenc.setLevel(logging.INFO)
@@ -415,15 +757,16 @@ if __name__ == "__main__":
     logger_ads1115 = logging.getLogger('ads1115')
     logger_ads1115.setLevel(logging.INFO)
     _loggers.append(logger_ads1115)
-    adc_ads1115 = ads1115(2, 0.001, 1, 1, 0x48, logger=logger_ads1115)
+    adc_ads1115 = ads1115(2, 0.001, 1, 1, 0x48, logger=logger_ads1115, trace=trace)
 
     logger_mcp3008 = logging.getLogger('mcp3008')
     logger_mcp3008.setLevel(logging.DEBUG)
     _loggers.append(logger_mcp3008)
-    adc_mcp3008 = mcp3008(2, 5, 400, 1, 8, logger=logger_mcp3008) # numOfChannels, vref, noiseThreshold, max time interval, chip select
+    adc_mcp3008 = mcp3008(2, 5, 400, 1, 8, logger=logger_mcp3008, trace=trace) # numOfChannels, vref, noiseThreshold, max time interval, chip select
 
     for logger in _loggers:
         main_logger.info('{0} is set at level: {1}'.format(logger, logger.getEffectiveLevel()))
+    traceindex = 0
     try:
         while 1:
             volt_current_power = ina219A.getdata()
@@ -443,6 +786,7 @@ if __name__ == "__main__":
             
             for x in range(20):
                 motor.step(incomingD)
+            traceindex = trace.dump(logger_stepper, traceindex)   # Stream the events recorded since the last dump
             outgoingD = motor.getdata()
             for key in outgoingD.keys():
                 main_logger.debug(key)
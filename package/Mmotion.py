@@ -0,0 +1,106 @@
+'''
+Encoder motion from edge timestamps. QuadratureDecoder pushes (time, quarter steps) of every
+quarter step into an array('d') ring buffer from its edge callback, and report() coalesces the
+counts into at most one payload per interval:
+ <prefix>Ci - position (detents)             <prefix>Di - net detents since the last payload
+ <prefix>Vf - velocity (detents/s)           <prefix>Af - acceleration (detents/s^2)
+ <prefix>Bi - button state                   <prefix>Pi - button presses since start
+A payload is sent when the position, button or press count changed, or while the knob is still
+slowing down, so the last payload of a spin has velocity 0. A fast spin is a handful of payloads
+instead of one per detent.
+
+velocity is taken over the edges in the last window seconds (count between the first and last
+edge / their time apart), so it has quarter step resolution even at a few edges per window.
+acceleration is the change from the window before. Both are 0 with fewer than 2 edges in the window.
+
+ motion = EncoderMotion(interval=0.1, window=0.1, prefix='RotEnc1')
+ rotEnc1 = RotaryEncoder(17, 27, 24, 'RotEnc1Ci', 'RotEnc1Bi', motion=dict(interval=0.1))   # Same, made by the driver
+
+'''
+
+from array import array
+from time import monotonic
+
+class EncoderMotion:
+    ''' Ring buffer of quarter step times. Windowed velocity/acceleration and coalesced payloads '''
+
+    def __init__(self, size=256, window=0.1, interval=0.1, stepsperdetent=4, prefix='RotEnc'):
+        self.size = size
+        self.window = window
+        self.interval = interval
+        self.stepsperdetent = stepsperdetent
+        self.times = array('d', bytes(8 * size))
+        self.steps = array('q', bytes(8 * size))   # Quarter step count after each edge
+        self.count = 0                              # Edges pushed
+        self.keys = [prefix + suffix for suffix in ('Ci', 'Di', 'Vf', 'Af', 'Bi', 'Pi')]
+        self.outgoing = {}
+        self.treport = float('-inf')
+        self.position = 0
+        self.velocity = 0.0
+        self.button = None
+        self.presses = 0
+        self.payloads = 0
+
+    def edge(self, t, quarters):
+        ''' One quarter step. Called from the edge callback with the decoder lock held '''
+        n = self.count % self.size
+        self.times[n] = t
+        self.steps[n] = quarters
+        self.count += 1
+
+    def rate(self, start, end):
+        ''' Detents/s over the edges between start and end (monotonic s) '''
+        first = last = None
+        for n in range(self.count - 1, max(-1, self.count - self.size - 1), -1):
+            t = self.times[n % self.size]
+            if t > end:
+                continue
+            if t < start:
+                break
+            if last is None:
+                last = n
+            first = n
+        if first is None or first == last or self.times[last % self.size] == self.times[first % self.size]:
+            return 0.0
+        span = self.times[last % self.size] - self.times[first % self.size]
+        return (self.steps[last % self.size] - self.steps[first % self.size]) / span / self.stepsperdetent
+
+    def rates(self, now):
+        ''' (velocity, acceleration) at now '''
+        velocity = self.rate(now - self.window, now)
+        previous = self.rate(now - 2 * self.window, now - self.window)
+        return velocity, (velocity - previous) / self.window
+
+    def report(self, position, button, presses, now=None):
+        ''' Payload once per interval when something changed, else None. Call with the decoder lock held '''
+        now = monotonic() if now is None else now
+        if now - self.treport < self.interval:
+            return None
+        velocity, acceleration = self.rates(now)
+        if position == self.position and button == self.button and presses == self.presses and velocity == 0 and self.velocity == 0:
+            return None
+        values = (position, position - self.position, float("{:.2f}".format(velocity)), float("{:.2f}".format(acceleration)), button, presses)
+        self.outgoing.update(zip(self.keys, values))
+        self.position, self.velocity, self.button, self.presses = position, velocity, button, presses
+        self.treport = now
+        self.payloads += 1
+        return self.outgoing
+
+if __name__ == "__main__":
+    motion = EncoderMotion(interval=0.1, prefix='RotEnc1')
+    profile = [(0.3, 10), (0.4, 40), (0.3, 10), (0.5, 0)]   # (seconds, detents/s) of a spin
+    quarters, t, nextedge, polls = 0, 0.0, 0.0, 0
+    for seconds, speed in profile:
+        end = t + seconds
+        while t < end:
+            t += 0.001
+            if speed and t >= nextedge:
+                quarters += 1
+                motion.edge(t, quarters)
+                nextedge = t + 1 / (4 * speed)
+            if round(t * 1000) % 20 == 0:   # getdata every 20ms
+                polls += 1
+                payload = motion.report(quarters // 4, 0, 0, now=t)
+                if payload is not None:
+                    print("{0:.2f}s {1}".format(t, payload))
+    print("{0} payloads for {1} polls and {2} detents".format(motion.payloads, polls, quarters // 4))
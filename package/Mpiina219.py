@@ -47,17 +47,36 @@ ADC*32SAMP: 32 samples at 12 bit, conversion time 17.02ms.
 ADC*64SAMP: 64 samples at 12 bit, conversion time 34.05ms.
 ADC*128SAMP: 128 samples at 12 bit, conversion time 68.10ms.
 
+Register transfers go through the process wide shared I2C bus (see Mi2cbus) so they queue fairly with the
+other I2C devices. Pass i2cbus to use another Mi2cbus.I2CBus.
+
+nonblocking=dict() reads through Mina219nb.INA219Reader instead of the library: getdata() returns right away with
+the cached reading and its age (agekey) and only reads the result registers when the conversion ready bit is set.
+Options are the INA219Reader arguments busadc, shuntadc (resolution/averaging above), mode ('triggered' or 'continuous')
+and agekey. sleep/wake/reset keep working.
+ ina = PiINA219('Vbusf', 'IbusAf', 'PowerWf', nonblocking=dict(shuntadc=ADC_128SAMP, busadc=ADC_12BIT))
+
+filters={currentkey: Mfilter.Pipeline(Kalman(q, r))} filters the readings of those keys (one sample per getdata)
+ ina = PiINA219('Vbusf', 'IbusAf', 'PowerWf', filters={'IbusAf': Pipeline(Kalman(1e-6, 0.002 ** 2))})
+
 '''
 
 from ina219 import INA219
 from ina219 import DeviceRangeError
 import time, logging
 from time import perf_counter, perf_counter_ns
+try:
+    from .Mi2cbus import I2CManager, RegisterDevice
+    from .Mina219nb import INA219Reader
+except ImportError:
+    from Mi2cbus import I2CManager, RegisterDevice
+    from Mina219nb import INA219Reader
 
 class PiINA219:
 
-    def __init__(self, voltkey='Vbusf', currentkey='IbusAf', powerkey='PowerWf', gainmode="auto", maxA = 0.4, address=0x40, logger=None): 
+    def __init__(self, voltkey='Vbusf', currentkey='IbusAf', powerkey='PowerWf', gainmode="auto", maxA = 0.4, address=0x40, logger=None, filters=None, i2cbus=None, nonblocking=None): 
         self.SHUNT_OHMS = 0.1
+        self.filters = filters if filters is not None else {}   # data key -> Mfilter.Pipeline
         self.voltkey = voltkey
         self.currentkey = currentkey
         self.powerkey = powerkey
@@ -70,22 +89,39 @@ class PiINA219:
         else:                                          # Root logger already exists and no custom logger passed
             self.logger = logging.getLogger(__name__)    # Create from root logger        
         self.ina219 = INA219(self.SHUNT_OHMS, maxA, address=self.address)  # can pass log_level=log_level
+        bus = i2cbus if i2cbus is not None else I2CManager.shared().bus(1)
+        self.ina219._i2c = RegisterDevice(bus, self.address)  # Library register reads/writes on the shared bus
         self.outgoing = {}
-        if gainmode == "auto":      # AUTO GAIN, HIGH RESOLUTION - Lower precision above max amps specified
+        self.reader = None
+        if nonblocking is not None:  # Conversion ready polling. Configured by the reader
+            self.reader = INA219Reader(bus, address, self.SHUNT_OHMS, maxA, gain=0 if gainmode == "manual" else None,
+                                       voltkey=voltkey, currentkey=currentkey, powerkey=powerkey, logger=self.logger, **nonblocking)
+            self.outgoing = self.reader.outgoing
+        elif gainmode == "auto":      # AUTO GAIN, HIGH RESOLUTION - Lower precision above max amps specified
             self.ina219.configure(self.ina219.RANGE_16V)
         elif gainmode == "manual":  # MANUAL GAIN, HIGH RESOLUTION - Max amps is 400mA
             self.ina219.configure(self.ina219.RANGE_16V, self.ina219.GAIN_1_40MV)
         self.logger.info('ina219 at {0} setup with gain mode:{1} max Amps:{2}'.format(address, gainmode, maxA))
-        self.logger.info(self.ina219)
+        if self.reader is None:
+            self.logger.info(self.ina219)
 
     def getdata(self):
-        self.outgoing[self.voltkey] =  self.ina219.voltage()
-        try:
-            self.outgoing[self.currentkey] = float("{:.3f}".format(self.ina219.current()/1000))
-            self.outgoing[self.powerkey] = float("{:.2f}".format(self.ina219.power()/1000))
-            #Vshunt = self.ina219.shunt_voltage()
-        except DeviceRangeError as e:
-            self.logger.info("Current overflow")
+        fresh = True
+        if self.reader is not None:
+            conversions = self.reader.fresh
+            self.reader.getdata()   # Updates self.outgoing
+            fresh = self.reader.fresh != conversions   # Filter new conversions only, not the cached reading
+        else:
+            self.outgoing[self.voltkey] =  self.ina219.voltage()
+            try:
+                self.outgoing[self.currentkey] = float("{:.3f}".format(self.ina219.current()/1000))
+                self.outgoing[self.powerkey] = float("{:.2f}".format(self.ina219.power()/1000))
+                #Vshunt = self.ina219.shunt_voltage()
+            except DeviceRangeError as e:
+                self.logger.info("Current overflow")
+        for key, pipeline in self.filters.items():
+            if fresh and key in self.outgoing and pipeline.update([self.outgoing[key]]) is not None:
+                self.outgoing[key] = float(pipeline.last[0])
         self.logger.debug('{0}, {1}, {2}'.format(self.address, self.outgoing.keys(), self.outgoing.values()))
         return self.outgoing
 
@@ -93,10 +129,15 @@ class PiINA219:
         self.ina219.sleep()
 
     def wake(self):
-        self.ina219.wake()
+        if self.reader is not None:
+            self.reader.trigger()
+        else:
+            self.ina219.wake()
 
     def reset(self):
         self.ina219.reset()
+        if self.reader is not None:
+            self.reader.setup()
 
 if __name__ == "__main__":
     from logging.handlers import RotatingFileHandler
@@ -0,0 +1,77 @@
+'''
+Acceleration planner for the steppers. Builds a per tick delay table (ms) for a move from the
+number of steps, max speed and acceleration. The table has acceleration, cruise and deceleration
+phases (triangle if the move is too short to reach max speed).
+
+ shape='trap'   - Trapezoidal. Constant acceleration, v = sqrt(v0^2 + 2*a*s)
+ shape='scurve' - S-curve. Velocity follows a smoothstep in time so acceleration ramps up and
+                  down (limited jerk). Peak acceleration is accel, so the ramp is 1.5x longer than trap.
+
+Speeds are in steps/sec, accel in steps/sec^2. stepsize is steps per tick (1 half step, 2 full step).
+startspeed below the speed reached after accelerating over the first tick (sqrt(2*accel*stepsize)),
+including 0, starts at that speed.
+Tables are cached by move parameters so repeated moves do not re-plan.
+
+Stepper mode 1 moves use a profile when the controls have an "accel" entry for the motor
+ {"maxspeed":[1000,1000], "accel":[2000,2000], "startspeed":[250,250], "profile":"trap", ...}
+
+'''
+
+from functools import lru_cache
+import numpy as np
+
+@lru_cache(maxsize=128)
+def plan(steps, stepsize=1, maxspeed=1000, accel=2000, startspeed=250, shape='trap'):
+    ''' Return a tuple with the delay (ms) for each tick of the move '''
+    ticks = max(1, -(-int(steps) // stepsize))               # ceil
+    pos = np.arange(ticks) * stepsize                        # steps travelled at the start of each tick
+    dist = np.minimum(pos, steps - pos).clip(0)              # distance from the nearest end of the move
+    v0 = min(max(startspeed, np.sqrt(2.0 * accel * stepsize)), maxspeed)   # From rest, the speed after one tick of accel (a 0 start speed has an infinite first delay)
+    if shape == 'scurve':
+        T = 1.5 * (maxspeed - v0) / accel                    # ramp time. smoothstep peak slope is 1.5x the average
+        t = np.linspace(0, T, 256)
+        x = t / T if T > 0 else np.ones_like(t)
+        v = v0 + (maxspeed - v0) * x * x * (3 - 2 * x)
+        s = np.concatenate(([0], np.cumsum((v[1:] + v[:-1]) / 2 * np.diff(t))))  # distance at each ramp time
+        speed = np.interp(dist, s, v)                        # beyond the ramp interp holds maxspeed
+    else:
+        speed = np.minimum(np.sqrt(v0 * v0 + 2.0 * accel * dist), maxspeed)
+    return tuple((stepsize * 1000.0 / speed).round(4).tolist())
+
+class MoveProfiles:
+    ''' Delay tables for the active mode 1 move of each motor '''
+
+    def __init__(self, numOfMotors):
+        self.table = [None] * numOfMotors
+        self.tick = [0] * numOfMotors
+
+    def start(self, i, command, distance, stepsize):
+        ''' Plan motor i move if the controls include an accel for it '''
+        if command.get("accel") is None or not command["accel"][i] > 0:
+            self.table[i] = None
+            return
+        self.table[i] = plan(abs(int(distance)), stepsize,
+                             command.get("maxspeed", [1000] * len(self.table))[i],
+                             command["accel"][i],
+                             command.get("startspeed", [250] * len(self.table))[i],
+                             command.get("profile", "trap"))
+        self.tick[i] = 0
+
+    def stop(self, i):
+        self.table[i] = None
+
+    def delay(self):
+        ''' Delay (ms) for this tick. All motors share the tick so the slowest active profile sets it. None if no profile active '''
+        delay = None
+        for i, table in enumerate(self.table):
+            if table is not None:
+                d = table[min(self.tick[i], len(table) - 1)]
+                self.tick[i] += 1
+                if delay is None or d > delay:
+                    delay = d
+        return delay
+
+if __name__ == "__main__":
+    for shape in ('trap', 'scurve'):
+        table = plan(400, 1, 1000, 4000, 250, shape)
+        print(shape, len(table), table[:5], table[195:200], table[-5:], "move time {0:.1f}ms".format(sum(table)))
@@ -0,0 +1,79 @@
+'''
+Report by exception between a device getdata() and mqtt publish. A payload is published when a
+watched key moves more than its deadband from the value last published, and held back otherwise.
+ deadbands   - {key: deadband}. Keys not listed use default (0 = any change publishes)
+ heartbeat   - Max seconds without a publish. The latest payload is sent again so subscribers know the device is alive
+ mininterval - Min seconds between publishes. A change inside it is published once the interval has passed
+
+Watched keys are the data_keys of the device. Other keys in the payload are published with it but
+do not trigger a publish. A payload is copied when it arrives (drivers reuse their outgoing dict) and
+only a new payload is checked for changes. A getdata() that returns None (ie ADC below its noise
+threshold) counts as no change, the latest payload is kept for the heartbeat.
+
+ rbe = ReportByException(['Vbusf', 'IbusAf', 'PowerWf'], deadbands={'Vbusf': 0.05, 'IbusAf': 0.002}, heartbeat=60, mininterval=0.5)
+ payload = rbe.check(ina219.getdata())
+ if payload is not None: mqtt_client.publish(topic, json.dumps(payload))
+
+'''
+
+from time import monotonic
+
+class ReportByException:
+    ''' Decides for one device whether a payload is published '''
+
+    def __init__(self, keys, deadbands=None, default=0, heartbeat=60, mininterval=0.0):
+        self.deadbands = {key: default for key in keys}
+        self.deadbands.update(deadbands or {})
+        self.heartbeat = heartbeat
+        self.mininterval = mininterval
+        self.sent = {}        # Watched values last published
+        self.latest = None    # Copy of the latest payload from the device
+        self.pending = False  # A payload changed past its deadband and is not published yet
+        self.tsent = None     # monotonic() of the last publish
+        self.published = 0
+        self.suppressed = 0
+
+    def changed(self, payload):
+        ''' Watched keys that moved past their deadband since the last publish '''
+        keys = []
+        for key, deadband in self.deadbands.items():
+            if key not in payload:
+                continue
+            value, last = payload[key], self.sent.get(key)
+            if last is None:
+                keys.append(key)
+            elif isinstance(value, (int, float)) and isinstance(last, (int, float)) and not isinstance(value, bool):
+                if abs(value - last) > deadband:
+                    keys.append(key)
+            elif value != last:
+                keys.append(key)
+        return keys
+
+    def check(self, payload, now=None):
+        ''' payload to publish or None '''
+        now = monotonic() if now is None else now
+        if isinstance(payload, dict):
+            self.latest = dict(payload)
+            self.pending = self.pending or bool(self.changed(self.latest))
+        if self.latest is None:
+            return None
+        if self.tsent is not None and now - self.tsent < self.mininterval:
+            self.suppressed += payload is not None
+            return None
+        if not self.pending and (self.heartbeat is None or self.tsent is not None and now - self.tsent < self.heartbeat):
+            self.suppressed += payload is not None
+            return None
+        self.sent = {key: self.latest[key] for key in self.deadbands if key in self.latest}
+        self.tsent = now
+        self.pending = False
+        self.published += 1
+        return self.latest
+
+if __name__ == "__main__":
+    import random
+    rbe = ReportByException(['Vbusf', 'IbusAf'], deadbands={'Vbusf': 0.05, 'IbusAf': 0.002}, heartbeat=10, mininterval=1)
+    for n in range(120):   # 60s of polls every 0.5s. Current steps at 30s
+        payload = {'Vbusf': 5 + random.gauss(0, 0.01), 'IbusAf': (0.3 if n >= 60 else 0.1) + random.gauss(0, 0.0005)}
+        if rbe.check(payload, n * 0.5) is not None:
+            print("{0:5.1f}s {1}".format(n * 0.5, {key: round(value, 4) for key, value in payload.items()}))
+    print("published", rbe.published, "suppressed", rbe.suppressed)
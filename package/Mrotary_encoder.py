@@ -5,13 +5,91 @@ both CW and CCW. Starts at 0 and increments by 1 or -1.
 
 Returns two integers: (1) the position of the knob and (2) the state of the button, 0 or 1.
 
+interrupt=True (default) decodes in GPIO edge callbacks on both clk and dt with QuadratureDecoder, so
+getdata() returns right away and no edge is lost while the caller is busy. getdata() returns None
+when neither the position nor the button changed. interrupt=False polls the pins in getdata() (call
+it in a tight loop).
+
+QuadratureDecoder looks up every (previous, new) clk/dt state in a 16 entry transition table:
++1/-1 for a quarter step, 0 for no change. Contact bounce toggles one pin back and forth, which
+adds and removes the same quarter step, and the position is only taken at the rest state (every
+4 quarter steps), so bounce never reaches getdata(). Both pins are re-read in the callback, so a
+missed edge is caught up by the next one. A jump of both pins is counted in errors.
+
+motion=dict() coalesces counts with Mmotion.EncoderMotion: edges are timestamped into a ring buffer and
+getdata() returns at most one payload per interval (default 0.1s) with position, net delta, velocity,
+acceleration, button state and press count. Keys start with key1 minus its 'Ci' (RotEnc1Ci -> RotEnc1Di ...).
+Options are the EncoderMotion arguments interval, window (velocity window s) and size (ring buffer edges).
+ rotEnc1 = RotaryEncoder(17, 27, 24, 'RotEnc1Ci', 'RotEnc1Bi', motion=dict(interval=0.1, window=0.1))
+
+gpio= takes the GPIO module (default RPi.GPIO). Mfakebus.FakeGPIO injects edges without a Pi:
+ gpio = FakeGPIO()
+ rotEnc1 = RotaryEncoder(17, 27, 24, gpio=gpio)
+ gpio.turn(17, 27, 3, bounce=2)   # 3 detents clockwise with contact bounce
+ rotEnc1.getdata()                # {'RotEncCi': 3, 'RotEncBi': 0}
+
 '''
 
-import logging
-import RPi.GPIO as GPIO
+import logging, threading
+from time import monotonic
+try:
+  from .Mmotion import EncoderMotion
+except ImportError:
+  from Mmotion import EncoderMotion
+
+class QuadratureDecoder:
+  ''' Counts quarter steps of a quadrature encoder from clk and dt edge callbacks '''
+  # (previous state << 2) | new state -> quarter steps. state = clk << 1 | dt. Clockwise (dt leads) is 0 1 3 2
+  TRANSITIONS = (0, 1, -1, 0,
+                 -1, 0, 0, 1,
+                 1, 0, 0, -1,
+                 0, -1, 1, 0)
+
+  def __init__(self, gpio, clkPin, dtPin, stepsperdetent=4, motion=None):
+    self.gpio = gpio
+    self.clkPin = clkPin
+    self.dtPin = dtPin
+    self.stepsperdetent = stepsperdetent
+    self.motion = motion   # Optional Mmotion.EncoderMotion. Gets a timestamp per quarter step
+    self.lock = threading.Lock()
+    self.state = self._read()
+    self.quarters = 0      # Quarter steps since start
+    self.position = 0      # Detents. Updated when the knob is at its rest state
+    self.edges = 0
+    self.errors = 0        # Both pins changed between callbacks (edges lost)
+    gpio.add_event_detect(clkPin, gpio.BOTH, callback=self._edge)
+    gpio.add_event_detect(dtPin, gpio.BOTH, callback=self._edge)
+
+  def _read(self):
+    return (self.gpio.input(self.clkPin) << 1) | self.gpio.input(self.dtPin)
+
+  def _edge(self, channel):
+    with self.lock:
+      new = self._read()
+      self.edges += 1
+      if new == self.state:   # Bounce already settled back or a second callback for the same change
+        return
+      if new ^ self.state == 3:
+        self.errors += 1
+      else:
+        self.quarters += self.TRANSITIONS[(self.state << 2) | new]
+        if self.motion is not None:
+          self.motion.edge(monotonic(), self.quarters)
+        if self.quarters % self.stepsperdetent == 0:
+          self.position = self.quarters // self.stepsperdetent
+      self.state = new
+
+  def read(self):
+    ''' (position in detents, quarter steps) '''
+    with self.lock:
+      return self.position, self.quarters
+
+  def close(self):
+    self.gpio.remove_event_detect(self.clkPin)
+    self.gpio.remove_event_detect(self.dtPin)
 
 class RotaryEncoder:
-  def __init__(self, clkPin, dtPin, button, key1='RotEncCi', key2='RotEncBi', logger=None):
+  def __init__(self, clkPin, dtPin, button, key1='RotEncCi', key2='RotEncBi', logger=None, interrupt=True, gpio=None, motion=None):
     self.clkPin = clkPin
     self.dtPin = dtPin
     self.button = button
@@ -25,9 +103,14 @@ class RotaryEncoder:
       self.logger = logging.getLogger(__name__)    # Create from root logger
     else:                                          # Root logger already exists and no custom logger passed
       self.logger = logging.getLogger(__name__)    # Create from root logger
+    if gpio is None:
+      import RPi.GPIO as gpio
+    self.GPIO = gpio
+    GPIO = gpio
     self.counter = 0
     self.clkUpdate = True
     self.buttonpressed = False
+    self.presses = 0
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(self.clkPin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
     GPIO.setup(self.dtPin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
@@ -36,9 +119,29 @@ class RotaryEncoder:
     self.clkState = GPIO.input(self.clkPin)
     self.dtState = GPIO.input(self.dtPin)
     GPIO.add_event_detect(self.button, GPIO.BOTH, callback=self._button_callback)
-    self.logger.info('Rotary Encoder pins- clk:{0} data:{1} button:{2}'.format(self.clkPin, self.dtPin, self.button))
+    self.motion = EncoderMotion(prefix=key1[:-2] if key1.endswith('Ci') else key1, **motion) if motion is not None and interrupt else None
+    self.decoder = QuadratureDecoder(GPIO, clkPin, dtPin, motion=self.motion) if interrupt else None
+    self.logger.info('Rotary Encoder pins- clk:{0} data:{1} button:{2}{3}'.format(self.clkPin, self.dtPin, self.button, ' interrupt driven' if interrupt else ''))
 
   def getdata(self):
+    GPIO = self.GPIO
+    if self.motion is not None:
+      with self.decoder.lock:
+        outgoing = self.motion.report(self.decoder.position, GPIO.input(self.button), self.presses)
+      self.buttonpressed = False
+      if outgoing is not None:
+        self.logger.debug(outgoing)
+      return outgoing
+    if self.decoder is not None:
+      position, quarters = self.decoder.read()
+      if position != self.counter or self.buttonpressed:
+        self.counter = position
+        self.buttonpressed = False
+        self.outgoing[self.og_counter] = self.counter
+        self.outgoing[self.og_button] = GPIO.input(self.button)
+        self.logger.debug(self.outgoing)
+        return self.outgoing
+      return None
     self.clkState = GPIO.input(self.clkPin)
     self.dtState = GPIO.input(self.dtPin)
     if self.clkState != self.clkLastState or self.buttonpressed:
@@ -58,6 +161,13 @@ class RotaryEncoder:
   
   def _button_callback(self, channel):
     self.buttonpressed = True
+    if self.GPIO.input(self.button):
+      self.presses += 1
+
+  def close(self):
+    if self.decoder is not None:
+      self.decoder.close()
+    self.GPIO.remove_event_detect(self.button)
 
   def _is_integer(self, n):
         if n == None:
@@ -79,8 +189,18 @@ class RotaryEncoder:
   '''
 
 if __name__ == "__main__":
+  import sys
+  from time import sleep
   _loggers = []
   logging.basicConfig(level=logging.DEBUG) # Set to CRITICAL to turn logging off. Set to DEBUG to get variables. Set to INFO for status messages.
+  try:
+    import RPi.GPIO as GPIO
+  except ImportError:                        # Not on a Pi. Inject edges with the fake GPIO
+    try:
+      from .Mfakebus import FakeGPIO
+    except ImportError:
+      from Mfakebus import FakeGPIO
+    GPIO = FakeGPIO()
   logging.info("GPIO version: {0}".format(GPIO.VERSION))
   main_logger = logging.getLogger(__name__)
   _loggers.append(main_logger)
@@ -93,14 +213,21 @@ if __name__ == "__main__":
   dtPin = 27
   button = 24
   data_keys = ['RotEncCi', 'RotEncBi']
-  rotEnc1 = RotaryEncoder(clkPin, dtPin, button, *data_keys, logger_rotenc)
+  rotEnc1 = RotaryEncoder(clkPin, dtPin, button, *data_keys, logger_rotenc, gpio=GPIO)
   
   try:
+    if GPIO.VERSION == 'fake':
+      for detents, bounce in ((3, 0), (-5, 2), (2, 3)):
+        GPIO.turn(clkPin, dtPin, detents, bounce)
+        main_logger.info("turned {0} bounce {1}: {2} edges so far {3} errors {4}".format(detents, bounce, rotEnc1.getdata(), rotEnc1.decoder.edges, rotEnc1.decoder.errors))
+      sys.exit()
     while True:
-      clicks = rotEnc1.getdata()
+      clicks = rotEnc1.getdata()   # Returns right away. Counts accumulate in the edge callbacks
+      if clicks is not None:
+        main_logger.info(clicks)
+      sleep(0.05)
   except KeyboardInterrupt:
     logging.info("Pressed ctrl-C")
   finally:
     GPIO.cleanup()
     logging.info("GPIO cleaned up")
-
@@ -0,0 +1,187 @@
+'''
+asyncio device scheduler. Each device is registered with its own poll period and priority and
+the loop sleeps until the next device is due, so nothing spins when there is nothing to do.
+ period   - Seconds between reads. Reads are scheduled on a fixed grid (no drift). A device that
+            falls more than one period behind skips the missed reads instead of bursting
+ priority - Higher is read first when several devices are due at the same time
+ blocking - True runs read() in the executor (I2C/SPI drivers). False calls it on the loop, for
+            reads that only copy cached values (ie rotary encoder counters)
+ publish  - Optional callable(name, payload) run on the loop with every payload that is not None
+
+A blocking read still running when the device is due again is not queued a second time (overrun).
+Per device stats: reads, overruns, late (max lateness of a read start, s) and busy (max read time, s).
+
+ scheduler = DeviceScheduler(workers=4)
+ scheduler.add('ina219A', ina219.getdata, 0.5, publish=publish)
+ scheduler.add('rotEnc1', rotenc.getdata, 0.001, priority=2, blocking=False, publish=publish)
+ asyncio.run(scheduler.run())
+
+AsyncMQTT drives a paho mqtt client from the same loop (socket callbacks instead of loop_start()),
+so publish() and on_message run on the loop thread with the device reads. publish() from another
+thread is still safe, the socket write callbacks are handed to the loop with call_soon_threadsafe.
+ mqttloop = AsyncMQTT(asyncio.get_running_loop(), mqtt_client)   # Before mqtt_client.connect()
+
+'''
+
+import asyncio, heapq, logging
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+class ScheduledDevice:
+    def __init__(self, name, read, period, priority, blocking, publish):
+        self.name = name
+        self.read = read
+        self.period = period
+        self.priority = priority
+        self.blocking = blocking
+        self.publish = publish
+        self.running = None   # Future of a blocking read in progress
+        self.reads = 0
+        self.overruns = 0
+        self.late = 0.0
+        self.busy = 0.0
+
+class DeviceScheduler:
+    ''' Poll devices at their own period on one asyncio loop '''
+
+    def __init__(self, workers=4, logger=None):
+        if logger is not None:                        # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='devread')
+        self.devices = {}
+        self.queue = []   # (due, -priority, order, device)
+        self._stop = False
+
+    def add(self, name, read, period, priority=0, blocking=True, publish=None):
+        device = ScheduledDevice(name, read, period, priority, blocking, publish)
+        self.devices[name] = device
+        heapq.heappush(self.queue, (monotonic(), -priority, len(self.devices), device))
+        self.logger.info("Scheduled {0} every {1}s priority {2}{3}".format(name, period, priority, "" if blocking else " on the loop"))
+        return device
+
+    def stop(self):
+        ''' run() returns at the next due read '''
+        self._stop = True
+
+    def stats(self):
+        ''' {name: (reads, overruns, late s, busy s)}. late and busy are reset '''
+        result = {}
+        for name, device in self.devices.items():
+            result[name] = (device.reads, device.overruns, device.late, device.busy)
+            device.late = device.busy = 0.0
+        return result
+
+    async def run(self):
+        ''' Poll until stop() '''
+        loop = asyncio.get_running_loop()
+        self._stop = False
+        while not self._stop:
+            if not self.queue:   # No devices yet
+                await asyncio.sleep(0.1)
+                continue
+            now = monotonic()
+            if self.queue[0][0] > now:
+                await asyncio.sleep(self.queue[0][0] - now)
+                continue
+            due, order, count, device = heapq.heappop(self.queue)
+            device.late = max(device.late, now - due)
+            nextdue = due + device.period
+            if nextdue <= now:   # Fell a period behind. Skip the missed reads
+                nextdue = now + device.period
+            heapq.heappush(self.queue, (nextdue, order, count, device))
+            if device.running is not None:
+                device.overruns += 1
+            elif device.blocking:
+                device.running = loop.run_in_executor(self.executor, self._timedread, device)
+                device.running.add_done_callback(lambda future, device=device: self._done(device, future))
+            else:
+                try:
+                    payload = self._timedread(device)
+                except Exception as exc:   # Same as a failed blocking read. The loop keeps polling the other devices
+                    self.logger.error("{0} read failed: {1!r}".format(device.name, exc))
+                else:
+                    self._deliver(device, payload)
+            await asyncio.sleep(0)   # Let mqtt and finished reads run between dispatches
+        self.executor.shutdown(wait=False)
+
+    def _timedread(self, device):
+        t0 = monotonic()
+        payload = device.read()
+        device.busy = max(device.busy, monotonic() - t0)
+        return payload
+
+    def _done(self, device, future):
+        device.running = None
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.logger.error("{0} read failed: {1!r}".format(device.name, future.exception()))
+            return
+        self._deliver(device, future.result())
+
+    def _deliver(self, device, payload):
+        device.reads += 1
+        if payload is not None and device.publish is not None:
+            try:
+                device.publish(device.name, payload)
+            except Exception:
+                self.logger.exception("{0} publish failed".format(device.name))
+
+class AsyncMQTT:
+    ''' Run a paho client on an asyncio loop. Create it before connect() '''
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.loop_misc())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        ''' Called from any thread that publishes (ie the stepper runner). add_writer must run on the loop '''
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock)
+
+    async def loop_misc(self):
+        ''' Keepalive pings and retries '''
+        while self.client.loop_misc() == 0:
+            await asyncio.sleep(1)
+
+if __name__ == "__main__":
+    import random
+    from time import sleep
+    logging.basicConfig(level=logging.INFO)
+    counts = {}
+    def publish(name, payload):
+        counts[name] = counts.get(name, 0) + 1
+    def slowread():
+        sleep(0.02)   # I2C read
+        return {'Vbusf': random.uniform(4.9, 5.1)}
+    scheduler = DeviceScheduler()
+    scheduler.add('encoder', lambda: {'RotEncCi': 0}, 0.001, priority=2, blocking=False, publish=publish)
+    scheduler.add('ina219', slowread, 0.5, priority=1, publish=publish)
+    scheduler.add('adc', slowread, 0.1, publish=publish)
+    async def main():
+        asyncio.get_running_loop().call_later(2, scheduler.stop)
+        await scheduler.run()
+    asyncio.run(main())
+    logging.info("payloads in 2s {0}".format(counts))
+    logging.info("stats {0}".format(scheduler.stats()))
@@ -0,0 +1,122 @@
+'''
+Block capture and spectral features for vibration and current ripple monitoring. A background
+thread fills a preallocated (blocksize x channels) NumPy block at a fixed sample rate, then
+computes features for every channel at once with one rfft. Only the features are published, so
+a block of 1024 samples per channel becomes a handful of numbers.
+
+Features per channel n (payload keys)
+ a<n>rmsf     - RMS of the block with the mean removed (AC RMS)
+ a<n>peakf    - Largest deviation from the mean
+ a<n>hz<k>f   - k-th dominant frequency (Hz), largest first. DC bin excluded. Left out when there is no k-th peak
+ a<n>band<k>f - Signal power (units^2) in bands[k] = (low Hz, high Hz)
+ sampleratef  - Sample rate the features were computed with
+
+The drivers create it when passed capture=dict(blocksize=1024, samplerate=2000, bands=[(0, 100), (100, 500)], peaks=3)
+ adc = mcp3008(2, 3.3, 400, 1, 8, capture=dict(blocksize=1024, samplerate=4000))
+ features = adc.getdata()    # None until a new block has been analysed
+
+'''
+
+import logging, threading
+import numpy as np
+try:
+    from .Msteprunner import LatestSlot
+except ImportError:
+    from Msteprunner import LatestSlot
+
+def dominant(power, freqs, peaks=3):
+    ''' Frequencies of the largest local maxima of a (bins, channels) power spectrum, largest first. DC bin excluded.
+    NaN where a channel has fewer than peaks maxima '''
+    inner = power[1:-1]
+    local = np.where((inner > power[:-2]) & (inner >= power[2:]), inner, 0)   # Keep only peaks so window leakage next to a peak is not reported
+    order = np.argsort(local, axis=0)[::-1][:peaks]
+    return np.where(np.take_along_axis(local, order, axis=0) > 0, freqs[order + 1], np.nan)
+
+class SpectralCapture:
+    ''' Background block capture. capture(block) must fill the block in place at samplerate '''
+
+    def __init__(self, capture, numOfChannels, blocksize=1024, samplerate=1000, bands=None, peaks=3, scale=1.0, logger=None):
+        if logger is not None:                        # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        self.capture = capture
+        self.numOfChannels = numOfChannels
+        self.samplerate = samplerate
+        self.scale = scale   # Raw block units -> volts
+        if bands is None:    # 4 equal bands up to Nyquist
+            edges = np.linspace(0, samplerate / 2, 5)
+            bands = list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+        self.bands = [tuple(band) for band in bands]
+        self.peaks = peaks
+        self.block = np.zeros((blocksize, numOfChannels))
+        self.window = np.hanning(blocksize)[:, None]
+        self.freqs = np.fft.rfftfreq(blocksize, 1 / samplerate)
+        self.bandmasks = np.array([(self.freqs >= low) & (self.freqs < high) for low, high in self.bands], dtype=float).reshape(len(self.bands), len(self.freqs))
+        self.powerscale = 2 / (blocksize * np.sum(self.window ** 2))
+        self.features = LatestSlot(None)   # capture thread -> getdata()
+        self.seq = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self.logger.info("Spectral capture {0} samples at {1:.1f} Hz bands: {2}".format(blocksize, samplerate, self.bands))
+
+    def analyse(self):
+        ''' Features of the current block as a payload dict '''
+        ac = self.block - self.block.mean(axis=0)
+        ac *= self.scale
+        power = np.abs(np.fft.rfft(ac * self.window, axis=0)) ** 2 * self.powerscale
+        hz = dominant(power, self.freqs, self.peaks)
+        bandpower = self.bandmasks @ power
+        rms = np.sqrt(np.mean(ac ** 2, axis=0))
+        peak = np.abs(ac).max(axis=0)
+        payload = {}
+        for x in range(self.numOfChannels):
+            payload['a' + str(x) + 'rmsf'] = float(rms[x])
+            payload['a' + str(x) + 'peakf'] = float(peak[x])
+            for k in range(hz.shape[0]):
+                if not np.isnan(hz[k, x]):   # Flat or single tone blocks have fewer peaks
+                    payload['a' + str(x) + 'hz' + str(k) + 'f'] = float(hz[k, x])
+            for k in range(len(self.bands)):
+                payload['a' + str(x) + 'band' + str(k) + 'f'] = float(bandpower[k, x])
+        payload['sampleratef'] = float(self.samplerate)
+        return payload
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='capture', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=2):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                self.capture(self.block)
+                self.features.put(self.analyse())
+        except Exception:
+            self.logger.exception("Spectral capture stopped on error")
+
+    def getdata(self):
+        ''' Features of the latest block, or None if no new block since the last call '''
+        seq, payload = self.features.get()
+        if seq == self.seq:
+            return None
+        self.seq = seq
+        return payload
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    rate, n = 2000, 1024
+    t = np.arange(n)[:, None] / rate
+    block = np.hstack([1 + 0.5 * np.sin(2 * np.pi * 50 * t), 0.2 * np.sin(2 * np.pi * 330 * t) + 0.1 * np.sin(2 * np.pi * 120 * t)])
+    def capture(buffer):
+        buffer[:] = block
+    spectrum = SpectralCapture(capture, 2, n, rate, bands=[(0, 100), (100, 200), (200, 1000)], peaks=2)
+    capture(spectrum.block)
+    logging.info(spectrum.analyse())
@@ -0,0 +1,154 @@
+'''
+Vectorized Stepper backend. Same step(), getdata() and resetsteps() interface as Mmodule.Stepper
+but the state for all motors (phase, step counter, speed, mode, target) is held in NumPy arrays.
+One tick for the whole machine is a handful of array operations, so the cost per tick stays
+almost flat as more motors are added.
+
+After each step() the pin state matrix for the machine is in pinstates (one row per motor,
+columns are ULN2003 IN1,2,3,4) and the pins in the same layout are in pins.
+
+'''
+
+import logging
+import numpy as np
+from time import sleep, perf_counter_ns
+try:
+    from .Mmodule import COILPHASES, COILSTOP, STEPDELTA, PHASETABLE, StepDeadline
+except ImportError:
+    from Mmodule import COILPHASES, COILSTOP, STEPDELTA, PHASETABLE, StepDeadline
+try:
+    from .Mplanner import MoveProfiles
+    from .Mgpioout import PinBank
+    from .Msystelemetry import SysTelemetry
+except ImportError:
+    from Mplanner import MoveProfiles
+    from Mgpioout import PinBank
+    from Msystelemetry import SysTelemetry
+
+COILPHASES_NP = np.array(COILPHASES, dtype=np.uint8)   # [phase] -> coil pattern
+PHASETABLE_NP = np.array(PHASETABLE, dtype=np.int8)    # [inverse, speed, phase] -> next phase
+STEPDELTA_NP = np.array(STEPDELTA, dtype=np.int32)     # [speed] -> step counter change
+
+class StepperArray:   # command comes from node-red GUI
+    def __init__(self, *args, logger=None, timing='sleep', output=None, telemetry=None):
+
+        if logger is not None:                        # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        self.deadline = StepDeadline() if timing == 'deadline' else None  # steady step period, see Mmodule.StepDeadline
+        self.FULLREVOLUTION = 4076    # Steps per revolution
+        self.numOfMotors = len(args)
+        n = self.numOfMotors
+        self.pins = np.array(args, dtype=np.uint8)                 # Pins connected to ULN2003 IN1,2,3,4. One row per motor
+        self.pinstates = np.zeros((n, 4), dtype=np.uint8)          # Coil pattern (HIGH pulses) sent on the last step
+        self.phase = np.full(n, 6, dtype=np.int8)                  # Index into COILPHASES. Start at phase 6 [0,0,1,1]
+        self.steps = np.zeros(n, dtype=np.int32)                   # Step counter for each motor
+        self.speed = np.full(n, 2, dtype=np.int8)                  # 0=fullstepCCW, 1=halfstepCCW, 2=stop, 3=halfstep CW, 4=fullstep CW
+        self.mode = np.zeros(n, dtype=np.int8)                     # 0=continuous, 1=incremental
+        self.targetstep = np.full(n, 291, dtype=np.int32)          # When in mode1/increment a target step is calculated.
+        self.startstepping = np.zeros(n, dtype=bool)               # Flag sent from nodered dashboard to start stepping in increment mode
+        self.profiles = MoveProfiles(n)                            # Acceleration delay tables for mode 1 moves (see Mplanner)
+        self.rpmtime0 = perf_counter_ns()  # used for rpm calculation
+        self.rpmsteps0 = np.zeros(n, dtype=np.int32)
+        self.rpm = np.zeros(n)
+        self.delay = 0        # Container to store loop delay
+        self.timens = 0       # monitor how long one tick takes for all motors (coil logic only)
+        self.timems = 0       # monitor how long one tick takes for all motors (coil logic + delay)
+        self.outgoing = {}
+        self.telemetry = telemetry or SysTelemetry.shared()   # cpufreq from cached sysfs descriptors
+        self.output = None    # output=RPiGPIOBackend()/RegisterBackend()/RecorderBackend() sends all coils in one write per step (see Mgpioout)
+        if output is not None:
+            self.output = PinBank(args, COILPHASES, output)
+            self.outputmask = np.array(self.output.phasemask, dtype=np.uint64)   # [motor, phase] -> set mask
+        for pin in self.pins.flat:   # Setup each pin in each stepper
+            self.logger.info("pin {0} Setup".format(pin))
+
+    def step(self, incomingD):
+        ''' ONE TICK FOR EVERY MOTOR. UPDATES PHASE, STEP COUNTER AND THE PIN STATE MATRIX '''
+        self.command = incomingD
+        t0 = perf_counter_ns()
+        n = self.numOfMotors
+        speed = np.array(self.command["speed"][:n], dtype=np.int8)
+        self.mode[:] = self.command["mode"][:n]
+        inverse = np.array(self.command["inverse"][:n], dtype=bool)
+        full = (speed == 0) | (speed == 4)
+        self.delay = self.command["delay"][0] + self.command["delay"][1] if full.any() else self.command["delay"][0] # Add extra delay for full step
+        mode1 = self.mode == 1
+
+        # Mode 1 with startstep flagged from node-red gui. Calculate the target step and start stepping
+        start = mode1 & (speed != 2) & (np.array(self.command["startstep"][:n]) == 1)
+        if start.any():
+            stepcmd = np.array(self.command["step"][:n], dtype=np.int32)
+            target = np.where(speed > 2, np.minimum(np.abs(self.steps) + stepcmd, self.FULLREVOLUTION),  # moving CW
+                                         np.maximum(self.steps - stepcmd, -self.FULLREVOLUTION))         # moving CCW
+            self.targetstep = np.where(start, target, self.targetstep)
+            self.startstepping |= start
+            for i in np.flatnonzero(start):
+                self.command["startstep"][i] = 0   # startstepping triggered and targetstep calculated. So turn off this if cond
+                self.profiles.start(i, self.command, self.targetstep[i] - self.steps[i], 2 if full[i] else 1)
+
+        # Mode 1 but haven't started stepping. Stop motor and wait for startstep flag from node-red GUI
+        waiting = mode1 & ~self.startstepping
+        if waiting.any():
+            speed[waiting] = 2
+            for i in np.flatnonzero(waiting):
+                self.command["speed"][i] = 2
+        # Mode 1 and stepping. Target met if delta is less than 2 (full step increments by 2)
+        done = mode1 & self.startstepping & (np.abs(np.abs(self.steps) - np.abs(self.targetstep)) < 2)
+        self.startstepping &= ~done
+        if self.profiles.table.count(None) != n:   # Profiled move active. Drop it when done or no longer in mode 1
+            for i in np.flatnonzero(done | ~mode1):
+                self.profiles.stop(i)
+
+        # Advance phase, build the pin state matrix and update the step counters
+        self.speed = speed
+        self.phase = PHASETABLE_NP[inverse.view(np.uint8), speed, self.phase]
+        np.multiply(COILPHASES_NP[self.phase], (speed != 2)[:, None], out=self.pinstates)
+        if self.output is not None:   # One write for the whole machine
+            self.output.write(int(np.bitwise_or.reduce(self.outputmask[np.arange(n), self.phase] * (speed != 2))))
+        self.steps += STEPDELTA_NP[speed]
+        self.steps[np.abs(self.steps) > self.FULLREVOLUTION] = 0   # If hit full revolution reset the step counter
+
+        self.timens = perf_counter_ns() - t0
+        profiledelay = self.profiles.delay()   # Mode 1 moves with accel follow their delay table instead of the fixed delay
+        if profiledelay is not None:
+            self.delay = profiledelay
+        self.timems = (self.timens/1000000) + self.delay
+        if self.deadline is not None:
+            self.deadline.wait(int(self.delay * 1000000))  # step period is delay, independent of logic and main loop time
+        else:
+            sleep(float(self.delay/1000))  # delay can be updated from node-red gui. Needs optimal setting for the motors.
+
+    def getdata(self):
+        ''' RETURN MOTOR DATA INCLUDING STEPS, RPMS, ETC '''
+        t1 = perf_counter_ns()
+        rpm = ((self.steps - self.rpmsteps0)/self.FULLREVOLUTION)/((t1 - self.rpmtime0)/60000000000)
+        self.rpm = np.where(rpm >= 0, rpm, self.rpm)
+        self.rpmsteps0[:] = self.steps
+        self.rpmtime0 = t1
+        for i in range(self.numOfMotors):
+            self.outgoing['steps' + str(i) + 'i'] = int(self.steps[i])
+            self.outgoing['rpm'+ str(i) + 'f'] = float(self.rpm[i])
+            self.outgoing['looptime'+ str(i) + 'f'] = self.timems
+            self.outgoing['speed'+ str(i) + 'i'] = int(self.speed[i])
+        if self.deadline is not None:   # Step lateness (us) when using deadline timing
+            self.outgoing['latemeanf'], self.outgoing['jitterf'], self.outgoing['latemaxf'] = self.deadline.stats()
+        self.outgoing['delayf'] = self.delay
+        self.telemetry.merge(self.outgoing, ('cpufreq0i',))
+        return self.outgoing
+
+    def resetsteps(self):
+        self.steps[:] = 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    logger_stepper = logging.getLogger('stepper')
+    incomingD={"delay":[0.8,1.0], "speed":[3,3,4,1], "mode":[0,0,1,0], "inverse":[False,False,True,False], "step":[2038, 2038, 100, 2038], "startstep":[0,0,1,0]}
+    motors = StepperArray([12, 16, 20, 21], [19, 13, 6, 5], [4, 17, 27, 22], [23, 24, 25, 18], logger=logger_stepper)
+    for x in range(20):
+        motors.step(incomingD)
+        logger_stepper.debug("steps:{0} pins:{1}".format(motors.steps, motors.pinstates.tolist()))
@@ -0,0 +1,116 @@
+'''
+Run a Stepper (or StepperArray) continuously on its own thread so slow device reads and mqtt
+publishing in the main loop do not stall the motors.
+
+The main loop hands over new controls with command() and reads telemetry with snapshot().
+Both go through a LatestSlot - a single writer/single reader slot where the writer replaces
+the whole (sequence, value) tuple. Replacing a reference is atomic so neither side takes a lock
+and the stepping thread never waits on the main loop.
+
+ runner = StepperRunner(motor, controlsD, telemetryinterval=0.5)
+ runner.start()
+ runner.command(newcontrolsD)   # only when new controls arrive (ie from on_message)
+ data = runner.snapshot()       # latest getdata() from the stepping thread
+ runner.stop()
+
+Pass a Mstream.SegmentBuffer as stream to play buffered segments. While the buffer has segments
+they are stepped instead of the latest controls.
+
+'''
+
+import logging, threading, copy
+from time import perf_counter, sleep
+
+class LatestSlot:
+    ''' Single writer / single reader handoff. Reader always gets the latest value and its sequence number '''
+
+    def __init__(self, value=None):
+        self._item = (0, value)
+
+    def put(self, value):
+        self._item = (self._item[0] + 1, value)   # Only the writer updates the sequence number
+
+    def get(self):
+        return self._item   # (sequence, value)
+
+class StepperRunner:
+    ''' Background thread that steps continuously with the latest controls and publishes getdata() snapshots '''
+
+    def __init__(self, stepper, controls, telemetryinterval=0.5, stream=None, logger=None):
+        if logger is not None:                        # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        self.stepper = stepper
+        self.telemetryinterval = telemetryinterval   # seconds between getdata() snapshots
+        self.stream = stream                         # Optional SegmentBuffer. Played back ahead of the controls
+        self.controls = LatestSlot(controls)         # main loop -> stepping thread
+        self.telemetry = LatestSlot({})              # stepping thread -> main loop
+        self.reset = LatestSlot(False)               # main loop -> stepping thread. resetsteps request
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='stepper', daemon=True)
+        self._thread.start()
+        self.logger.info("Stepper runner started")
+
+    def stop(self, timeout=1):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.logger.info("Stepper runner stopped")
+
+    def command(self, controlsD):
+        ''' Hand new controls to the stepping thread. Call once per new controls dict, not every loop '''
+        self.controls.put(controlsD)
+
+    def snapshot(self):
+        ''' Latest getdata() dict from the stepping thread. Never blocks '''
+        return self.telemetry.get()[1]
+
+    def resetsteps(self):
+        self.reset.put(True)
+
+    def _run(self):
+        controlseq, resetseq = -1, 0
+        t0 = perf_counter()
+        try:
+            while not self._stop.is_set():
+                seq, controls = self.controls.get()
+                if seq != controlseq:        # New controls. Copy since step() updates startstep/speed in place
+                    command = copy.deepcopy(controls)
+                    controlseq = seq
+                if self.reset.get()[0] != resetseq:
+                    resetseq = self.reset.get()[0]
+                    self.stepper.resetsteps()
+                streamcommand = self.stream.next_command() if self.stream is not None else None
+                self.stepper.step(command if streamcommand is None else streamcommand)
+                if perf_counter() - t0 > self.telemetryinterval:
+                    self.telemetry.put(dict(self.stepper.getdata()))
+                    t0 = perf_counter()
+        except Exception:
+            self.logger.exception("Stepper runner stopped on error")
+
+if __name__ == "__main__":
+    try:
+        from .Mmodule import Stepper
+    except ImportError:
+        from Mmodule import Stepper
+    logging.basicConfig(level=logging.INFO)
+    logger_stepper = logging.getLogger('stepper')
+    controlsD = {"delay":[0.8,1.0], "speed":[3,3], "mode":[0,0], "inverse":[False,True], "step":[2038, 2038], "startstep":[0,0]}
+    runner = StepperRunner(Stepper([12, 16, 20, 21], [19, 13, 6, 5], logger=logger_stepper, timing='deadline'), controlsD, logger=logger_stepper)
+    runner.start()
+    try:
+        for x in range(10):
+            sleep(1)   # main loop can block without stalling the motors
+            logger_stepper.info(runner.snapshot())
+            if x == 5:
+                runner.command({"delay":[0.8,1.0], "speed":[1,4], "mode":[0,0], "inverse":[False,True], "step":[2038, 2038], "startstep":[0,0]})
+    finally:
+        runner.stop()
@@ -0,0 +1,105 @@
+'''
+Buffered step sequence playback for the steppers. A host (node-red or a script) pushes compact
+segments and the stepping loop plays them back from a bounded ring buffer, so long moves and
+speed changes do not need an mqtt round trip per change.
+
+Segment format (one list per segment, ints):
+ [ticks, delay_us, speed0, speed1, ...]
+ ticks    - number of step() ticks to run the segment
+ delay_us - tick delay in microseconds
+ speedN   - speed code per motor. 0=fullstepCCW, 1=halfstepCCW, 2=stop, 3=halfstep CW, 4=fullstep CW
+ie mqtt topic nred2pi/stepperZCMD/segments with payload [[2038, 900, 3, 3], [1019, 1800, 4, 0]]
+
+One producer (mqtt on_message) calls push(), one consumer (stepping loop) calls next_command().
+push() checks every segment first and raises ValueError without queueing any if one is malformed.
+The producer only moves tail and the consumer only moves head, so no lock is needed.
+When the buffer drains to the low water mark the lowwater callback is called once with the number
+of free segment slots so the producer can refill ahead of time. The same split applies there: push()
+records the tail whenever the fill goes above low water and only the consumer records the tail it
+has notified for, so a refill is reported once even while push() and next_command() overlap.
+
+'''
+
+import logging
+import numpy as np
+
+class SegmentBuffer:
+    ''' Bounded ring buffer of step segments. next_command() returns controls for Stepper.step() '''
+
+    def __init__(self, numOfMotors, capacity=256, lowwater=64, lowwatercallback=None, logger=None):
+        if logger is not None:                        # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        self.numOfMotors = numOfMotors
+        self.capacity = capacity
+        self.lowwater = lowwater
+        self.lowwatercallback = lowwatercallback
+        self.segments = np.zeros((capacity, 2 + numOfMotors), dtype=np.int32)
+        self.head = 0          # segments consumed (consumer only)
+        self.tail = 0          # segments pushed (producer only)
+        self.remaining = 0     # ticks left in the current segment
+        self.filled = 0        # tail when a push last took the fill above low water (producer only)
+        self.notified = 0      # filled value the low water callback was last called for (consumer only)
+        self.command = {"delay":[0, 0], "speed":[2] * numOfMotors, "mode":[0] * numOfMotors, "inverse":[False] * numOfMotors,
+                        "step":[0] * numOfMotors, "startstep":[0] * numOfMotors}   # Reused for every tick
+
+    def fill(self):
+        return self.tail - self.head
+
+    def push(self, segments):
+        ''' Queue segments. Returns how many were accepted (rest are dropped when the buffer is full).
+        Raises ValueError and queues nothing if any segment is malformed '''
+        width = 2 + self.numOfMotors
+        try:
+            rows = np.asarray(segments, dtype=np.int64)
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError("Segments must be lists of {0} ints".format(width))
+        if rows.ndim not in (1, 2) or rows.size == 0 or rows.shape[-1] != width:
+            raise ValueError("Segments must be lists of {0} ints. Got shape {1}".format(width, rows.shape))
+        rows = rows.reshape(-1, width)
+        if (rows[:, :2] < 0).any() or (rows[:, :2] > 0x7FFFFFFF).any():
+            raise ValueError("Segment ticks and delay_us must be 0-{0}".format(0x7FFFFFFF))
+        if ((rows[:, 2:] < 0) | (rows[:, 2:] > 4)).any():
+            raise ValueError("Segment speeds must be 0-4")
+        accepted = min(len(rows), self.capacity - self.fill())
+        for row in rows[:accepted]:
+            self.segments[self.tail % self.capacity] = row
+            self.tail += 1                # Publish the segment after it is written
+        if accepted < len(rows):
+            self.logger.warning("Segment buffer full. Dropped {0} segments".format(len(rows) - accepted))
+        if self.fill() > self.lowwater:
+            self.filled = self.tail
+        return accepted
+
+    def next_command(self):
+        ''' Controls for the next tick or None if the buffer is empty '''
+        if self.remaining == 0:
+            if self.head == self.tail:
+                return None
+            segment = self.segments[self.head % self.capacity]
+            self.remaining = int(segment[0])
+            self.command["delay"][0] = int(segment[1]) / 1000   # ms
+            self.command["speed"][:] = segment[2:].tolist()
+            self.head += 1
+            filled = self.filled
+            if filled > self.notified and self.fill() <= self.lowwater:   # Once per refill above low water
+                self.notified = filled
+                if self.lowwatercallback is not None:
+                    self.lowwatercallback(self.capacity - self.fill())
+            if self.remaining <= 0:
+                return self.next_command()
+        self.remaining -= 1
+        return self.command
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    buffer = SegmentBuffer(2, capacity=4, lowwater=1, lowwatercallback=lambda free: logging.info("refill, {0} free".format(free)))
+    logging.info(buffer.push([[2, 900, 3, 3], [1, 1800, 4, 0], [3, 900, 1, 2]]))
+    command = buffer.next_command()
+    while command is not None:
+        logging.info(command)
+        command = buffer.next_command()
@@ -0,0 +1,98 @@
+'''
+System telemetry from sysfs/procfs. Files are opened once and re-read with os.pread so there is
+no open/close (or leaked descriptor) per publish. Samples are refreshed on their own interval and
+any device getdata() can merge the latest values into its payload.
+
+ cpufreq<n>i  - current frequency of core n (MHz)
+ cputempf     - thermal zone 0 temperature (C)
+ throttledi   - Pi firmware throttled flags (bit0 under-voltage, bit1 freq capped, bit2 throttled, bit3 soft temp limit)
+ load1f       - 1 minute load average
+
+Files that do not exist on this machine are skipped.
+
+ telemetry = SysTelemetry.shared()
+ telemetry.merge(outgoing, ('cpufreq0i', 'cputempf'))   # or merge(outgoing) for all keys
+
+'''
+
+import logging, os, glob
+from time import perf_counter
+
+class SysTelemetry:
+    ''' Cached sysfs/procfs descriptors sampled every interval seconds '''
+    _shared = None
+
+    def __init__(self, interval=1.0, logger=None):
+        if logger is not None:                        # Use logger passed as argument
+            self.logger = logger
+        elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
+            logging.basicConfig(level=logging.INFO)      # Create root logger
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        else:                                          # Root logger already exists and no custom logger passed
+            self.logger = logging.getLogger(__name__)    # Create from root logger
+        self.interval = interval
+        self.time0 = None
+        self.data = {}
+        cpufreq = sorted(glob.glob('/sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq'), key=lambda f: int(f.split('/')[5][3:]))
+        self.cpufd = [(core, fd) for core, fd in ((int(f.split('/')[5][3:]), self._open(f)) for f in cpufreq) if fd is not None]   # (core, fd) so a missing file does not shift the keys
+        self.tempfd = self._open('/sys/class/thermal/thermal_zone0/temp')
+        self.throttledfd = self._open('/sys/devices/platform/soc/soc:firmware/get_throttled')
+        self.loadfd = self._open('/proc/loadavg')
+
+    @classmethod
+    def shared(cls):
+        ''' One process wide instance so devices share the descriptors and samples '''
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def _open(self, filename):
+        try:
+            return os.open(filename, os.O_RDONLY)
+        except OSError:
+            self.logger.info("Telemetry not available: {0}".format(filename))
+            return None
+
+    def sample(self):
+        ''' Re-read every open file from offset 0 '''
+        for core, fd in self.cpufd:
+            self.data['cpufreq' + str(core) + 'i'] = int(os.pread(fd, 32, 0)) // 1000
+        if self.tempfd is not None:
+            self.data['cputempf'] = int(os.pread(self.tempfd, 32, 0)) / 1000
+        if self.throttledfd is not None:
+            self.data['throttledi'] = int(os.pread(self.throttledfd, 32, 0), 16)
+        if self.loadfd is not None:
+            self.data['load1f'] = float(os.pread(self.loadfd, 64, 0).split()[0])
+        self.time0 = perf_counter()
+
+    def getdata(self):
+        ''' Latest samples. Re-sampled when older than interval '''
+        if self.time0 is None or perf_counter() - self.time0 > self.interval:
+            self.sample()
+        return self.data
+
+    def merge(self, outgoing, keys=None):
+        ''' Add telemetry to a device payload. keys=None adds everything available '''
+        data = self.getdata()
+        if keys is None:
+            outgoing.update(data)
+        else:
+            for key in keys:
+                if key in data:
+                    outgoing[key] = data[key]
+        return outgoing
+
+    def close(self):
+        for fd in [fd for core, fd in self.cpufd] + [self.tempfd, self.throttledfd, self.loadfd]:
+            if fd is not None:
+                os.close(fd)
+        self.cpufd, self.tempfd, self.throttledfd, self.loadfd = [], None, None, None
+
+if __name__ == "__main__":
+    from time import sleep
+    logging.basicConfig(level=logging.INFO)
+    telemetry = SysTelemetry(interval=0.5)
+    for x in range(3):
+        logging.info(telemetry.getdata())
+        sleep(1)
+    telemetry.close()
@@ -0,0 +1,95 @@
+'''
+Hot path tracing. Drivers record fixed layout events (event id, timestamp, 4 ints, 2 floats) into
+a preallocated ring buffer made of array('q')/array('d'). Nothing is formatted when recording.
+Events are decoded and formatted only when dump() or lines() is called.
+
+ trace = TraceBuffer(4096)
+ EV_STEP = trace.register("Motor:{0} Steps:{1} phase:{2} speed {3}")   # ints are {0}-{3}, floats {4} {5}
+ trace.record(EV_STEP, 0, 120, 3, 3)
+ trace.dump(logger)                      # log every event still in the buffer
+ lines, index = trace.lines(since=index) # stream only the events recorded after index
+
+The oldest events are overwritten when the buffer wraps. record() takes a lock, so one buffer can be
+shared by the stepper runner, scheduler and bus poller threads. dump() logs at DEBUG (level= to change).
+
+'''
+
+import logging, threading
+from array import array
+from time import perf_counter_ns
+
+class TraceBuffer:
+    ''' Ring buffer of fixed layout events. capacity is rounded up to a power of 2 '''
+    NUMINTS = 4
+    NUMFLOATS = 2
+
+    def __init__(self, capacity=4096):
+        self.capacity = 1 << max(0, capacity - 1).bit_length()
+        self.mask = self.capacity - 1
+        self.event = array('h', bytes(2 * self.capacity))
+        self.ts = array('q', bytes(8 * self.capacity))
+        self.ints = array('q', bytes(8 * self.NUMINTS * self.capacity))
+        self.floats = array('d', bytes(8 * self.NUMFLOATS * self.capacity))
+        self.index = 0          # Total events recorded
+        self.formats = []       # event id -> format string
+        self.lock = threading.Lock()
+
+    def register(self, fmt):
+        ''' Return the event id for a format string. The same string returns the same id '''
+        if fmt not in self.formats:
+            self.formats.append(fmt)
+        return self.formats.index(fmt)
+
+    def record(self, event, i0=0, i1=0, i2=0, i3=0, f0=0.0, f1=0.0):
+        with self.lock:
+            n = self.index & self.mask
+            self.event[n] = event
+            self.ts[n] = perf_counter_ns()
+            base = n * 4
+            self.ints[base] = i0
+            self.ints[base + 1] = i1
+            self.ints[base + 2] = i2
+            self.ints[base + 3] = i3
+            base = n * 2
+            self.floats[base] = f0
+            self.floats[base + 1] = f1
+            self.index += 1
+
+    def events(self, since=0, end=None):
+        ''' Decode events recorded at or after since (older ones may have been overwritten) and before end '''
+        with self.lock:   # Copy, so events recorded meanwhile can not overwrite them half way
+            end = self.index if end is None else min(end, self.index)
+            first = max(since, self.index - self.capacity)
+            events = []
+            for k in range(first, end):
+                n = k & self.mask
+                events.append((self.ts[n], self.event[n], self.ints[n * 4:n * 4 + 4].tolist(), self.floats[n * 2:n * 2 + 2].tolist()))
+            return events
+
+    def lines(self, since=0):
+        ''' Formatted events since index. Returns (lines, index to pass next time) '''
+        end = self.index
+        lines = []
+        for ts, event, ints, floats in self.events(since, end):
+            lines.append("{0:.6f} {1}".format(ts / 1000000000, self.formats[event].format(*ints, *floats)))
+        return lines, end
+
+    def dump(self, logger, since=0, level=logging.DEBUG):
+        lines, end = self.lines(since)
+        for line in lines:
+            logger.log(level, line)
+        return end
+
+    def clear(self):
+        with self.lock:
+            self.index = 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    trace = TraceBuffer(8)
+    EV_STEP = trace.register("Motor:{0} Steps:{1} phase:{2}")
+    EV_ADC = trace.register("chan: {0} changed: {1} value: {4:1.3f} previously: {5:1.3f}")
+    for x in range(10):
+        trace.record(EV_STEP, 0, x, x % 8)
+        trace.record(EV_ADC, 1, x % 2, 0, 0, x * 0.1, (x - 1) * 0.1)
+    trace.dump(logging.getLogger('trace'))
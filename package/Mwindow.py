@@ -0,0 +1,95 @@
+'''
+Sliding window statistics updated in O(1) per sample. The window is an array('d') ring buffer.
+Each push replaces the oldest sample and updates
+ mean/variance - running mean and sum of squared deviations (Welford update for a replaced sample)
+ min/max       - monotonic deques of ring indexes. Every sample is added and removed at most once
+
+ window = RunningStats(10)
+ window.push(adc_value)    # One new sample per poll
+ window.mean, window.variance, window.min, window.max
+
+Until the window is full the statistics cover the samples pushed so far.
+
+'''
+
+from array import array
+from collections import deque
+
+class RunningStats:
+    ''' Mean, variance, min and max of the last size samples '''
+
+    def __init__(self, size=10):
+        self.size = size
+        self.values = array('d', bytes(8 * size))
+        self.count = 0      # Total samples pushed
+        self.mean = 0.0
+        self.m2 = 0.0       # Sum of squared deviations from the mean
+        self._min = deque() # Ring indexes with increasing values
+        self._max = deque() # Ring indexes with decreasing values
+
+    def push(self, value):
+        n = self.count
+        if n < self.size:   # Growing window
+            delta = value - self.mean
+            self.mean += delta / (n + 1)
+            self.m2 += delta * (value - self.mean)
+        else:               # Replace the oldest sample
+            old = self.values[n % self.size]
+            mean = self.mean + (value - old) / self.size
+            self.m2 += (value - old) * (value - mean + old - self.mean)
+            self.mean = mean
+            if self._min[0] == n - self.size:
+                self._min.popleft()
+            if self._max[0] == n - self.size:
+                self._max.popleft()
+        self.values[n % self.size] = value
+        while self._min and self.values[self._min[-1] % self.size] >= value:
+            self._min.pop()
+        self._min.append(n)
+        while self._max and self.values[self._max[-1] % self.size] <= value:
+            self._max.pop()
+        self._max.append(n)
+        self.count = n + 1
+        return self.mean
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    @property
+    def full(self):
+        return self.count >= self.size
+
+    @property
+    def variance(self):
+        ''' Population variance of the window '''
+        return max(0.0, self.m2 / len(self)) if self.count else 0.0
+
+    @property
+    def min(self):
+        return self.values[self._min[0] % self.size] if self.count else None
+
+    @property
+    def max(self):
+        return self.values[self._max[0] % self.size] if self.count else None
+
+    def fill(self, value):
+        ''' Start from a window full of value (ie the first reading) '''
+        self.clear()
+        for x in range(self.size):
+            self.push(value)
+
+    def clear(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self._min.clear()
+        self._max.clear()
+
+if __name__ == "__main__":
+    import random, statistics
+    window = RunningStats(10)
+    data = [random.uniform(0, 5) for x in range(1000)]
+    for x, value in enumerate(data):
+        window.push(value)
+    last = data[-10:]
+    print(window.mean - statistics.fmean(last), window.variance - statistics.pvariance(last), window.min == min(last), window.max == max(last))
@@ -1 +1,23 @@
 from .Mmodule import *
+from .Mstepperarray import *
+from .Msteprunner import *
+from .Mstream import *
+from .Minterp import *
+from .Mgpioout import *
+from .Msystelemetry import *
+from .Mtrace import *
+from .Mfakebus import *
+from .Mads1115stream import *
+from .Mmcp3008scan import *
+from .Mspectral import *
+from .Mwindow import *
+from .Mfilter import *
+from .Madaptive import *
+from .Mcalibrate import *
+from .Mrbe import *
+from .Mdelta import *
+from .Mscheduler import *
+from .Mbuspoll import *
+from .Mi2cbus import *
+from .Mina219nb import *
+from .Mmotion import *
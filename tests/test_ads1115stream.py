@@ -0,0 +1,95 @@
+import pytest
+from package.Mfakebus import FakeI2C, FakeADS1115
+from package.Mads1115stream import ADS1115Stream
+
+LEVELS = [1.2, 0.4, 3.3, 0.0]
+
+@pytest.fixture
+def bus():
+    return FakeI2C({0x48: FakeADS1115(LEVELS)})
+
+def test_config_is_continuous_single_ended(bus):
+    stream = ADS1115Stream(bus, gain=1, datarate=860, channels=(2,))
+    config = stream.config(2)
+    assert (config >> 12) & 0x07 == 0b110   # AIN2 to GND
+    assert (config >> 9) & 0x07 == 1         # +/-4.096V
+    assert config & (1 << 8) == 0            # Continuous
+    assert (config >> 5) & 0x07 == 7         # 860 SPS
+    assert config & 0x03 == 0b11             # Comparator off in timed mode
+
+def test_invalid_settings_raise(bus):
+    with pytest.raises(ValueError):
+        ADS1115Stream(bus, gain=3)
+    with pytest.raises(ValueError):
+        ADS1115Stream(bus, datarate=100)
+
+def test_single_channel_stream(bus):
+    stream = ADS1115Stream(bus, channels=(0,))
+    stream.start()
+    try:
+        assert stream.wait()
+        assert stream.average(0, 1) == pytest.approx(LEVELS[0], abs=0.001)
+    finally:
+        stream.stop()
+    assert stream.counts[1:] == [0, 0, 0]
+    assert bus.devices[0x48].registers[1] & (1 << 8)   # Back to single shot
+
+def test_mux_rotation_keeps_channels_apart(bus):
+    stream = ADS1115Stream(bus, channels=(0, 1, 2), burst=4)
+    stream.start()
+    try:
+        assert stream.wait()
+        while min(stream.counts[:3]) < 8:
+            stream.wait()
+    finally:
+        stream.stop()
+    for channel in (0, 1, 2):
+        assert stream.samples(channel) == pytest.approx([LEVELS[channel]] * len(stream.samples(channel)), abs=0.001)
+
+def test_samples_wrap_oldest_first(bus):
+    stream = ADS1115Stream(bus, channels=(0,), capacity=4)
+    for volts in range(6):
+        stream.append(0, float(volts))
+    assert stream.samples(0) == [2.0, 3.0, 4.0, 5.0]
+    assert stream.samples(0, 2) == [4.0, 5.0]
+    assert stream.average(0, 2) == 4.5
+    assert stream.average(1) is None
+
+def test_wait_times_out_without_a_device():
+    stream = ADS1115Stream(FakeI2C(), channels=(0,))
+    stream.start()
+    assert not stream.wait(timeout=0.05)
+
+def test_stream_waits_for_a_busy_bus(bus):
+    stream = ADS1115Stream(bus, channels=(0,))
+    assert bus.try_lock()   # Another driver is mid transfer
+    stream.start()
+    try:
+        assert not stream.wait(timeout=0.05)
+        bus.unlock()
+        assert stream.wait()
+    finally:
+        stream.stop()
+
+def test_take_keeps_channels_aligned(bus):
+    stream = ADS1115Stream(bus, channels=(0, 1), capacity=8)
+    for k in range(3):
+        stream.append(0, 10.0 + k)
+    for k in range(5):
+        stream.append(1, 20.0 + k)
+    rows, since = stream.take([0, 0])
+    assert rows == [(10.0, 20.0), (11.0, 21.0), (12.0, 22.0)]
+    assert since == [3, 3]
+    stream.append(0, 13.0)
+    rows, since = stream.take(since)
+    assert rows == [(13.0, 23.0)]
+    assert since == [4, 4]
+    assert stream.take(since) == ([], [4, 4])
+
+def test_take_skips_overwritten_samples(bus):
+    stream = ADS1115Stream(bus, channels=(0,), capacity=4)
+    for k in range(10):
+        stream.append(0, float(k))
+    rows, since = stream.take([2])
+    assert rows == [(6.0,), (7.0,), (8.0,), (9.0,)]
+    assert since == [10]
@@ -0,0 +1,45 @@
+from package.Mdelta import DeltaEncoder, decode
+
+def frames(encoder, payloads):
+    ''' Encode payloads one second apart and decode them. Returns (messages, decoded payloads) '''
+    state, messages, decoded = {}, [], []
+    for n, payload in enumerate(payloads):
+        messages.append(encoder.encode(payload, now=n))
+        decoded.append(decode(state, messages[-1]))
+    return messages, decoded
+
+def test_unchanged_keys_are_left_out():
+    messages, decoded = frames(DeltaEncoder(), [{'a': 1, 'b': 2}, {'a': 1, 'b': 3}])
+    assert messages[1] == {'b': 3, 'seqi': 1, 'keyi': 0}
+    assert decoded[1] == {'a': 1, 'b': 3, 'seqi': 1, 'keyi': 0}
+
+def test_deadband_counts_as_unchanged():
+    messages, decoded = frames(DeltaEncoder(deadbands={'b': 0.5}), [{'a': 1, 'b': 2.0}, {'a': 1, 'b': 2.4}])
+    assert messages[1] == {'seqi': 1, 'keyi': 0}
+
+def test_removed_key_sends_a_keyframe():
+    payload = {'a': 1, 'b': 2, 'c': 3, 'd': 4, 'hz': 5}
+    smaller = {'a': 1, 'b': 2, 'c': 3, 'd': 4}
+    messages, decoded = frames(DeltaEncoder(), [payload, smaller, smaller])
+    assert messages[1]['keyi'] == messages[1]['seqi'] == 1
+    assert decoded[1] == dict(smaller, seqi=1, keyi=1)
+    assert messages[2] == {'seqi': 2, 'keyi': 1}
+    assert 'hz' not in decoded[2]
+
+def test_added_key_is_in_the_delta():
+    messages, decoded = frames(DeltaEncoder(), [{'a': 1, 'b': 2, 'c': 3}, {'a': 1, 'b': 2, 'c': 3, 'hz': 5}])
+    assert messages[1] == {'hz': 5, 'seqi': 1, 'keyi': 0}
+    assert decoded[1]['hz'] == 5
+
+def test_keyframe_every_n_payloads_and_on_request():
+    encoder = DeltaEncoder(keyframe=3)
+    messages, decoded = frames(encoder, [{'a': n, 'b': 0, 'c': 0} for n in range(4)])
+    assert [m['keyi'] == m['seqi'] for m in messages] == [True, False, False, True]
+    encoder.request_keyframe()
+    assert encoder.encode({'a': 3, 'b': 0, 'c': 0}, now=4)['keyi'] == 4
+
+def test_missed_keyframe_drops_deltas():
+    encoder, state = DeltaEncoder(), {}
+    encoder.encode({'a': 1, 'b': 1}, now=0)   # Lost
+    assert decode(state, encoder.encode({'a': 2, 'b': 1}, now=1)) is None
+    assert state.get('lost', 0) == 0
@@ -0,0 +1,75 @@
+import logging
+from package.Mgpioout import PinBank, RecorderBackend
+from package.Mmodule import COILPHASES, Stepper
+
+M1PINS, M2PINS = [12, 16, 20, 21], [19, 13, 6, 5]
+
+def bank(maxwrites=100000):
+    recorder = RecorderBackend(maxwrites)
+    return PinBank([M1PINS, M2PINS], COILPHASES, recorder), recorder
+
+def test_setup_receives_every_pin():
+    pins, recorder = bank()
+    assert recorder.pins == M1PINS + M2PINS
+    assert pins.allmask == sum(1 << pin for pin in M1PINS + M2PINS)
+
+def test_phasemask_matches_coil_patterns():
+    pins, recorder = bank()
+    for motor, motorpins in enumerate((M1PINS, M2PINS)):
+        for phase, pattern in enumerate(COILPHASES):
+            pins.write(pins.phasemask[motor][phase])
+            assert recorder.states(motorpins) == list(pattern)
+
+def test_write_phases_sets_every_motor_in_one_write():
+    pins, recorder = bank()
+    pins.write_phases([0, 2], [True, True])
+    assert recorder.states(M1PINS) == list(COILPHASES[0])
+    assert recorder.states(M2PINS) == list(COILPHASES[2])
+    assert len(recorder.writes) == 1
+
+def test_stopped_motor_is_low():
+    pins, recorder = bank()
+    pins.write_phases([0, 2], [True, True])
+    pins.write_phases([1, 2], [True, False])
+    assert recorder.states(M1PINS) == list(COILPHASES[1])
+    assert recorder.states(M2PINS) == [0, 0, 0, 0]
+
+def test_clearmask_is_every_other_motor_pin():
+    pins, recorder = bank()
+    pins.write_phases([4, 6], [True, True])
+    ns, setmask, clearmask = recorder.writes[-1]
+    assert setmask == pins.phasemask[0][4] | pins.phasemask[1][6]
+    assert clearmask == pins.allmask & ~setmask
+    assert setmask & clearmask == 0
+
+def test_write_timestamps_increase():
+    pins, recorder = bank()
+    for phase in range(8):
+        pins.write_phases([phase, phase], [True, True])
+    stamps = [ns for ns, setmask, clearmask in recorder.writes]
+    assert stamps == sorted(stamps)
+
+def test_maxwrites_caps_history_but_not_levels():
+    pins, recorder = bank(maxwrites=3)
+    for phase in range(8):
+        pins.write_phases([phase, 0], [True, False])
+    assert len(recorder.writes) == 3
+    assert recorder.states(M1PINS) == list(COILPHASES[7])
+
+def test_cleanup_drives_all_pins_low():
+    pins, recorder = bank()
+    pins.write_phases([0, 0], [True, True])
+    pins.cleanup()
+    assert recorder.writes[-1][1:] == (0, pins.allmask)
+    assert recorder.states(M1PINS + M2PINS) == [0] * 8
+
+def test_stepper_writes_once_per_step():
+    recorder = RecorderBackend()
+    motor = Stepper(M1PINS, M2PINS, logger=logging.getLogger('test'), output=recorder)
+    command = {'delay': [0.0, 0.0], 'speed': [3, 2], 'mode': [0, 0], 'startstep': [0, 0], 'step': [0, 0], 'inverse': [False, False]}
+    for n in range(5):
+        motor.step(command)
+    assert len(recorder.writes) == 5
+    assert recorder.states(M1PINS) == list(COILPHASES[motor.mach.stepper[0].phase])
+    assert recorder.states(M2PINS) == [0, 0, 0, 0]
+    assert motor.mach.stepper[0].step == 5
@@ -0,0 +1,124 @@
+import threading
+import time
+import pytest
+from package.Mfakebus import FakeI2C
+from package.Mi2cbus import I2CBus, I2CManager, RegisterDevice
+
+class Registers:
+    ''' 16 bit register file with an auto incrementing pointer '''
+
+    def __init__(self, values):
+        self.values = list(values)
+        self.pointer = 0
+
+    def write(self, data):
+        self.pointer = data[0]
+        for k in range(1, len(data) - 1, 2):
+            self.values[self.pointer] = (data[k] << 8) | data[k + 1]
+
+    def read(self, length):
+        data = bytearray()
+        while len(data) < length:
+            data += self.values[self.pointer].to_bytes(2, 'big')
+            self.pointer += 1
+        return bytes(data[:length])
+
+@pytest.fixture
+def bus():
+    return I2CBus(FakeI2C({0x40: Registers(range(0x100, 0x108)), 0x48: Registers([0x8000, 0x0001, 0xFFFE, 0x1234])}))
+
+def queue(bus, n):
+    ''' Start n threads while bus is held, each after the previous one has its ticket. Returns the order they got the bus '''
+    order = []
+    def worker(k):
+        with bus:
+            order.append(k)
+    threads = []
+    for k in range(n):
+        tickets = bus._tickets
+        threads.append(threading.Thread(target=worker, args=(k,)))
+        threads[-1].start()
+        while bus._tickets == tickets:
+            time.sleep(0.001)
+    return threads, order
+
+def test_threads_get_the_bus_in_fifo_order(bus):
+    bus.acquire()
+    threads, order = queue(bus, 8)
+    assert order == []
+    bus.release()
+    for thread in threads:
+        thread.join()
+    assert order == list(range(8))
+
+def test_lock_is_reentrant(bus):
+    with bus:
+        with bus:
+            assert bus.try_lock()
+            bus.unlock()
+        assert bus._owner == threading.get_ident()
+    assert bus._owner is None
+    assert bus._serving == bus._tickets
+
+def test_read_registers_one_transfer_each(bus):
+    values = bus.read_registers(0x40, (0, 1, 2, 5))
+    assert [int.from_bytes(value, 'big') for value in values] == [0x100, 0x101, 0x102, 0x105]
+    assert bus.backend.transactions == 4
+
+def test_autoincrement_merges_consecutive_registers(bus):
+    values = bus.read_registers(0x40, (0, 1, 2, 5, 6, 3), autoincrement=True)
+    assert [int.from_bytes(value, 'big') for value in values] == [0x100, 0x101, 0x102, 0x105, 0x106, 0x103]
+    assert bus.backend.transactions == 3
+
+def test_read_registers_is_one_turn_on_the_bus(bus):
+    tickets = bus._tickets
+    bus.read_registers(0x40, range(8))
+    bus.read_registers(0x40, range(8), autoincrement=True)
+    assert bus._tickets == tickets + 2
+    assert bus.backend.transactions == 9
+
+def test_accounting_per_address(bus):
+    bus.read_registers(0x40, (0, 1, 2))
+    bus.read_registers(0x48, (0, 1), autoincrement=True)
+    bus.write_register(0x48, 3, b'\x00\x07')
+    stats = bus.stats()
+    assert stats[0x40]['transactions'] == 3
+    assert stats[0x48]['transactions'] == 2
+    assert stats[0x40]['busy'] > 0 and stats[0x48]['busy'] > 0
+    assert bus.backend.devices[0x48].values[3] == 7
+
+def test_wait_is_charged_to_the_waiting_address(bus):
+    bus.acquire()
+    thread = threading.Thread(target=bus.read_registers, args=(0x48, (0,)))
+    thread.start()
+    while bus._tickets < 2:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    bus.release()
+    thread.join()
+    assert bus.stats()[0x48]['wait'] >= 0.05
+    assert 0x40 not in bus.stats()
+
+def test_missing_device_releases_the_bus(bus):
+    with pytest.raises(OSError):
+        bus.read_registers(0x50, (0,))
+    assert bus._owner is None
+    assert bus._serving == bus._tickets
+
+def test_register_device(bus):
+    device = RegisterDevice(bus, 0x48)
+    assert device.readU16BE(0) == 0x8000
+    assert device.readS16BE(0) == -32768
+    assert device.readS16BE(2) == -2
+    device.writeList(1, [0x12, 0x34])
+    assert device.readU16BE(1) == 0x1234
+    assert bus.stats()[0x48]['transactions'] == 5
+
+def test_manager_shares_one_handle_per_bus():
+    manager = I2CManager()
+    first = manager.bus(3, FakeI2C())
+    assert manager.bus(3) is first
+    assert manager.bus(3, FakeI2C()).backend is first.backend
+    with pytest.raises(ValueError):
+        manager.bus(4)
+    assert manager.stats() == {'i2c3': {}}
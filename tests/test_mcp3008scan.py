@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from package.Mfakebus import FakeSPI, FakeMCP3008
+from package.Mmcp3008scan import MCP3008Scan
+
+CE0 = [0.1 * ch for ch in range(8)]
+CE1 = [3.3 - 0.1 * ch for ch in range(8)]
+
+def counts(volts):
+    ''' 10 bit result shifted to 16 bits, as the scan returns it '''
+    return [min(1023, round(v * 1024 / 3.3)) << 6 for v in volts]
+
+@pytest.fixture
+def spis():
+    return [FakeSPI(FakeMCP3008(CE0)), FakeSPI(FakeMCP3008(CE1))]
+
+def test_one_chip_scan(spis):
+    scan = MCP3008Scan(spis[:1], channels=8, samples=5)
+    raw = scan.scan()
+    assert raw.shape == (5, 8)
+    assert raw.dtype == np.uint16
+    assert (raw == counts(CE0)).all()
+    assert spis[0].transactions == 1
+    assert spis[0].frames == 40
+
+def test_sixteen_channels_use_both_chips(spis):
+    scan = MCP3008Scan(spis, channels=16, samples=10)
+    assert scan.averages() == pytest.approx(counts(CE0) + counts(CE1))
+    assert [spi.transactions for spi in spis] == [1, 1]
+    assert [spi.frames for spi in spis] == [80, 80]
+
+def test_partial_second_chip(spis):
+    scan = MCP3008Scan(spis, channels=10, samples=2)
+    assert scan.scan().shape == (2, 10)
+    assert (scan.raw[:, 8:] == counts(CE1[:2])).all()
+    assert spis[1].frames == 4
+
+def test_channel_count_is_checked(spis):
+    with pytest.raises(ValueError):
+        MCP3008Scan(spis[:1], channels=9)
+    with pytest.raises(ValueError):
+        MCP3008Scan(spis, channels=0)
+
+def test_scan_follows_the_signal():
+    levels = [1.0] * 8
+    spi = FakeSPI(FakeMCP3008(lambda channel, t: levels[channel]))
+    scan = MCP3008Scan([spi], channels=8, samples=4)
+    first = scan.averages().copy()
+    levels[3] = 2.0
+    second = scan.averages()
+    assert second[3] > first[3]
+    assert np.delete(second, 3) == pytest.approx(np.delete(first, 3))
+
+def test_capture_runs_at_the_requested_rate():
+    spi = FakeSPI(FakeMCP3008(lambda channel, t: 1.5 + np.sin(2 * np.pi * 100 * t)))
+    scan = MCP3008Scan([spi], channels=1, samples=1)
+    rate = scan.setup_capture(1024, 4000)
+    assert rate == pytest.approx(4000, rel=0.01)
+    block = np.zeros((1024, 1), dtype=np.uint16)
+    scan.capture(block)
+    assert spi.clock == pytest.approx(1024 / rate)
+    spectrum = np.abs(np.fft.rfft(block[:, 0] - block[:, 0].mean()))
+    assert np.fft.rfftfreq(1024, 1 / rate)[spectrum.argmax()] == pytest.approx(100, abs=rate / 1024)
@@ -0,0 +1,77 @@
+import threading
+import pytest
+from package.Mfakebus import FakeGPIO
+from package.Mrotary_encoder import QuadratureDecoder, RotaryEncoder
+
+CLK, DT, BUTTON = 17, 27, 24
+
+@pytest.fixture
+def gpio():
+    gpio = FakeGPIO()
+    for pin in (CLK, DT, BUTTON):
+        gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_DOWN)
+    return gpio
+
+def test_clockwise_detents(gpio):
+    decoder = QuadratureDecoder(gpio, CLK, DT)
+    gpio.turn(CLK, DT, 3)
+    assert decoder.read() == (3, 12)
+    assert decoder.errors == 0
+
+def test_counter_clockwise_detents(gpio):
+    decoder = QuadratureDecoder(gpio, CLK, DT)
+    gpio.turn(CLK, DT, -5)
+    assert decoder.read() == (-5, -20)
+
+@pytest.mark.parametrize('bounce', [1, 2, 5])
+def test_bounce_is_rejected(gpio, bounce):
+    decoder = QuadratureDecoder(gpio, CLK, DT)
+    gpio.turn(CLK, DT, 4, bounce=bounce)
+    gpio.turn(CLK, DT, -1, bounce=bounce)
+    assert decoder.read() == (3, 12)
+    assert decoder.errors == 0
+    assert decoder.edges == 5 * 4 * (2 * bounce + 1)
+
+def test_position_only_moves_at_rest_state(gpio):
+    decoder = QuadratureDecoder(gpio, CLK, DT)
+    gpio.set(DT, 1)   # First quarter step clockwise
+    assert decoder.read() == (0, 1)
+    gpio.set(DT, 0)   # Back again (chatter)
+    assert decoder.read() == (0, 0)
+
+def test_both_pins_changing_counts_an_error(gpio):
+    decoder = QuadratureDecoder(gpio, CLK, DT)
+    gpio.levels[CLK] = gpio.levels[DT] = 1   # Both pins changed before the callback ran
+    decoder._edge(CLK)
+    assert decoder.errors == 1
+    assert decoder.read() == (0, 0)
+
+def test_duplicate_callbacks_are_ignored(gpio):
+    decoder = QuadratureDecoder(gpio, CLK, DT)
+    gpio.set(DT, 1)
+    decoder._edge(DT)   # Second callback for the same change
+    assert decoder.read() == (0, 1)
+
+def test_concurrent_edges_and_reads(gpio):
+    encoder = RotaryEncoder(CLK, DT, BUTTON, gpio=gpio)
+    turner = threading.Thread(target=lambda: [gpio.turn(CLK, DT, 1, bounce=1) for i in range(2000)])
+    turner.start()
+    while turner.is_alive():
+        encoder.getdata()
+    turner.join()
+    assert encoder.decoder.read() == (2000, 8000)
+    assert encoder.decoder.errors == 0
+
+def test_getdata_returns_changes_only(gpio):
+    encoder = RotaryEncoder(CLK, DT, BUTTON, 'RotEnc1Ci', 'RotEnc1Bi', gpio=gpio)
+    assert encoder.getdata() is None
+    gpio.turn(CLK, DT, -2)
+    assert encoder.getdata() == {'RotEnc1Ci': -2, 'RotEnc1Bi': 0}
+    assert encoder.getdata() is None
+    gpio.set(BUTTON, 1)
+    assert encoder.getdata() == {'RotEnc1Ci': -2, 'RotEnc1Bi': 1}
+
+def test_polled_mode_without_interrupts(gpio):
+    encoder = RotaryEncoder(CLK, DT, BUTTON, gpio=gpio, interrupt=False)
+    assert encoder.decoder is None
+    assert CLK not in gpio.events and DT not in gpio.events
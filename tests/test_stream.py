@@ -0,0 +1,51 @@
+import pytest
+from package.Mstream import SegmentBuffer
+
+def drain(buffer, ticks=None):
+    n = 0
+    while (ticks is None or n < ticks) and buffer.next_command() is not None:
+        n += 1
+    return n
+
+def test_segments_play_back_in_order():
+    buffer = SegmentBuffer(2, capacity=4)
+    assert buffer.push([[2, 900, 3, 3], [1, 1800, 4, 0]]) == 2
+    commands = [(command["delay"][0], list(command["speed"])) for command in iter(buffer.next_command, None)]
+    assert commands == [(0.9, [3, 3]), (0.9, [3, 3]), (1.8, [4, 0])]
+
+def test_full_buffer_drops_the_rest():
+    buffer = SegmentBuffer(1, capacity=2)
+    assert buffer.push([[1, 1, 3]] * 3) == 2
+    assert buffer.fill() == 2
+
+@pytest.mark.parametrize('segments', [[[1, 2, 3]], [[1, 2, 3, 9]], [[-1, 900, 3, 3]], 'x', None, [], [[1, 2, 3, 3], [1, 2]]])
+def test_malformed_segments_are_rejected(segments):
+    buffer = SegmentBuffer(2)
+    with pytest.raises(ValueError):
+        buffer.push(segments)
+    assert buffer.fill() == 0
+
+def test_low_water_is_reported_once_per_refill():
+    calls = []
+    buffer = SegmentBuffer(1, capacity=8, lowwater=2, lowwatercallback=calls.append)
+    buffer.push([[1, 1, 3]] * 5)
+    drain(buffer)
+    assert calls == [6]
+    buffer.push([[1, 1, 3]] * 2)   # Never above low water
+    drain(buffer)
+    assert calls == [6]
+    buffer.push([[1, 1, 3]] * 6)
+    drain(buffer, 3)
+    buffer.push([[1, 1, 3]])       # Topped up before reaching low water
+    drain(buffer)
+    assert calls == [6, 6]
+
+def test_refill_recorded_after_the_consumer_drained():
+    calls = []
+    buffer = SegmentBuffer(1, capacity=8, lowwater=2, lowwatercallback=calls.append)
+    buffer.push([[1, 1, 3]] * 5)
+    drain(buffer, 3)
+    assert calls == [6]
+    buffer.filled = buffer.tail    # push() saw the fill above low water before the consumer drained it
+    drain(buffer)
+    assert calls == [6]